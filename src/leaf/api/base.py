@@ -7,7 +7,7 @@ Leaf Package Manager
 @license:   https://www.mozilla.org/en-US/MPL/2.0/
 """
 
-import operator
+import hashlib
 import os
 import platform
 from collections import OrderedDict
@@ -15,15 +15,15 @@ from datetime import datetime, timedelta
 from pathlib import Path
 
 from leaf import __version__
+from leaf.core.cache import InstalledPackagesIndex
 from leaf.core.constants import LeafFiles, LeafSettings
 from leaf.core.error import LeafException, UserCancelException
 from leaf.core.logger import TextLogger, print_trace
-from leaf.core.utils import is_folder_ignored
 from leaf.model.base import Scope
 from leaf.model.config import ConfigContextManager, UserConfiguration
 from leaf.model.environment import Environment
-from leaf.model.modelutils import keep_latest
-from leaf.model.package import InstalledPackage, ScopeSetting
+from leaf.model.modelutils import PackageMap, keep_latest
+from leaf.model.package import InstalledPackage, LeafArtifact, PackageIdentifier, ScopeSetting
 from leaf.rendering.renderer.error import HintsRenderer, LeafExceptionRenderer
 from leaf.rendering.renderer.question import QuestionRenderer
 from leaf.rendering.theme import ThemeManager
@@ -53,8 +53,11 @@ class ConfigurationManager:
         return out
 
     def is_file_outdated(self, file: Path):
+        return self.is_timestamp_outdated(file.stat().st_mtime)
+
+    def is_timestamp_outdated(self, timestamp: float):
         ndays = LeafSettings.SMART_REFRESH_DELTA.as_int()
-        return ndays > 0 and datetime.fromtimestamp(file.stat().st_mtime) < datetime.now() - timedelta(days=ndays)
+        return ndays > 0 and datetime.fromtimestamp(timestamp) < datetime.now() - timedelta(days=ndays)
 
     def init_leaf_settings(self):
         userenvmap = self.read_user_configuration()._getenvmap()
@@ -106,6 +109,36 @@ class ConfigurationManager:
         with self.open_user_configuration() as config:
             config.update_environment(set_map, unset_list)
 
+    def get_installed_packages_index(self, root_folder: Path) -> InstalledPackagesIndex:
+        """
+        Return the index of the packages installed in the given folder, stored in the cache folder
+        """
+        root_folder = root_folder.absolute()
+        index_name = hashlib.sha1(str(root_folder).encode()).hexdigest() + ".json"
+        return InstalledPackagesIndex(self.cache_folder / LeafFiles.CACHE_INSTALLED_FOLDERNAME / index_name, root_folder)
+
+    def open_artifact(self, path: Path) -> LeafArtifact:
+        """
+        Return the artifact for the given file, its content is only read again if the file changed since last time
+        """
+        path = Path(str(path))
+        scan_name = hashlib.sha1(str(path.absolute()).encode()).hexdigest() + ".json"
+        return LeafArtifact(path, scan_file=self.cache_folder / LeafFiles.CACHE_ARTIFACTS_FOLDERNAME / scan_name)
+
+    def prune_artifact_scans(self) -> list:
+        """
+        Remove the scan files of the artifacts which have been removed or modified since they were opened
+        @return: the removed files
+        """
+        out = []
+        scans_folder = self.cache_folder / LeafFiles.CACHE_ARTIFACTS_FOLDERNAME
+        if scans_folder.is_dir():
+            for scan_file in scans_folder.iterdir():
+                if scan_file.is_file() and LeafArtifact.is_scan_outdated(scan_file):
+                    scan_file.unlink()
+                    out.append(scan_file)
+        return out
+
     def _list_installed_packages(self, root_folder: Path, read_only: bool) -> dict:
         """
         Return all installed packages in given folder
@@ -113,17 +146,16 @@ class ConfigurationManager:
         """
         out = {}
         if root_folder is not None and root_folder.is_dir():
-            for folder in root_folder.iterdir():
-                # iterate over non ignored sub folders
-                if folder.is_dir() and not is_folder_ignored(folder):
-                    # test if a manifest exists
-                    mffile = folder / LeafFiles.MANIFEST
-                    if mffile.is_file():
-                        try:
-                            ip = InstalledPackage(mffile, read_only=read_only)
-                            out[ip.identifier] = ip
-                        except BaseException:
-                            print_trace("Invalid manifest found: {mf}".format(mf=mffile))
+            for name, identifier in self.get_installed_packages_index(root_folder).packages.items():
+                mffile = root_folder / name / LeafFiles.MANIFEST
+                if not mffile.is_file():
+                    continue
+                try:
+                    # Manifests are parsed on demand
+                    ip = InstalledPackage(mffile, read_only=read_only, identifier=PackageIdentifier.parse(identifier))
+                    out[ip.identifier] = ip
+                except BaseException:
+                    print_trace("Invalid manifest found: {mf}".format(mf=mffile))
         return out
 
     def list_installed_packages(self, only_latest=False, alt_user_root_folder: Path = None) -> dict:
@@ -138,11 +170,10 @@ class ConfigurationManager:
 
         # only keep latest if needed
         if only_latest:
-            latest_pi_list = keep_latest(out.keys())
-            out = {pi: ip for pi, ip in out.items() if pi in latest_pi_list}
+            return PackageMap((pi, out[pi]) for pi in keep_latest(PackageMap(out)))
 
         # sort dict by package identifier
-        return OrderedDict(sorted(out.items(), key=operator.itemgetter(0)))
+        return PackageMap(sorted(out.items(), key=lambda item: item[0].key))
 
     def get_setting(self, setting_id: str) -> ScopeSetting:
         out = self.get_settings().get(setting_id)
@@ -7,20 +7,22 @@ Leaf Package Manager
 @license:   https://www.mozilla.org/en-US/MPL/2.0/
 """
 
-import shutil
-from collections import OrderedDict
+from concurrent.futures import wait
 from pathlib import Path
-from tarfile import TarFile
 
 from leaf.api.remotes import RemoteManager
-from leaf.core.constants import LeafConstants, LeafFiles, LeafSettings
-from leaf.core.download import download_and_verify_file
+from leaf.core.cache import DownloadCache
+from leaf.core.constants import JsonConstants, LeafFiles, LeafSettings
+from leaf.core.download import DownloadPool, download_and_verify_file
 from leaf.core.error import InvalidPackageNameException, LeafException, LeafOutOfDateException, NoPackagesInCacheException, PrereqException
+from leaf.core.extract import ExtractionPool, extract_tarfile
+from leaf.core.jsonutils import jtostring
 from leaf.core.lock import LockFile
-from leaf.core.utils import fs_check_free_space, fs_compute_total_size, get_cached_artifact_name, mark_folder_as_ignored, rmtree_force
+from leaf.core.store import ContentStore
+from leaf.core.utils import fs_check_free_space, get_cached_artifact_name, mark_folder_as_ignored, rmtree_force
 from leaf.model.dependencies import DependencyUtils
 from leaf.model.environment import Environment
-from leaf.model.modelutils import check_leaf_min_version, find_manifest, is_latest_package
+from leaf.model.modelutils import PackageMap, check_leaf_min_version, find_manifest, is_latest_package
 from leaf.model.package import IDENTIFIER_GETTER, AvailablePackage, InstalledPackage, LeafArtifact, PackageIdentifier
 from leaf.model.steps import StepExecutor, VariableResolver
 from leaf.rendering.formatutils import sizeof_fmt
@@ -32,12 +34,15 @@ class PackageManager(RemoteManager):
     Main API for using Leaf package manager
     """
 
+    # Available packages map shared by all instances, with the key used to check its validity
+    __AVAILABLE_PACKAGES_CACHE = None
+
     def __init__(self):
         """
         Constructor
         """
         RemoteManager.__init__(self)
-        self.__download_cache_folder = self.cache_folder / LeafFiles.CACHE_DOWNLOAD_FOLDERNAME
+        self.__download_cache = DownloadCache(self.cache_folder / LeafFiles.CACHE_DOWNLOAD_FOLDERNAME)
         self.__application_lock = LockFile(self.find_configuration_file(LeafFiles.LOCK_FILENAME))
         self.__check_cache_folder_size()
 
@@ -45,35 +50,124 @@ class PackageManager(RemoteManager):
     def application_lock(self):
         return self.__application_lock
 
+    @property
+    def download_cache(self):
+        return self.__download_cache
+
+    @property
+    def content_store(self) -> ContentStore:
+        return ContentStore(self.install_folder / LeafFiles.CONTENT_STORE_FOLDERNAME)
+
+    def __get_install_store(self) -> ContentStore:
+        """
+        Return the store used to share the files of the installed packages, if enabled
+        """
+        return self.content_store if LeafSettings.INSTALL_DEDUP.as_boolean() else None
+
+    def __release_store_objects(self, folder: Path):
+        """
+        Remove the objects of the store used by a removed package folder, if no other package use them
+        """
+        store = self.content_store
+        count = store.release(folder)
+        if count > 0:
+            self.logger.print_verbose("Removed {count} unused object(s) from {folder}".format(count=count, folder=store.folder))
+
+    def __unshare_package(self, ip: InstalledPackage, steps_key: str):
+        """
+        Steps may modify files in place, the files shared with other packages are copied before
+        """
+        if not ip.read_only and ip.jsonget(steps_key):
+            count = self.content_store.unshare(ip.folder)
+            if count > 0:
+                self.logger.print_verbose("Copied {count} shared file(s) of {ip.identifier}".format(count=count, ip=ip))
+
     @property
     def download_cache_folder(self):
-        self.__download_cache_folder.mkdir(parents=True, exist_ok=True)
-        return self.__download_cache_folder
+        return self.__download_cache.folder
+
+    @property
+    def download_cache_max_size(self):
+        return LeafSettings.CACHE_SIZE_MAX.as_int() * 1024 * 1024
 
     def __check_cache_folder_size(self):
-        # Check if it has been checked recently
-        if self.is_file_outdated(self.download_cache_folder):
-            # Compute the folder total size
-            totalsize = fs_compute_total_size(self.download_cache_folder)
-            if totalsize > LeafConstants.CACHE_SIZE_MAX:
+        # Check if it has been checked recently, the ledger is used to avoid loading the cache index
+        # Nothing is removed here since the application lock is not held, the cache is pruned after installs
+        if self.is_timestamp_outdated(self.download_cache.last_check):
+            totalsize = self.download_cache.total_size
+            if totalsize > self.download_cache_max_size:
                 # Display a message
                 self.logger.print_error("You can save {size} by cleaning the leaf cache folder".format(size=sizeof_fmt(totalsize)))
-                self.print_hints("to clean the cache, you can run: 'rm -r {folder}'".format(folder=self.download_cache_folder))
-                # Clean the cache
-                if not LeafSettings.NON_INTERACTIVE.as_boolean() and LeafSettings.CACHE_AUTOCLEAN.as_boolean():
-                    if self.print_with_confirm(question="Do you want to clean the cache?"):
-                        shutil.rmtree(str(self.download_cache_folder))
-                # Update the mtime
-                self.download_cache_folder.touch()
+                self.print_hints("to clean the cache, you can run: 'leaf cache prune'")
+            self.download_cache.set_checked()
+
+    def __auto_prune_download_cache(self):
+        """
+        Evict the least recently used artifacts if the cache exceeds its budget and the user agrees
+        Must be called with the application lock held
+        """
+        if LeafSettings.CACHE_AUTOCLEAN.as_boolean() and self.download_cache.total_size > self.download_cache_max_size:
+            self.logger.print_default(
+                "The leaf cache folder uses {size}, more than {max}".format(
+                    size=sizeof_fmt(self.download_cache.total_size), max=sizeof_fmt(self.download_cache_max_size)
+                )
+            )
+            if self.print_with_confirm(question="Do you want to clean the cache?"):
+                removed = self.download_cache.prune(max_size=self.download_cache_max_size)
+                self.logger.print_verbose("{count} file(s) removed from the cache folder".format(count=len(removed)))
+                self.__prune_artifact_scans()
+
+    def __prune_artifact_scans(self):
+        removed = self.prune_artifact_scans()
+        if len(removed) > 0:
+            self.logger.print_verbose("{count} outdated artifact scan(s) removed from the cache folder".format(count=len(removed)))
+
+    def prune_download_cache(self, max_size: int = None, untracked: bool = False) -> list:
+        """
+        Remove the least recently used artifacts from the download cache, until the cache is smaller than
+        the given size (default to leaf.cache.size.max setting)
+        @return: the removed files
+        """
+        with self.application_lock.acquire():
+            if max_size is None:
+                max_size = self.download_cache_max_size
+            out = self.download_cache.prune(max_size=max_size, keep_untracked=not untracked)
+            # Scans of the removed artifacts, or of local artifacts removed since, are not needed anymore
+            self.__prune_artifact_scans()
+            return out
+
+    def verify_download_cache(self) -> list:
+        """
+        Check the hash of all artifacts in the download cache, corrupted files are removed
+        @return: the removed CacheEntry list
+        """
+        with self.application_lock.acquire():
+            return self.download_cache.verify()
 
     def list_available_packages(self, force_refresh=False) -> dict:
         """
         List all available package
+        The merged map is cached in the process until remotes are modified or fetched
         """
-        out = OrderedDict()
         self.fetch_remotes(force_refresh=force_refresh)
 
-        for remote in self.list_remotes(only_enabled=True).values():
+        remotes = self.list_remotes(only_enabled=True)
+        cache_key = (self.remotes_generation,) + tuple(
+            (alias, jtostring(remote.json), self.get_remote_cache_identity(alias)) for alias, remote in remotes.items()
+        )
+        cache = PackageManager.__AVAILABLE_PACKAGES_CACHE
+        if cache is None or cache[0] != cache_key:
+            cache = (cache_key, self.__build_available_packages(remotes))
+            PackageManager.__AVAILABLE_PACKAGES_CACHE = cache
+
+        if len(cache[1]) == 0:
+            raise NoPackagesInCacheException()
+        # Return copies, callers can add custom tags
+        return PackageMap((pi, ap.copy()) for pi, ap in cache[1].items())
+
+    def __build_available_packages(self, remotes: dict) -> PackageMap:
+        out = PackageMap()
+        for remote in remotes.values():
             if remote.is_fetched:
                 for ap in remote.available_packages:
                     if ap.identifier not in out:
@@ -90,9 +184,6 @@ class PackageManager(RemoteManager):
                         for t in ap.tags:
                             if t not in ap2.tags:
                                 ap2.tags.append(t)
-
-        if len(out) == 0:
-            raise NoPackagesInCacheException()
         return out
 
     def __download_ap(self, ap: AvailablePackage) -> LeafArtifact:
@@ -100,17 +191,41 @@ class PackageManager(RemoteManager):
         Download given available package and returns the files in cache folder
         @return LeafArtifact
         """
-        cachedfile = self.__download_cache_folder / get_cached_artifact_name(ap.filename, ap.hashsum)
+        cachedfile = self.__get_cached_file(ap)
         # Select best candidate
         candidate = ap.best_candidate
         self.logger.print_verbose("Downloading {ap.identifier} from {ap.remote.alias}: {ap.url}".format(ap=candidate))
-        download_and_verify_file(candidate.url, cachedfile, logger=self.logger, hashstr=ap.hashsum)
-        return LeafArtifact(cachedfile)
+        download_and_verify_file(candidate.url, cachedfile, logger=self.logger, hashstr=ap.hashsum, session=self.http_session)
+        self.__record_download(ap)
+        return self.open_artifact(cachedfile)
 
-    def __extract_artifact(self, la: LeafArtifact, env: Environment, ipmap: dict, keep_folder_on_error: bool = False) -> InstalledPackage:
+    def __get_cached_file(self, ap: AvailablePackage) -> Path:
         """
-        Install a leaf artifact
-        @return InstalledPackage
+        Artifacts are stored by hash in the download cache, the ones without hash keep their filename
+        """
+        if ap.hashsum is not None:
+            return self.download_cache.get_path(ap.hashsum)
+        return self.download_cache_folder / get_cached_artifact_name(ap.filename, ap.hashsum)
+
+    def __record_download(self, ap: AvailablePackage):
+        if ap.hashsum is not None:
+            self.download_cache.record(ap.hashsum, remote=ap.best_candidate.remote.alias, filename=ap.filename)
+
+    def __submit_download(self, pool: DownloadPool, ap: AvailablePackage):
+        """
+        Schedule the download of given available package in the given pool
+        @return Future which result is the file in cache folder
+        """
+        cachedfile = self.__get_cached_file(ap)
+        # Select best candidate
+        candidate = ap.best_candidate
+        pool.print_message("Downloading {ap.identifier} from {ap.remote.alias}: {ap.url}".format(ap=candidate), verbose=True)
+        return pool.submit(candidate.url, cachedfile, hashstr=ap.hashsum, size=ap.size, key=candidate.remote.alias, label=ap.filename)
+
+    def __prepare_artifact(self, la: LeafArtifact, ipmap: dict) -> Path:
+        """
+        Check that the artifact can be installed and create its folder
+        @return the folder where the artifact must be extracted
         """
         if la.identifier in ipmap:
             raise LeafException("Package is already installed: {la.identifier}".format(la=la))
@@ -126,27 +241,50 @@ class PackageManager(RemoteManager):
 
         # Create folder
         target_folder.mkdir(parents=True)
+        return target_folder
+
+    def __install_extracted_artifact(self, target_folder: Path, env: Environment, ipmap: dict) -> InstalledPackage:
+        """
+        Execute the install steps of an extracted artifact
+        @return InstalledPackage
+        """
+        out = InstalledPackage(target_folder / LeafFiles.MANIFEST)
+        ipmap[out.identifier] = out
+        self.__execute_steps(out.identifier, ipmap, StepExecutor.install, env=env)
+        # Share files once the install steps succeeded, since they may modify them
+        store = self.__get_install_store()
+        if store is not None:
+            saved = store.deduplicate(target_folder)
+            self.logger.print_verbose("Saved {size} by sharing files of {ip.identifier}".format(size=sizeof_fmt(saved), ip=out))
+        # Touch folder to trigger FS event
+        target_folder.touch(exist_ok=True)
+        self.get_installed_packages_index(self.install_folder).add(target_folder, out.identifier)
+        return out
 
+    def __rollback_artifact(self, target_folder: Path, keep_folder_on_error: bool = False):
+        if keep_folder_on_error:
+            target_folder = mark_folder_as_ignored(target_folder)
+            self.logger.print_verbose("Mark folder as ignored: {folder}".format(folder=target_folder))
+        else:
+            self.logger.print_verbose("Remove folder: {folder}".format(folder=target_folder))
+            rmtree_force(target_folder)
+            self.__release_store_objects(target_folder)
+
+    def __extract_artifact(self, la: LeafArtifact, env: Environment, ipmap: dict, keep_folder_on_error: bool = False) -> InstalledPackage:
+        """
+        Install a leaf artifact
+        @return InstalledPackage
+        """
+        target_folder = self.__prepare_artifact(la, ipmap)
         try:
             # Extract content
             self.logger.print_verbose("Extract {la.path} in {dest}".format(la=la, dest=target_folder))
-            with TarFile.open(str(la.path)) as tf:
-                tf.extractall(str(target_folder))
+            extract_tarfile(la.path, target_folder)
             # Execute post install steps
-            out = InstalledPackage(target_folder / LeafFiles.MANIFEST)
-            ipmap[out.identifier] = out
-            self.__execute_steps(out.identifier, ipmap, StepExecutor.install, env=env)
-            # Touch folder to trigger FS event
-            target_folder.touch(exist_ok=True)
-            return out
+            return self.__install_extracted_artifact(target_folder, env, ipmap)
         except BaseException as e:
             self.logger.print_error("Error during installation:", e)
-            if keep_folder_on_error:
-                target_folder = mark_folder_as_ignored(target_folder)
-                self.logger.print_verbose("Mark folder as ignored: {folder}".format(folder=target_folder))
-            else:
-                self.logger.print_verbose("Remove folder: {folder}".format(folder=target_folder))
-                rmtree_force(target_folder)
+            self.__rollback_artifact(target_folder, keep_folder_on_error=keep_folder_on_error)
             raise e
 
     def __install_prereq(self, mflist: list, ipmap: dict, env: Environment = None, keep_folder_on_error: bool = False):
@@ -176,6 +314,7 @@ class PackageManager(RemoteManager):
         # Then, sync package sorted alphabetically
         for ip in sorted(ip_to_sync, key=IDENTIFIER_GETTER):
             # Sync package
+            self.__unshare_package(ip, JsonConstants.SYNC)
             self.__execute_steps(ip.identifier, ipmap, StepExecutor.sync, env=env)
 
     def install_packages(self, items: list, env: Environment = None, keep_folder_on_error: bool = False):
@@ -196,7 +335,7 @@ class PackageManager(RemoteManager):
                     pilist.append(PackageIdentifier.parse(item))
                 else:
                     # If leaf artifacts are given, add/replace identifiers of available packages
-                    la = LeafArtifact(Path(item))
+                    la = self.open_artifact(Path(item))
                     pilist.append(la.identifier)
                     apmap[la.identifier] = la
             out = []
@@ -245,29 +384,66 @@ class PackageManager(RemoteManager):
                     except BaseException as e:
                         raise PrereqException(e)
 
-                # Download ap list
-                self.logger.print_default("Downloading {size} package(s)".format(size=download_count))
-                la_to_install = []
-                for mf in ap_to_install:
-                    if isinstance(mf, AvailablePackage):
-                        la_to_install.append(self.__download_ap(mf))
-                    elif isinstance(mf, LeafArtifact):
-                        la_to_install.append(mf)
-
-                # Check the extracted size
+                # Check the extracted size, artifacts without final size are checked once downloaded
                 extracted_totalsize = 0
-                for la in la_to_install:
-                    if la.final_size is not None:
-                        extracted_totalsize += la.final_size
-                    else:
-                        extracted_totalsize += la.get_total_size()
+                for mf in ap_to_install:
+                    if mf.final_size is not None:
+                        extracted_totalsize += mf.final_size
                 fs_check_free_space(self.install_folder, extracted_totalsize)
 
-                # Extract la list
-                for la in la_to_install:
-                    self.logger.print_default("[{current}/{total}] Installing {la.identifier}".format(current=(len(out) + 1), total=len(la_to_install), la=la))
-                    ip = self.__extract_artifact(la, env, ipmap, keep_folder_on_error=keep_folder_on_error)
-                    out.append(ip)
+                # Download all packages in background and extract them concurrently as soon as they are downloaded and verified,
+                # then execute the install steps following the dependency order
+                self.logger.print_default("Downloading {size} package(s)".format(size=download_count))
+                try:
+                    with DownloadPool(logger=self.logger, session=self.http_session) as pool, ExtractionPool(jobs=len(ap_to_install)) as xpool:
+                        la_sources = [self.__submit_download(pool, mf) if isinstance(mf, AvailablePackage) else mf for mf in ap_to_install]
+                        # Extracted artifacts which are not installed yet
+                        extractions = []
+                        install_errors = []
+
+                        def install_extracted(block: bool):
+                            # Execute install steps following the dependency order, as soon as artifacts are extracted
+                            while len(install_errors) == 0 and len(extractions) > 0 and (block or extractions[0][2].done()):
+                                la, target_folder, future = extractions.pop(0)
+                                pool.print_message("[{current}/{total}] Installing {la.identifier}".format(current=(len(out) + 1), total=len(la_sources), la=la))
+                                try:
+                                    future.result()
+                                    out.append(self.__install_extracted_artifact(target_folder, env, ipmap))
+                                except BaseException as e:
+                                    install_errors.append(e)
+                                    self.logger.print_error("Error during installation:", e)
+                                    self.__rollback_artifact(target_folder, keep_folder_on_error=keep_folder_on_error)
+                                    raise e
+
+                        try:
+                            try:
+                                for mf, la_source in zip(ap_to_install, la_sources):
+                                    if isinstance(la_source, LeafArtifact):
+                                        la = la_source
+                                    else:
+                                        la = self.open_artifact(la_source.result())
+                                        self.__record_download(mf)
+                                    if la.final_size is None:
+                                        # Check the size of all packages to install, not only this one
+                                        extracted_totalsize += la.get_total_size()
+                                        fs_check_free_space(self.install_folder, extracted_totalsize)
+                                    target_folder = self.__prepare_artifact(la, ipmap)
+                                    pool.print_message("Extract {la.path} in {dest}".format(la=la, dest=target_folder), verbose=True)
+                                    extractions.append((la, target_folder, xpool.submit(la.path, target_folder)))
+                                    install_extracted(False)
+                            finally:
+                                # The packages extracted before a download failure are installed
+                                install_extracted(True)
+                        finally:
+                            # Remove the artifacts extracted but not installed because of a failure
+                            for _, _, future in extractions:
+                                future.cancel()
+                            wait([future for _, _, future in extractions])
+                            for _, target_folder, _ in extractions:
+                                self.__rollback_artifact(target_folder)
+                finally:
+                    self.download_cache.save()
+                self.__auto_prune_download_cache()
 
             return out
 
@@ -291,9 +467,12 @@ class PackageManager(RemoteManager):
                     if ip.read_only:
                         raise LeafException("Cannot uninstall system package {ip.identifier}".format(ip=ip))
                     self.logger.print_default("Removing {ip.identifier}".format(ip=ip))
+                    self.__unshare_package(ip, JsonConstants.UNINSTALL)
                     self.__execute_steps(ip.identifier, ipmap, StepExecutor.uninstall)
                     self.logger.print_verbose("Remove folder: {ip.folder}".format(ip=ip))
                     rmtree_force(ip.folder)
+                    self.__release_store_objects(ip.folder)
+                    self.get_installed_packages_index(ip.folder.parent).remove(ip.folder)
                     del ipmap[ip.identifier]
 
                 self.logger.print_default("{count} package(s) removed".format(count=len(iplist_to_remove)))
@@ -305,6 +484,7 @@ class PackageManager(RemoteManager):
         ipmap = self.list_installed_packages()
         for pi in pilist:
             self.logger.print_verbose("Sync package {pi}".format(pi=pi))
+            self.__unshare_package(find_manifest(pi, ipmap), JsonConstants.SYNC)
             self.__execute_steps(pi, ipmap, StepExecutor.sync, env=env)
 
     def __execute_steps(self, pi: PackageIdentifier, ipmap: dict, se_func: callable, env: Environment = None):
@@ -346,6 +526,7 @@ class PackageManager(RemoteManager):
                     raise InvalidPackageNameException(item)
             else:
                 raise InvalidPackageNameException(item)
-            vr = VariableResolver(ip, ipmap.values())
+            # The installed packages map is shared by all resolvers
+            vr = VariableResolver(ip, ipmap)
             out.append(ip.build_environment(vr=vr.resolve))
         return out
@@ -6,22 +6,44 @@ Leaf Package Manager
 @contact:   Legato Tooling Team <letools@sierrawireless.com>
 @license:   https://www.mozilla.org/en-US/MPL/2.0/
 """
+import hashlib
 import os
 import re
 import subprocess
 from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
 from datetime import datetime
 from pathlib import Path
 
 from leaf.api import LoggerManager
+from leaf.core.archive import COMPRESSIONS, create_tarfile
 from leaf.core.constants import JsonConstants, LeafConstants, LeafFiles, LeafSettings
 from leaf.core.error import LeafException
 from leaf.core.jsonutils import jlayer_update, jloadfile, jtostring, jwritefile
+from leaf.core.logger import print_trace
 from leaf.core.utils import hash_compute
 from leaf.model.modelutils import is_latest_package
 from leaf.model.package import AvailablePackage, ConditionalPackageIdentifier, LeafArtifact, Manifest, PackageIdentifier
 
 
+def build_artifact_node(artifact: Path, manifest: Manifest = None, hashstr: str = None, final_size: int = None) -> OrderedDict:
+    """
+    Build the node of an artifact in an index, with its info, hash and size
+    The hash is computed if not given, the final size is added to the info if the manifest does not define it
+    """
+    out = OrderedDict()
+    if manifest is None:
+        manifest = LeafArtifact(artifact)
+    info_node = manifest.info_node
+    if final_size is not None and manifest.final_size is None:
+        info_node = OrderedDict(info_node)
+        info_node[JsonConstants.INFO_FINALSIZE] = final_size
+    out[JsonConstants.INFO] = info_node
+    out[JsonConstants.REMOTE_PACKAGE_HASH] = hashstr if hashstr is not None else hash_compute(artifact)
+    out[JsonConstants.REMOTE_PACKAGE_SIZE] = artifact.stat().st_size
+    return out
+
+
 class RelengManager(LoggerManager):
     __TAR_FORBIDDEN_ARGS = {
         "-A",
@@ -48,6 +70,7 @@ class RelengManager(LoggerManager):
         "-f",
         "--file",
     }
+    __TAR_COMPRESSION_ARGS = {"gz": "-z", "bz2": "-j", "xz": "-J"}
     """
     Methods needed for releng, ie generate packages and maintain repository
     """
@@ -61,18 +84,18 @@ class RelengManager(LoggerManager):
     def find_external_info_file(self, artifact: LeafArtifact):
         return artifact.parent / (artifact.name + LeafConstants.EXTINFO_EXTENSION)
 
-    def __build_pkg_node(self, tarfile: Path, manifest: Manifest = None):
-        out = OrderedDict()
-        if manifest is None:
-            manifest = LeafArtifact(tarfile)
-        out[JsonConstants.INFO] = manifest.info_node
-        out[JsonConstants.REMOTE_PACKAGE_HASH] = hash_compute(tarfile)
-        out[JsonConstants.REMOTE_PACKAGE_SIZE] = tarfile.stat().st_size
-        return out
-
-    def create_package(self, input_folder: Path, output_file: Path, store_extenal_info: bool = True, tar_extra_args: list = None, validate_only: bool = False):
+    def create_package(
+        self,
+        input_folder: Path,
+        output_file: Path,
+        store_extenal_info: bool = True,
+        tar_extra_args: list = None,
+        validate_only: bool = False,
+        compression: str = None,
+    ):
         """
         Create a leaf artifact from given folder containing a manifest.json
+        Without tar extra arguments nor custom tar, the archive is reproducible and it is hashed while it is written
         """
         mffile = input_folder / LeafFiles.MANIFEST
         infofile = self.find_external_info_file(output_file)
@@ -89,6 +112,9 @@ class RelengManager(LoggerManager):
 
             self.logger.print_default("Found package {mf.identifier} in {folder}".format(mf=manifest, folder=input_folder))
 
+            if compression is not None and compression not in COMPRESSIONS:
+                raise LeafException("Unsupported compression: {compression}".format(compression=compression))
+
             # Check if external info file exists
             if not store_extenal_info and infofile.exists():
                 raise LeafException(
@@ -96,13 +122,23 @@ class RelengManager(LoggerManager):
                     hints="You should remove it with 'rm {file}'".format(file=infofile),
                 )
 
-            self.__exec_tar(output_file, input_folder, extra_args=tar_extra_args)
+            hashstr, final_size = None, None
+            if (tar_extra_args is None or len(tar_extra_args) == 0) and not LeafSettings.CUSTOM_TAR.is_set():
+                self.logger.print_verbose("Archive {folder} in {file}".format(folder=input_folder, file=output_file))
+                try:
+                    hashstr, _, final_size = create_tarfile(input_folder, output_file, compression=compression, first_members=(LeafFiles.MANIFEST,))
+                except BaseException as e:
+                    if output_file.exists():
+                        output_file.unlink()
+                    raise e
+            else:
+                self.__exec_tar(output_file, input_folder, extra_args=tar_extra_args, compression=compression)
 
             self.logger.print_default("Leaf package created: {file}".format(file=output_file))
 
             if store_extenal_info:
                 self.logger.print_default("Write info to {file}".format(file=infofile))
-                jwritefile(infofile, self.__build_pkg_node(output_file, manifest=manifest), pp=True)
+                jwritefile(infofile, build_artifact_node(output_file, manifest=manifest, hashstr=hashstr, final_size=final_size), pp=True)
 
     def generate_index(
         self,
@@ -114,15 +150,24 @@ class RelengManager(LoggerManager):
         use_extra_tags: bool = True,
         prettyprint: bool = False,
         resolve: bool = True,
+        incremental: bool = False,
+        max_workers: int = None,
     ):
         """
         Create an index.json referencing all given artifacts
+        Info of artifacts without info file are computed in parallel by *max_workers* processes, one per processor by default.
+        In incremental mode, the entries of the existing index are reused for artifacts which were not modified since it was generated.
         """
+        tags_file = self.__get_index_tags_file(index_file)
+        previous_nodes = self.__read_previous_index(index_file, tags_file) if incremental else {}
+        # Tags of the artifacts before the extra tags are added, to reuse their nodes in incremental mode
+        tags_map = OrderedDict()
         if not index_file.exists():
             index_file.touch()
         if resolve:
             index_file = index_file.resolve()
 
+        executor = None
         try:
             # Create the "info" node
             info_node = OrderedDict()
@@ -136,18 +181,36 @@ class RelengManager(LoggerManager):
             # Resolve artifacts if needed
             if resolve:
                 artifacts = [a.resolve() for a in artifacts]
+
+            # Get the info of the artifacts from their info file or from the previous index
+            artifact_nodes = []
             for artifact in artifacts:
                 artifact_node = None
-
                 if use_external_info:
                     infofile = self.find_external_info_file(artifact)
                     if infofile.exists():
                         self.logger.print_default("Reading info from {file}".format(file=infofile))
                         artifact_node = jloadfile(infofile)
-
+                if artifact_node is None and len(previous_nodes) > 0:
+                    artifact_node = self.__find_previous_node(previous_nodes, index_file, artifact)
+                    if artifact_node is not None:
+                        self.logger.print_default("Reuse info for {artifact}".format(artifact=artifact))
+                artifact_nodes.append(artifact_node)
+
+            # Compute the info of the other artifacts in parallel, hashing and reading manifests are CPU bound
+            missing = [artifact for artifact, artifact_node in zip(artifacts, artifact_nodes) if artifact_node is None]
+            if max_workers is None:
+                max_workers = os.cpu_count() or 1
+            if len(missing) > 1 and max_workers > 1:
+                executor = ProcessPoolExecutor(max_workers=min(max_workers, len(missing)))
+                computed_nodes = iter(executor.map(build_artifact_node, missing))
+            else:
+                computed_nodes = map(build_artifact_node, missing)
+
+            for artifact, artifact_node in zip(artifacts, artifact_nodes):
                 if artifact_node is None:
                     self.logger.print_default("Compute info for {artifact}".format(artifact=artifact))
-                    artifact_node = self.__build_pkg_node(artifact)
+                    artifact_node = next(computed_nodes)
 
                 ap = AvailablePackage(artifact_node)
                 pi = ap.identifier
@@ -161,6 +224,13 @@ class RelengManager(LoggerManager):
                     if ap.hashsum != AvailablePackage(packages_map[pi]).hashsum:
                         raise LeafException("Artifact {pi} has multiple different artifacts for same version".format(pi=pi))
                 else:
+                    try:
+                        relative_path = artifact.relative_to(index_file.parent)
+                    except ValueError:
+                        raise LeafException("Artifact {a} must be relative to {i.parent}".format(a=artifact, i=index_file))
+                    tags = artifact_node[JsonConstants.INFO].get(JsonConstants.INFO_TAGS)
+                    tags_map[str(relative_path)] = list(tags) if tags is not None else None
+
                     # Read extra tags
                     extratags_file = artifact.parent / (artifact.name + ".tags")
                     if use_extra_tags and extratags_file.exists():
@@ -171,12 +241,7 @@ class RelengManager(LoggerManager):
                                     ap.tags.append(tag)
 
                     self.logger.print_default("Add package {pi}".format(pi=pi))
-                    try:
-
-                        relative_path = artifact.relative_to(index_file.parent)
-                        artifact_node[JsonConstants.REMOTE_PACKAGE_FILE] = str(relative_path)
-                    except ValueError:
-                        raise LeafException("Artifact {a} must be relative to {i.parent}".format(a=artifact, i=index_file))
+                    artifact_node[JsonConstants.REMOTE_PACKAGE_FILE] = str(relative_path)
                     packages_map[pi] = artifact_node
 
             # Create the json structure
@@ -186,11 +251,69 @@ class RelengManager(LoggerManager):
 
             jwritefile(index_file, root_node, pp=prettyprint)
             self.logger.print_default("Index created: {index}".format(index=index_file))
+            self.__write_index_tags(tags_file, tags_map)
         except BaseException as e:
             # Clean the invalid index file
             if index_file.exists():
                 index_file.unlink()
             raise e
+        finally:
+            if executor is not None:
+                executor.shutdown(wait=True)
+
+    def __get_index_tags_file(self, index_file: Path) -> Path:
+        """
+        Return the file in the cache folder where the tags of the artifacts of the given index are stored
+        """
+        tags_name = hashlib.sha1(str(index_file.resolve()).encode()).hexdigest() + ".json"
+        return self.cache_folder / LeafFiles.CACHE_INDEX_TAGS_FOLDERNAME / tags_name
+
+    def __write_index_tags(self, tags_file: Path, tags_map: dict):
+        try:
+            tags_file.parent.mkdir(parents=True, exist_ok=True)
+            tmpfile = tags_file.parent / (tags_file.name + ".tmp")
+            jwritefile(tmpfile, tags_map)
+            tmpfile.replace(tags_file)
+        except OSError:
+            print_trace("Cannot write index tags file {file}".format(file=tags_file))
+
+    def __read_previous_index(self, index_file: Path, tags_file: Path) -> dict:
+        """
+        Return the artifact nodes of an existing index by file, with the index modification time and the tags of the artifacts.
+        Since the nodes contain the extra tags of the previous generation, only the artifacts with known tags are returned.
+        """
+        out = {}
+        if index_file.is_file() and index_file.stat().st_size > 0 and tags_file.is_file():
+            try:
+                mtime = index_file.stat().st_mtime
+                tags_map = jloadfile(tags_file)
+                for artifact_node in jloadfile(index_file).get(JsonConstants.REMOTE_PACKAGES, []):
+                    file = artifact_node[JsonConstants.REMOTE_PACKAGE_FILE]
+                    if file in tags_map:
+                        out[file] = (mtime, artifact_node, tags_map[file])
+            except (ValueError, KeyError, AttributeError):
+                self.logger.print_verbose("Cannot read previous index {file}".format(file=index_file))
+                out = {}
+        return out
+
+    def __find_previous_node(self, previous_nodes: dict, index_file: Path, artifact: Path) -> OrderedDict:
+        """
+        Return the node of the previous index if the artifact has the same path and size, and was not modified since the index was generated.
+        The extra tags of the previous generation are removed, the current ones are added again like for other nodes.
+        """
+        try:
+            mtime, artifact_node, tags = previous_nodes[str(artifact.relative_to(index_file.parent))]
+        except (ValueError, KeyError):
+            return None
+        stat = artifact.stat()
+        if stat.st_size != artifact_node.get(JsonConstants.REMOTE_PACKAGE_SIZE) or stat.st_mtime >= mtime:
+            return None
+        info_node = artifact_node[JsonConstants.INFO]
+        if tags is None:
+            info_node.pop(JsonConstants.INFO_TAGS, None)
+        else:
+            info_node[JsonConstants.INFO_TAGS] = tags
+        return artifact_node
 
     def generate_manifest(self, output_file: Path, fragment_files: list = None, info_map: dict = None, resolve_envvars: bool = False):
         """
@@ -262,7 +385,7 @@ class RelengManager(LoggerManager):
         with output_file.open("w") as fp:
             fp.write(jsonstr)
 
-    def __exec_tar(self, output: Path, workdir: Path, extra_args: list = None):
+    def __exec_tar(self, output: Path, workdir: Path, extra_args: list = None, compression: str = None):
         tar = "tar"
         if LeafSettings.CUSTOM_TAR.is_set():
             tar = LeafSettings.CUSTOM_TAR.value
@@ -274,9 +397,17 @@ class RelengManager(LoggerManager):
             forbidden_args = set(extra_args) & RelengManager.__TAR_FORBIDDEN_ARGS
             if len(forbidden_args) > 0:
                 raise LeafException("You should not use tar extra arguments: {invalid_args}".format(invalid_args=" ".join(forbidden_args)))
+            if compression is not None:
+                raise LeafException("Compression cannot be used with tar extra arguments", hints="Use tar compression options instead")
             command += extra_args
         else:
-            command.append(".")
+            if compression is not None:
+                command.append(RelengManager.__TAR_COMPRESSION_ARGS[compression])
+            # The manifest is the first member, so it can be read without reading the whole archive
+            # Members are prefixed to never be taken for options
+            command.append("--")
+            command.append("./" + LeafFiles.MANIFEST)
+            command += sorted("./" + item.name for item in workdir.iterdir() if item.name != LeafFiles.MANIFEST)
 
         command_text = " ".join(map(str, command))
         self.logger.print_default("Executing command: {cmd}".format(cmd=command_text))
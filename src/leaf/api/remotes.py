@@ -10,15 +10,19 @@ Leaf Package Manager
 import re
 from builtins import Exception
 from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
 from pathlib import Path
+from threading import Lock
 
 import gnupg
 
 from leaf.api.base import LoggerManager
 from leaf.core.constants import JsonConstants, LeafConstants, LeafFiles, LeafSettings
-from leaf.core.download import PRIORITIES_RANGE, download_file
+from leaf.core.download import PRIORITIES_RANGE, create_http_session, download_file, download_file_if_modified
 from leaf.core.error import LeafException, NoEnabledRemoteException, NoRemoteException, RemoteFetchException
-from leaf.core.jsonutils import jloadfile
+from leaf.core.logger import print_trace
+from leaf.core.jsonutils import jloadcache, jloadfile, jwritecache, jwritefile
 from leaf.model.modelutils import check_leaf_min_version
 from leaf.model.remote import Remote
 
@@ -65,9 +69,29 @@ class GPGManager(LoggerManager):
 class RemoteManager(GPGManager):
 
     __REMOTE_ALIAS_PATTERN = re.compile(r"[\S]+")
+    # Incremented each time remotes are modified or fetched in the current process
+    __REMOTES_GENERATION = 0
 
     def __init__(self):
         GPGManager.__init__(self)
+        self.__http_session = None
+        self.__gpg_lock = Lock()
+
+    @property
+    def http_session(self):
+        """
+        The http session shared by all remote index and artifact downloads, so connections are reused
+        """
+        if self.__http_session is None:
+            self.__http_session = create_http_session()
+        return self.__http_session
+
+    @http_session.setter
+    def http_session(self, session):
+        """
+        Replace the http session, for example to use custom transport adapters
+        """
+        self.__http_session = session
 
     @property
     def remote_cache_folder(self):
@@ -75,7 +99,31 @@ class RemoteManager(GPGManager):
         out.mkdir(parents=True, exist_ok=True)
         return out
 
+    @property
+    def remotes_generation(self) -> int:
+        """
+        Counter incremented each time remotes are modified or fetched in the current process, used to invalidate caches
+        """
+        return RemoteManager.__REMOTES_GENERATION
+
+    def __notify_remotes_changed(self):
+        RemoteManager.__REMOTES_GENERATION += 1
+
+    def get_remote_cache_identity(self, alias: str) -> tuple:
+        """
+        Return a tuple identifying the current cached content of the given remote, based on files stats
+        """
+        out = []
+        for f in self.__get_remote_files(alias)[:2]:
+            if f.exists():
+                st = f.stat()
+                out.append((st.st_mtime_ns, st.st_size, st.st_ino))
+            else:
+                out.append(None)
+        return tuple(out)
+
     def __clean_remote_files(self, alias: str):
+        self.__notify_remotes_changed()
         for f in self.__get_remote_files(alias):
             if f.exists():
                 f.unlink()
@@ -84,8 +132,22 @@ class RemoteManager(GPGManager):
         return (
             self.remote_cache_folder / "{alias}{ext}".format(alias=alias, ext=".json"),
             self.remote_cache_folder / "{alias}{ext}".format(alias=alias, ext=LeafConstants.GPG_SIG_EXTENSION),
+            self.remote_cache_folder / "{alias}{ext}".format(alias=alias, ext=".validators.json"),
+            self.remote_cache_folder / "{alias}{ext}".format(alias=alias, ext=".json.bin"),
         )
 
+    def __read_validators(self, remote: Remote):
+        """
+        Return the http validators (ETag, Last-Modified) of the cached index, if the cache is complete
+        """
+        rindex, rsig, rvalidators, _rbin = self.__get_remote_files(remote.alias)
+        if rindex.exists() and rvalidators.exists() and (remote.gpg_key is None or rsig.exists()):
+            try:
+                return jloadfile(rvalidators)
+            except ValueError:
+                pass
+        return None
+
     def list_remotes(self, only_enabled: bool = False):
         out = OrderedDict()
         remotes = self.read_user_configuration().remotes
@@ -97,18 +159,38 @@ class RemoteManager(GPGManager):
                 out[alias] = remote
                 if remote.enabled:
                     # Load content if remote is enabled cache exists and check signature is present if needed
-                    rindex, rsig = self.__get_remote_files(alias)
+                    # Content is loaded on first access
+                    rindex, rsig, _validators, _rbin = self.__get_remote_files(alias)
                     if rindex.exists() and (remote.gpg_key is None or rsig.exists()):
-                        try:
-                            remote.content = jloadfile(rindex)
-                        except Exception:
-                            self.logger.print_default("Invalid json file cache for remote {alias}".format(alias=alias))
-                            self.__clean_remote_files(alias)
+                        remote.set_content_loader(partial(self.__load_remote_index, alias))
         if len(out) == 0 and only_enabled:
             raise NoEnabledRemoteException()
 
         return out
 
+    def __load_remote_index(self, alias: str):
+        """
+        Load the cached index of a remote, using its binary copy if it is up to date
+        """
+        rindex, _sig, _validators, rbin = self.__get_remote_files(alias)
+        try:
+            out = jloadcache(rbin, rindex)
+            if out is None:
+                out = jloadfile(rindex)
+                self.__write_remote_index_cache(alias, out)
+            return out
+        except Exception:
+            self.logger.print_default("Invalid json file cache for remote {alias}".format(alias=alias))
+            self.__clean_remote_files(alias)
+        return None
+
+    def __write_remote_index_cache(self, alias: str, content: dict):
+        rindex, _sig, _validators, rbin = self.__get_remote_files(alias)
+        try:
+            jwritecache(rbin, content, rindex)
+        except OSError:
+            print_trace("Cannot write binary cache for remote {alias}".format(alias=alias))
+
     def create_remote(self, alias: str, url: str, enabled: bool = True, insecure: bool = False, gpgkey: str = None, priority: int = None):
         # Do some checks
         if not RemoteManager.__REMOTE_ALIAS_PATTERN.fullmatch(alias):
@@ -164,43 +246,74 @@ class RemoteManager(GPGManager):
         self.__clean_remote_files(alias)
 
     def __fetch_remote(self, remote: Remote):
-        # clean files if they exist
-        self.__clean_remote_files(remote.alias)
+        """
+        Download and verify the index of the given remote, this method is called from worker threads
+        """
         # Target files
-        index, sig = self.__get_remote_files(remote.alias)
-        try:
-            # Download index
-            self.logger.print_default("Fetching remote {remote.alias}".format(remote=remote))
-            download_file(remote.url, index)
+        index, sig, validators_file, _bin = self.__get_remote_files(remote.alias)
+        # Download index, unless it has not been modified since last fetch
+        validators = download_file_if_modified(remote.url, index, validators=self.__read_validators(remote), session=self.http_session)
+        if validators is None:
+            # Content (and its signature) has already been verified, update the mtime for smart refresh
+            self.logger.print_verbose("Remote {remote.alias} has not been modified".format(remote=remote))
+            content = self.__load_remote_index(remote.alias)
+            if content is None:
+                raise LeafException("Invalid cache for remote {remote.alias}".format(remote=remote))
+            index.touch()
+            self.__write_remote_index_cache(remote.alias, content)
+        else:
+            if validators_file.exists():
+                validators_file.unlink()
             # If gpg enabled
             gpgkey = remote.gpg_key
             if gpgkey is not None:
-                download_file(remote.url + LeafConstants.GPG_SIG_EXTENSION, sig)
-                self.logger.print_default("Verifying signature for remote {0.alias}".format(remote))
-                self.gpg_import_keys(gpgkey)
-                self.gpg_verify_file(index, sig, expected_key=gpgkey)
-            remote.content = jloadfile(index)
-            self.__check_remote_content(remote)
-        except Exception as e:
-            self.__clean_remote_files(remote.alias)
-            self.print_exception(RemoteFetchException(remote, e))
+                download_file(remote.url + LeafConstants.GPG_SIG_EXTENSION, sig, session=self.http_session)
+                # GPG keyring cannot be used concurrently
+                with self.__gpg_lock:
+                    self.logger.print_default("Verifying signature for remote {0.alias}".format(remote))
+                    self.gpg_import_keys(gpgkey)
+                    self.gpg_verify_file(index, sig, expected_key=gpgkey)
+            if len(validators) > 0:
+                jwritefile(validators_file, validators)
+            content = jloadfile(index)
+            self.__write_remote_index_cache(remote.alias, content)
+        remote.content = content
 
     def fetch_remotes(self, force_refresh: bool = False):
         """
         Refresh remotes content with smart refresh, ie auto refresh after X days
+        Remotes are fetched concurrently, see leaf.download.parallel setting
         """
         remotes = self.list_remotes(only_enabled=True)
         if len(remotes) == 0:
             raise NoRemoteException()
+        remotes_to_fetch = []
         for alias, remote in remotes.items():
-            rindex, _sig = self.__get_remote_files(alias)
+            rindex, _sig, _validators, _bin = self.__get_remote_files(alias)
             if not force_refresh and rindex.exists():
                 if self.is_file_outdated(rindex):
                     self.logger.print_verbose("Cache for remote {0} is outdated".format(alias))
                 else:
                     # Smart refresh skip refresh for current remote
                     continue
-            self.__fetch_remote(remote)
+            remotes_to_fetch.append(remote)
+
+        if len(remotes_to_fetch) > 0:
+            # Results are processed in priority order
+            remotes_to_fetch = sorted(remotes_to_fetch, key=lambda r: r.priority)
+            with ThreadPoolExecutor(max_workers=max(1, min(len(remotes_to_fetch), LeafSettings.DOWNLOAD_PARALLEL.as_int()))) as executor:
+                futures = []
+                for remote in remotes_to_fetch:
+                    self.logger.print_default("Fetching remote {remote.alias}".format(remote=remote))
+                    futures.append(executor.submit(self.__fetch_remote, remote))
+                for remote, future in zip(remotes_to_fetch, futures):
+                    try:
+                        future.result()
+                        self.__check_remote_content(remote)
+                    except Exception as e:
+                        self.__clean_remote_files(remote.alias)
+                        self.print_exception(RemoteFetchException(remote, e))
+            self.__notify_remotes_changed()
 
     def __check_remote_content(self, remote: Remote):
         # Check leaf min version for all packages
@@ -6,6 +6,7 @@ Leaf Package Manager
 @contact:   Legato Tooling Team <letools@sierrawireless.com>
 @license:   https://www.mozilla.org/en-US/MPL/2.0/
 """
+import hashlib
 import os
 import shutil
 from builtins import Exception, property
@@ -13,8 +14,9 @@ from collections import OrderedDict
 from pathlib import Path
 
 from leaf.api.packages import PackageManager
-from leaf.core.constants import LeafFiles, LeafSettings
+from leaf.core.constants import JsonConstants, LeafFiles, LeafSettings
 from leaf.core.error import (
+    InvalidPackageNameException,
     InvalidProfileNameException,
     LeafException,
     NoProfileSelected,
@@ -23,11 +25,13 @@ from leaf.core.error import (
     ProfileProvisioningException,
     WorkspaceNotInitializedException,
 )
+from leaf.core.jsonutils import jloadfile, jwritefile
 from leaf.core.logger import print_trace
 from leaf.model.base import Scope
 from leaf.model.config import ConfigContextManager, WorkspaceConfiguration
 from leaf.model.dependencies import DependencyUtils
 from leaf.model.environment import Environment
+from leaf.model.package import PackageIdentifier
 from leaf.model.settings import ScopeSetting
 from leaf.model.workspace import Profile
 
@@ -38,6 +42,9 @@ class WorkspaceManager(PackageManager):
     Represent a workspace, where leaf profiles apply
     """
 
+    # Number of resolutions kept in cache for each profile
+    __DEPENDENCIES_CACHE_SIZE = 8
+
     @staticmethod
     def is_workspace_root(folder):
         return folder is not None and (folder / LeafFiles.WS_CONFIG_FILENAME).is_file()
@@ -306,11 +313,69 @@ class WorkspaceManager(PackageManager):
     def build_pf_environment(self, profile: Profile):
         return Environment.build(self.build_builtin_environment(), self.build_user_environment(), self.build_ws_environment(), profile.build_environment())
 
+    def __get_dependencies_cache_file(self, profile: Profile) -> Path:
+        name = hashlib.sha1("{ws}:{pf.name}".format(ws=self.ws_root_folder.absolute(), pf=profile).encode()).hexdigest()
+        return self.cache_folder / LeafFiles.CACHE_PROFILES_FOLDERNAME / (name + ".json")
+
     def get_profile_dependencies(self, profile, ipmap=None):
         """
         Returns all latest packages needed by a profile
+        The resolution is cached, it is reused as long as the profile packages, the installed packages (and their manifests)
+        and the values of the variables used by the conditional dependencies are the same
         """
-        return DependencyUtils.installed(profile.packages, ipmap or self.list_installed_packages(), only_keep_latest=True, env=self.build_pf_environment(profile))
+        ipmap = ipmap or self.list_installed_packages()
+        env = self.build_pf_environment(profile)
+
+        hasher = hashlib.sha1()
+        for pi in profile.packages:
+            hasher.update("{pi}\n".format(pi=pi).encode())
+        hasher.update(b"\0")
+        for pi, ip in ipmap.items():
+            # A manifest can be modified in place, for example when a package is reinstalled in the same folder
+            try:
+                st = (ip.folder / LeafFiles.MANIFEST).stat()
+                mfstat = "{st.st_size} {st.st_mtime_ns}".format(st=st)
+            except OSError:
+                mfstat = ""
+            hasher.update("{pi} {ip.folder} {mfstat}\n".format(pi=pi, ip=ip, mfstat=mfstat).encode())
+        key = hasher.hexdigest()
+
+        cache_file = self.__get_dependencies_cache_file(profile)
+        entries = OrderedDict()
+        if cache_file.exists():
+            try:
+                entries = jloadfile(cache_file)
+            except ValueError:
+                print_trace("Invalid dependencies cache {file}".format(file=cache_file))
+        values = env.snapshot()
+        entry = entries.get(key)
+        if entry is not None and all(values.get(k) == v for k, v in entry[JsonConstants.CACHE_VARIABLES].items()):
+            try:
+                return [ipmap[PackageIdentifier.parse(pis)] for pis in entry[JsonConstants.CACHE_DEPENDENCIES]]
+            except (KeyError, InvalidPackageNameException):
+                print_trace("Invalid dependencies cache {file}".format(file=cache_file))
+
+        used_variables = set()
+        out = DependencyUtils.installed(profile.packages, ipmap, only_keep_latest=True, env=env, used_variables=used_variables)
+
+        # Most recently used last
+        entries.pop(key, None)
+        entries[key] = OrderedDict(
+            (
+                (JsonConstants.CACHE_VARIABLES, OrderedDict((k, values.get(k)) for k in sorted(used_variables))),
+                (JsonConstants.CACHE_DEPENDENCIES, [str(ip.identifier) for ip in out]),
+            )
+        )
+        while len(entries) > WorkspaceManager.__DEPENDENCIES_CACHE_SIZE:
+            del entries[next(iter(entries))]
+        try:
+            cache_file.parent.mkdir(parents=True, exist_ok=True)
+            tmpfile = cache_file.parent / (cache_file.name + ".tmp")
+            jwritefile(tmpfile, entries)
+            tmpfile.replace(cache_file)
+        except OSError:
+            print_trace("Cannot write dependencies cache {file}".format(file=cache_file))
+        return out
 
     def get_settings_value(self, *settings_id: str) -> dict:
         out = OrderedDict()
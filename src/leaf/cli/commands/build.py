@@ -14,6 +14,7 @@ from pathlib import Path
 from leaf.api import RelengManager
 from leaf.cli.base import LeafCommand
 from leaf.cli.cliutils import string_to_bool
+from leaf.core.archive import COMPRESSIONS
 from leaf.core.constants import JsonConstants, LeafFiles
 from leaf.core.error import LeafException
 
@@ -24,6 +25,7 @@ class BuildPackSubCommand(LeafCommand):
 
     def _get_examples(self):
         return [
+            ("leaf build pack -i path/to/packageFolder/ -o package.leaf --compression xz", "Build a reproducible XZ compressed archive"),
             ("leaf build pack -i path/to/packageFolder/ -o package.leaf -- -z .", "Build an GZIP compressed archive"),
             (
                 "leaf build pack -i path/to/packageFolder/ -o package.leaf -- -v -J -X /tmp/exclude.list .",
@@ -39,6 +41,7 @@ class BuildPackSubCommand(LeafCommand):
         out = "notes: \n"
         out += "  - extra tar options must begin with a '--'\n"
         out += "  - if you specify extra tar options, you must specify the content to include (usually, end your command with a '.')\n"
+        out += "  - without extra tar options, files are sorted and their owner and date are reset (to $SOURCE_DATE_EPOCH if set) so the archive is reproducible\n"
         out += "\n" + super()._get_epilog_text()
         return out
 
@@ -48,6 +51,7 @@ class BuildPackSubCommand(LeafCommand):
         parser.add_argument("-i", "--input", metavar="FOLDER", type=Path, dest="input_folder", help="package folder")
         parser.add_argument("--no-info", action="store_false", dest="syore_external_info", help="do not store artifact info in a separate file")
         parser.add_argument("--validate-only", action="store_true", dest="validate_only", help="only validate manifest.json model, do not create the package")
+        parser.add_argument("--compression", choices=sorted(COMPRESSIONS), dest="compression", help="compress the archive")
         parser.add_argument("tar_extra_args", metavar="TAR_ARGS", nargs="*", help="extra arguments given to tar command line\n(must start with '--')")
 
     def execute(self, args, uargs):
@@ -65,7 +69,12 @@ class BuildPackSubCommand(LeafCommand):
             raise ValueError("Invalid input folder")
 
         rm.create_package(
-            pkg_folder, args.output_file, store_extenal_info=args.syore_external_info, tar_extra_args=args.tar_extra_args, validate_only=args.validate_only
+            pkg_folder,
+            args.output_file,
+            store_extenal_info=args.syore_external_info,
+            tar_extra_args=args.tar_extra_args,
+            validate_only=args.validate_only,
+            compression=args.compression,
         )
 
 
@@ -84,6 +93,9 @@ class BuildIndexSubCommand(LeafCommand):
         )
         parser.add_argument("--no-extra-tags", action="store_false", dest="use_extra_tags", help='do not use extra tags in "*.tags" files')
         parser.add_argument("--prettyprint", action="store_true", dest="prettyprint", help="pretty print json")
+        parser.add_argument(
+            "--incremental", action="store_true", dest="incremental", help="reuse the entries of the existing index for artifacts not modified since"
+        )
         parser.add_argument(
             "--resolve", action="store_true", dest="resolve", help="Resolves artifacts path to ensure they are relative to index (NB: symlinks are resolved)"
         )
@@ -108,6 +120,7 @@ class BuildIndexSubCommand(LeafCommand):
             use_extra_tags=args.use_extra_tags,
             prettyprint=args.prettyprint,
             resolve=args.resolve,
+            incremental=args.incremental,
         )
 
 
@@ -0,0 +1,75 @@
+"""
+Leaf Package Manager
+
+@author:    Legato Tooling Team <letools@sierrawireless.com>
+@copyright: Sierra Wireless. All rights reserved.
+@contact:   Legato Tooling Team <letools@sierrawireless.com>
+@license:   https://www.mozilla.org/en-US/MPL/2.0/
+"""
+
+from datetime import datetime
+
+from leaf.api import PackageManager
+from leaf.cli.base import LeafCommand
+from leaf.rendering.formatutils import sizeof_fmt
+
+
+class CacheShowCommand(LeafCommand):
+    def __init__(self):
+        LeafCommand.__init__(self, "show", "display the download cache usage")
+
+    def execute(self, args, uargs):
+        pm = PackageManager()
+        cache = pm.download_cache
+
+        entries = cache.entries
+        pm.logger.print_quiet("Cache folder: {folder}".format(folder=cache.folder))
+        pm.logger.print_quiet(
+            "{count} file(s), {size} used of {max}".format(count=len(entries), size=sizeof_fmt(cache.total_size), max=sizeof_fmt(pm.download_cache_max_size))
+        )
+        untracked = cache.find_untracked_files()
+        if len(untracked) > 0:
+            pm.logger.print_default("{count} untracked file(s)".format(count=len(untracked)))
+        # Most recently used first
+        for entry in reversed(entries):
+            pm.logger.print_verbose(
+                "  {e.key:.12} {size:>10} {date} {e.remote} {e.filename}".format(
+                    e=entry, size=sizeof_fmt(entry.size), date=datetime.fromtimestamp(entry.last_access).strftime("%Y-%m-%d %H:%M")
+                )
+            )
+
+
+class CachePruneCommand(LeafCommand):
+    def __init__(self):
+        LeafCommand.__init__(self, "prune", "remove the least recently used files from the download cache")
+
+    def _get_examples(self):
+        return [
+            ("leaf cache prune", "Reduce the cache to the size configured by leaf.cache.size.max"),
+            ("leaf cache prune --size 0 --untracked", "Remove all files from the cache"),
+        ]
+
+    def _configure_parser(self, parser):
+        super()._configure_parser(parser)
+        parser.add_argument("--size", dest="max_size", type=int, metavar="MB", help="the maximum size of the cache (default to leaf.cache.size.max setting)")
+        parser.add_argument("--untracked", dest="untracked", action="store_true", help="also remove the files not tracked by the cache index")
+
+    def execute(self, args, uargs):
+        pm = PackageManager()
+        max_size = args.max_size * 1024 * 1024 if args.max_size is not None else None
+        removed = pm.prune_download_cache(max_size=max_size, untracked=args.untracked)
+        for item in removed:
+            pm.logger.print_verbose("Removed {file}".format(file=item))
+        pm.logger.print_default("{count} file(s) removed, cache size is {size}".format(count=len(removed), size=sizeof_fmt(pm.download_cache.total_size)))
+
+
+class CacheVerifyCommand(LeafCommand):
+    def __init__(self):
+        LeafCommand.__init__(self, "verify", "check the integrity of the files in the download cache")
+
+    def execute(self, args, uargs):
+        pm = PackageManager()
+        removed = pm.verify_download_cache()
+        for entry in removed:
+            pm.logger.print_error("Corrupted file removed: {e.path} ({e.filename})".format(e=entry))
+        pm.logger.print_default("{count} corrupted file(s) removed".format(count=len(removed)))
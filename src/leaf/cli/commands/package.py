@@ -23,7 +23,7 @@ from leaf.core.utils import env_list_to_map
 from leaf.model.dependencies import DependencyUtils
 from leaf.model.environment import Environment
 from leaf.model.filtering import MetaPackageFilter
-from leaf.model.package import IDENTIFIER_GETTER, LeafArtifact, PackageIdentifier
+from leaf.model.package import IDENTIFIER_GETTER, PackageIdentifier
 from leaf.rendering.renderer.manifest import ManifestListRenderer
 
 
@@ -248,12 +248,13 @@ class PackageInspectCommand(LeafCommand):
                 return tostring(list(map(lambda kv: "{0}={1}".format(kv[0], kv[1]), item.items())))
             return str(item)
 
+        pm = PackageManager()
         for index in range(0, len(args.files)):
             if index > 0:
                 print("")
             file = args.files[index]
             try:
-                la = LeafArtifact(file)
+                la = pm.open_artifact(file)
                 if args.format is None:
                     print(file)
                     kvfmt = "  {k}: {v}"
@@ -0,0 +1,147 @@
+"""
+Leaf Package Manager
+
+@author:    Legato Tooling Team <letools@sierrawireless.com>
+@copyright: Sierra Wireless. All rights reserved.
+@contact:   Legato Tooling Team <letools@sierrawireless.com>
+@license:   https://www.mozilla.org/en-US/MPL/2.0/
+"""
+
+import bz2
+import lzma
+import os
+import zlib
+from pathlib import Path
+from queue import Queue
+from tarfile import GNU_FORMAT, TarFile
+from threading import Thread
+
+from leaf.core.constants import CommonSettings
+from leaf.core.utils import hash_create, hash_tostring
+
+# Supported compressions, the gzip header does not contain any file name nor date
+COMPRESSIONS = {
+    "gz": lambda: zlib.compressobj(9, zlib.DEFLATED, 16 + zlib.MAX_WBITS),
+    "bz2": lambda: bz2.BZ2Compressor(9),
+    "xz": lambda: lzma.LZMACompressor(format=lzma.FORMAT_XZ, check=lzma.CHECK_CRC64),
+}
+_BLOCKSIZE = 1024 * 1024
+_QUEUE_SIZE = 16
+
+
+class _ArchiveWriter:
+
+    """
+    File object given to the tar file.
+    Data is compressed, hashed and written by a separate thread, so files are read while the previous ones are compressed.
+    """
+
+    def __init__(self, fp, compressor=None):
+        self.__fp = fp
+        self.__compressor = compressor
+        self.__hasher = hash_create()
+        self.__size = 0
+        self.__buffer = bytearray()
+        self.__queue = Queue(maxsize=_QUEUE_SIZE)
+        self.__errors = []
+        self.__thread = Thread(target=self.__run, daemon=True)
+        self.__thread.start()
+
+    @property
+    def hashstr(self):
+        return hash_tostring(self.__hasher)
+
+    @property
+    def size(self):
+        return self.__size
+
+    def write(self, data):
+        if len(self.__errors) > 0:
+            raise self.__errors[0]
+        self.__buffer += data
+        if len(self.__buffer) >= _BLOCKSIZE:
+            self.__queue.put(bytes(self.__buffer))
+            self.__buffer = bytearray()
+        return len(data)
+
+    def __output(self, data):
+        if len(data) > 0:
+            self.__fp.write(data)
+            self.__hasher.update(data)
+            self.__size += len(data)
+
+    def __run(self):
+        try:
+            while True:
+                data = self.__queue.get()
+                if data is None:
+                    break
+                self.__output(self.__compressor.compress(data) if self.__compressor is not None else data)
+            if self.__compressor is not None:
+                self.__output(self.__compressor.flush())
+        except BaseException as e:
+            self.__errors.append(e)
+            # Consume the queue so the tar writer is never blocked
+            while self.__queue.get() is not None:
+                pass
+
+    def close(self):
+        if len(self.__buffer) > 0:
+            self.__queue.put(bytes(self.__buffer))
+            self.__buffer = bytearray()
+        self.__queue.put(None)
+        self.__thread.join()
+        if len(self.__errors) > 0:
+            raise self.__errors[0]
+
+
+def _list_members(folder: Path, first_members: tuple, excluded_stat: os.stat_result) -> list:
+    """
+    List the relative paths of the folder content, the given top level members first, then sorted by path
+    The excluded file is the archive itself, when it is created in the folder
+    """
+    out = []
+    for root, dirs, files in os.walk(str(folder)):
+        for name in dirs:
+            out.append(Path(root, name).relative_to(folder))
+        for name in files:
+            path = Path(root, name)
+            if not os.path.samestat(os.lstat(str(path)), excluded_stat):
+                out.append(path.relative_to(folder))
+    return sorted(out, key=lambda p: (p.parts[0] not in first_members, p.parts))
+
+
+def create_tarfile(folder: Path, output: Path, compression: str = None, first_members: tuple = (), mtime: int = None) -> tuple:
+    """
+    Create a reproducible tar file with the content of the folder: members are sorted, their owner and modification date are normalized.
+    The date is *mtime* if given, else SOURCE_DATE_EPOCH or 0.
+    @return: the hash and the size of the archive, and the total size of the archived files
+    """
+    if compression is not None and compression not in COMPRESSIONS:
+        raise ValueError("Unsupported compression: {compression}".format(compression=compression))
+    if mtime is None:
+        mtime = CommonSettings.SOURCE_DATE_EPOCH.as_int(default=0)
+
+    files_size = 0
+    with output.open("wb") as fp:
+        writer = _ArchiveWriter(fp, compressor=COMPRESSIONS[compression]() if compression is not None else None)
+        try:
+            with TarFile.open(fileobj=writer, mode="w|", format=GNU_FORMAT) as tf:
+                for member in _list_members(folder, first_members, os.fstat(fp.fileno())):
+                    file = folder / member
+                    ti = tf.gettarinfo(str(file), arcname=member.as_posix())
+                    if ti is None:
+                        # Sockets cannot be archived
+                        continue
+                    ti.uid = ti.gid = 0
+                    ti.uname = ti.gname = ""
+                    ti.mtime = mtime
+                    if ti.isreg():
+                        with file.open("rb") as mfp:
+                            tf.addfile(ti, mfp)
+                        files_size += ti.size
+                    else:
+                        tf.addfile(ti)
+        finally:
+            writer.close()
+    return writer.hashstr, writer.size, files_size
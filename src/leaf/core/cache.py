@@ -0,0 +1,393 @@
+"""
+Leaf Package Manager
+
+@author:    Legato Tooling Team <letools@sierrawireless.com>
+@copyright: Sierra Wireless. All rights reserved.
+@contact:   Legato Tooling Team <letools@sierrawireless.com>
+@license:   https://www.mozilla.org/en-US/MPL/2.0/
+"""
+
+import os
+import re
+import time
+from collections import OrderedDict
+from pathlib import Path
+
+from leaf.core.constants import JsonConstants, LeafFiles
+from leaf.core.jsonutils import jloadfile, jwritefile
+from leaf.core.logger import print_trace
+from leaf.core.utils import hash_check, hash_parse, is_folder_ignored
+
+_HASH_FILENAME_PATTERN = re.compile("^[0-9a-f]{96}$")
+
+
+class CacheEntry:
+
+    """
+    A file stored in the download cache
+    """
+
+    def __init__(self, cache, key: str, json: dict):
+        self.__cache = cache
+        self.key = key
+        self.json = json
+
+    @property
+    def path(self) -> Path:
+        return self.__cache.folder / self.key
+
+    @property
+    def hashsum(self) -> str:
+        return "sha384:" + self.key
+
+    @property
+    def size(self) -> int:
+        return self.json.get(DownloadCache.KEY_SIZE, 0)
+
+    @property
+    def last_access(self) -> float:
+        return self.json.get(DownloadCache.KEY_LASTACCESS, 0)
+
+    @property
+    def remote(self) -> str:
+        return self.json.get(DownloadCache.KEY_REMOTE)
+
+    @property
+    def filename(self) -> str:
+        return self.json.get(DownloadCache.KEY_FILENAME)
+
+
+class DownloadCache:
+
+    """
+    Content-addressed store for downloaded artifacts.
+    Files are named after their sha384 and an index keeps their size, last access and origin,
+    so the least recently used files can be evicted when the cache exceeds its budget.
+    Files downloaded without hash are not tracked by the index.
+    A tiny ledger keeps the total size of the cache, so it can be checked without loading the index.
+    """
+
+    INDEX_FILENAME = "index.json"
+    LEDGER_FILENAME = "ledger.json"
+    KEY_FILES = "files"
+    KEY_SIZE = "size"
+    KEY_LASTACCESS = "lastAccess"
+    KEY_REMOTE = "remote"
+    KEY_FILENAME = "filename"
+    KEY_COUNT = "count"
+    KEY_LASTCHECK = "lastCheck"
+    __METADATA_FILENAMES = (INDEX_FILENAME, LEDGER_FILENAME)
+
+    def __init__(self, folder: Path):
+        self.__folder = folder
+        self.__entries = None
+        self.__dirty = False
+
+    @property
+    def folder(self) -> Path:
+        self.__folder.mkdir(parents=True, exist_ok=True)
+        return self.__folder
+
+    @property
+    def index_file(self) -> Path:
+        return self.__folder / DownloadCache.INDEX_FILENAME
+
+    @property
+    def ledger_file(self) -> Path:
+        return self.__folder / DownloadCache.LEDGER_FILENAME
+
+    def __read_ledger(self) -> dict:
+        if self.ledger_file.exists():
+            try:
+                return jloadfile(self.ledger_file)
+            except ValueError:
+                print_trace("Invalid cache ledger {file}".format(file=self.ledger_file))
+        return None
+
+    def __write_ledger(self, last_check: float = None):
+        ledger = self.__read_ledger() or {}
+        if last_check is None:
+            last_check = ledger.get(DownloadCache.KEY_LASTCHECK, 0)
+        if self.__entries is None and isinstance(ledger.get(DownloadCache.KEY_SIZE), int):
+            # Ledger is up to date, no need to load the index
+            size, count = ledger[DownloadCache.KEY_SIZE], ledger.get(DownloadCache.KEY_COUNT, 0)
+        else:
+            entries = self.__load()
+            size, count = sum(e.size for e in entries.values()), len(entries)
+        self.__write_json(
+            self.ledger_file,
+            OrderedDict(((DownloadCache.KEY_SIZE, size), (DownloadCache.KEY_COUNT, count), (DownloadCache.KEY_LASTCHECK, last_check))),
+        )
+
+    def __write_json(self, file: Path, data: dict):
+        tmpfile = self.folder / (file.name + ".tmp")
+        jwritefile(tmpfile, data)
+        tmpfile.replace(file)
+
+    def get_path(self, hashstr: str) -> Path:
+        """
+        Return the path of the file with the given hash in the cache, the file may not exist
+        """
+        return self.folder / hash_parse(hashstr)[1]
+
+    def __load(self):
+        if self.__entries is None:
+            self.__entries = OrderedDict()
+            if self.index_file.exists():
+                try:
+                    for key, json in jloadfile(self.index_file).get(DownloadCache.KEY_FILES, {}).items():
+                        self.__entries[key] = CacheEntry(self, key, json)
+                except ValueError:
+                    print_trace("Invalid cache index {file}".format(file=self.index_file))
+                    self.__dirty = True
+            # Forget files removed outside leaf
+            for key in [key for key, entry in self.__entries.items() if not entry.path.exists()]:
+                del self.__entries[key]
+                self.__dirty = True
+            # Index files added outside leaf, or if the index is lost
+            # Only complete files are named after their hash, partial downloads have a suffix
+            for item in self.folder.iterdir():
+                if item.name not in self.__entries and _HASH_FILENAME_PATTERN.match(item.name) and item.is_file():
+                    st = item.stat()
+                    self.__entries[item.name] = CacheEntry(
+                        self, item.name, {DownloadCache.KEY_SIZE: st.st_size, DownloadCache.KEY_LASTACCESS: st.st_mtime}
+                    )
+                    self.__dirty = True
+        return self.__entries
+
+    @property
+    def entries(self) -> list:
+        """
+        Return the entries sorted by last access, least recently used first
+        """
+        return sorted(self.__load().values(), key=lambda e: e.last_access)
+
+    @property
+    def total_size(self) -> int:
+        """
+        Return the size of the cache, from the ledger if the index has not been loaded
+        """
+        if self.__entries is None:
+            ledger = self.__read_ledger()
+            if ledger is not None and isinstance(ledger.get(DownloadCache.KEY_SIZE), int):
+                return ledger[DownloadCache.KEY_SIZE]
+        return sum(e.size for e in self.__load().values())
+
+    @property
+    def last_check(self) -> float:
+        """
+        Return the timestamp of the last cache size check, 0 if it has never been checked
+        """
+        ledger = self.__read_ledger()
+        return ledger.get(DownloadCache.KEY_LASTCHECK, 0) if ledger is not None else 0
+
+    def set_checked(self):
+        """
+        Record that the cache size has just been checked
+        """
+        self.__write_ledger(last_check=time.time())
+
+    def find_untracked_files(self) -> list:
+        """
+        Files in the cache folder which are not indexed, like the ones downloaded without hash
+        """
+        entries = self.__load()
+        return sorted(item for item in self.folder.iterdir() if item.name not in entries and item.name not in DownloadCache.__METADATA_FILENAMES)
+
+    def record(self, hashstr: str, remote: str = None, filename: str = None):
+        """
+        Record an access to the file with the given hash, which must exist in the cache
+        """
+        path = self.get_path(hashstr)
+        entry = self.__load().get(path.name)
+        if entry is None:
+            entry = CacheEntry(self, path.name, {})
+            self.__entries[path.name] = entry
+        entry.json[DownloadCache.KEY_SIZE] = path.stat().st_size
+        entry.json[DownloadCache.KEY_LASTACCESS] = time.time()
+        if remote is not None:
+            entry.json[DownloadCache.KEY_REMOTE] = remote
+        if filename is not None:
+            entry.json[DownloadCache.KEY_FILENAME] = filename
+        self.__dirty = True
+        return entry
+
+    def remove(self, entry: CacheEntry):
+        if entry.path.exists():
+            os.remove(str(entry.path))
+        if self.__load().pop(entry.key, None) is not None:
+            self.__dirty = True
+
+    def prune(self, max_size: int = 0, keep_untracked: bool = True) -> list:
+        """
+        Evict the least recently used files until the cache size is below max_size
+        @return: the removed files
+        """
+        out = []
+        if not keep_untracked:
+            for item in self.find_untracked_files():
+                if item.is_file():
+                    os.remove(str(item))
+                    out.append(item)
+        entries = self.entries
+        total_size = self.total_size
+        for entry in entries:
+            if total_size <= max_size:
+                break
+            self.remove(entry)
+            total_size -= entry.size
+            out.append(entry.path)
+        self.save()
+        return out
+
+    def verify(self) -> list:
+        """
+        Check the hash of all files in the cache, corrupted files are removed
+        @return: the removed entries
+        """
+        out = []
+        for entry in self.entries:
+            if not hash_check(entry.path, entry.hashsum, raise_exception=False):
+                self.remove(entry)
+                out.append(entry)
+        self.save()
+        return out
+
+    def save(self):
+        if self.__dirty and self.__entries is not None:
+            self.__write_json(self.index_file, {DownloadCache.KEY_FILES: OrderedDict((key, e.json) for key, e in self.__entries.items())})
+            self.__write_ledger()
+            self.__dirty = False
+
+
+class InstalledPackagesIndex:
+
+    """
+    Persisted index of the packages installed in a root folder: package folder name -> identifier.
+    The index is trusted as long as the root folder mtime is unchanged, so listing installed packages does not
+    need to scan all folders and parse all manifests.
+    Folders without manifest (being extracted) are kept aside and checked each time.
+    """
+
+    KEY_ROOT = "root"
+    KEY_MTIME = "mtime"
+    KEY_PACKAGES = "packages"
+    KEY_PENDING = "pending"
+    # Do not trust a root folder modified less than 1s before the scan, the filesystem mtime precision may be too coarse
+    __RACY_DELAY = 1
+
+    def __init__(self, index_file: Path, root_folder: Path):
+        self.__index_file = index_file
+        self.__root_folder = root_folder
+
+    @property
+    def index_file(self) -> Path:
+        return self.__index_file
+
+    @property
+    def root_folder(self) -> Path:
+        return self.__root_folder
+
+    def __get_root_mtime(self) -> int:
+        return self.__root_folder.stat().st_mtime_ns
+
+    def __read(self) -> dict:
+        if self.__index_file.exists():
+            try:
+                data = jloadfile(self.__index_file)
+                if data.get(InstalledPackagesIndex.KEY_ROOT) == str(self.__root_folder):
+                    return data
+            except ValueError:
+                print_trace("Invalid installed packages index {file}".format(file=self.__index_file))
+        return None
+
+    def __is_valid(self, data: dict) -> bool:
+        if data is None or data.get(InstalledPackagesIndex.KEY_MTIME) != self.__get_root_mtime():
+            return False
+        for name in data.get(InstalledPackagesIndex.KEY_PENDING, []):
+            if (self.__root_folder / name / LeafFiles.MANIFEST).is_file():
+                return False
+        return True
+
+    def __scan(self) -> dict:
+        # Get the mtime before scanning, so any modification during the scan invalidates the index
+        mtime = self.__get_root_mtime()
+        packages = OrderedDict()
+        pending = []
+        for folder in self.__root_folder.iterdir():
+            # iterate over non ignored sub folders
+            if folder.is_dir() and not is_folder_ignored(folder):
+                # test if a manifest exists
+                mffile = folder / LeafFiles.MANIFEST
+                if mffile.is_file():
+                    try:
+                        info = jloadfile(mffile)[JsonConstants.INFO]
+                        packages[folder.name] = "{name}_{version}".format(
+                            name=info[JsonConstants.INFO_NAME], version=info[JsonConstants.INFO_VERSION]
+                        )
+                    except BaseException:
+                        print_trace("Invalid manifest found: {mf}".format(mf=mffile))
+                else:
+                    pending.append(folder.name)
+        if time.time() - mtime / 1e9 < InstalledPackagesIndex.__RACY_DELAY:
+            mtime = None
+        return OrderedDict(
+            (
+                (InstalledPackagesIndex.KEY_ROOT, str(self.__root_folder)),
+                (InstalledPackagesIndex.KEY_MTIME, mtime),
+                (InstalledPackagesIndex.KEY_PACKAGES, packages),
+                (InstalledPackagesIndex.KEY_PENDING, sorted(pending)),
+            )
+        )
+
+    def __write(self, data: dict):
+        try:
+            self.__index_file.parent.mkdir(parents=True, exist_ok=True)
+            tmpfile = self.__index_file.parent / (self.__index_file.name + ".tmp")
+            jwritefile(tmpfile, data)
+            tmpfile.replace(self.__index_file)
+        except OSError:
+            print_trace("Cannot write installed packages index {file}".format(file=self.__index_file))
+
+    def __load(self) -> dict:
+        data = self.__read()
+        if not self.__is_valid(data):
+            data = self.__scan()
+            self.__write(data)
+        return data
+
+    @property
+    def packages(self) -> OrderedDict:
+        """
+        Return the installed packages, folder name -> package identifier
+        """
+        if not self.__root_folder.is_dir():
+            return OrderedDict()
+        return self.__load()[InstalledPackagesIndex.KEY_PACKAGES]
+
+    def __update(self, name: str, identifier: str = None):
+        if not self.__root_folder.is_dir():
+            return
+        # The index is rebuilt if the root folder was modified since it was written, including by the caller,
+        # so changes made outside leaf are never hidden
+        data = self.__load()
+        data[InstalledPackagesIndex.KEY_PACKAGES].pop(name, None)
+        pending = data[InstalledPackagesIndex.KEY_PENDING]
+        if name in pending:
+            pending.remove(name)
+        if identifier is not None:
+            data[InstalledPackagesIndex.KEY_PACKAGES][name] = identifier
+        # Keep the mtime of the loaded index, it is only valid if the root folder has not been modified since
+        self.__write(data)
+
+    def add(self, folder: Path, identifier):
+        """
+        Record a package which has just been installed in the given folder
+        """
+        self.__update(folder.name, str(identifier))
+
+    def remove(self, folder: Path):
+        """
+        Forget the package which has just been removed from the given folder
+        """
+        self.__update(folder.name)
@@ -19,6 +19,7 @@ class CommonSettings(StaticSettings):
     CONFIG_FOLDER = EnvVar("LEAF_CONFIG", default="~/.config/leaf")
     VERBOSITY = EnvVar("LEAF_VERBOSE", validator=RegexValidator("(default|verbose|quiet)"))
     SHELL = EnvVar("SHELL")
+    SOURCE_DATE_EPOCH = EnvVar("SOURCE_DATE_EPOCH", validator=RegexValidator("[0-9]+"))
 
 
 class LeafSettings(CommonSettings):
@@ -34,6 +35,13 @@ class LeafSettings(CommonSettings):
     CACHE_AUTOCLEAN = LeafSetting(
         "leaf.cache.autoclean", "LEAF_CACHE_AUTOCLEAN", description="Leaf cache auto clean up", default=1, validator=RegexValidator("[0-1]")
     )
+    CACHE_SIZE_MAX = LeafSetting(
+        "leaf.cache.size.max",
+        "LEAF_CACHE_SIZE_MAX",
+        description="Maximum size (in MB) of the download cache",
+        default=5 * 1024,
+        validator=RegexValidator("[0-9]+"),
+    )
     DEBUG_MODE = LeafSetting("leaf.debug", "LEAF_DEBUG", description="Enable traces")
     NON_INTERACTIVE = LeafSetting("leaf.noninteractive", "LEAF_NON_INTERACTIVE", description="Do not ask for confirmations, assume yes")
     DISABLE_LOCKS = LeafSetting("leaf.locks.disable", "LEAF_DISABLE_LOCKS", description="Disable lock files for install operations")
@@ -46,6 +54,26 @@ class LeafSettings(CommonSettings):
         "leaf.download.retry", "LEAF_RETRY", description="Retry count for download operations", default=5, validator=RegexValidator("[0-9]+")
     )
     DOWNLOAD_NORESUME = LeafSetting("leaf.download.resume.disable", "LEAF_NORESUME", description="Disable resume when a download fails")
+    DOWNLOAD_PARALLEL = LeafSetting(
+        "leaf.download.parallel", "LEAF_DOWNLOAD_PARALLEL", description="Maximum number of parallel downloads", default=4, validator=RegexValidator("[0-9]+")
+    )
+    DOWNLOAD_PARALLEL_REMOTE = LeafSetting(
+        "leaf.download.parallel.remote",
+        "LEAF_DOWNLOAD_PARALLEL_REMOTE",
+        description="Maximum number of parallel downloads from a single remote",
+        default=4,
+        validator=RegexValidator("[0-9]+"),
+    )
+    EXTRACT_PARALLEL = LeafSetting(
+        "leaf.extract.parallel",
+        "LEAF_EXTRACT_PARALLEL",
+        description="Maximum number of parallel package extractions, 0 to use all processors",
+        default=0,
+        validator=RegexValidator("[0-9]+"),
+    )
+    INSTALL_DEDUP = LeafSetting(
+        "leaf.install.dedup", "LEAF_INSTALL_DEDUP", description="Share identical files of installed packages with hard links to a common store"
+    )
     GPG_KEYSERVER = LeafSetting(
         "leaf.gpg.server", "LEAF_GPG_KEYSERVER", description="Server where GPG keys will be fetched", default="subset.pool.sks-keyservers.net"
     )
@@ -80,7 +108,6 @@ class LeafConstants:
     MIN_PYTHON_VERSION = (3, 5)
     COLORAMA_MIN_VERSION = "0.3.3"
     DEFAULT_PROFILE = "default"
-    CACHE_SIZE_MAX = 5 * 1024 * 1024 * 1024  # 5GB
     GPG_SIG_EXTENSION = ".asc"
     EXTINFO_EXTENSION = ".info"
     LATEST = "latest"
@@ -105,10 +132,16 @@ class LeafFiles:
     CONFIG_FILENAME = "config.json"
     CACHE_DOWNLOAD_FOLDERNAME = "files"
     CACHE_REMOTES_FOLDERNAME = "remotes"
+    CACHE_ARTIFACTS_FOLDERNAME = "artifacts"
+    CACHE_INSTALLED_FOLDERNAME = "installed"
+    CACHE_PROFILES_FOLDERNAME = "profiles"
+    CACHE_INDEX_TAGS_FOLDERNAME = "tags"
     THEMES_FILENAME = "themes.ini"
     PLUGINS_DIRNAME = "plugins"
     GPG_DIRNAME = "gpg"
     LOCK_FILENAME = "lock"
+    # Hidden folder in the user root folder, shared by installed packages
+    CONTENT_STORE_FOLDERNAME = ".leaf-store"
 
 
 class JsonConstants(object):
@@ -181,3 +214,7 @@ class JsonConstants(object):
     WS_REMOTES = "remotes"
     WS_PROFILE_PACKAGES = "packages"
     WS_PROFILE_ENV = "env"
+
+    # Profile dependencies cache
+    CACHE_VARIABLES = "variables"
+    CACHE_DEPENDENCIES = "dependencies"
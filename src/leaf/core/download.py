@@ -10,18 +10,25 @@ Leaf Package Manager
 import os
 import shutil
 import time
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
+from threading import BoundedSemaphore, Lock
 from urllib.parse import urlparse, urlunparse
 from urllib.request import urlopen
 
 import requests
+from requests.adapters import HTTPAdapter
 
 from leaf.core.constants import LeafSettings
+from leaf.core.error import InvalidHashException
 from leaf.core.logger import TextLogger, print_trace
-from leaf.core.utils import hash_check
+from leaf.core.utils import hash_check, hash_create, hash_tostring, hash_update
 
 PRIORITIES_RANGE = range(1, 1000)
 PROTOCOLS_PRIORITIES = {"https": 200, "http": 201, "file": 100, "": 100}
+HTTP_ETAG = "ETag"
+HTTP_LAST_MODIFIED = "Last-Modified"
+PARTIAL_SUFFIX = ".part"
 
 
 def get_url_priority(url: str):
@@ -38,60 +45,144 @@ def url_resolve(url: str, subpath: str):
     return urlunparse(url)
 
 
-def _download_file_generic(url: str, output: Path, logger: TextLogger):
-    _display_progress(logger, "Getting {0.name}".format(output))
+def create_http_session(pool_size: int = None) -> requests.Session:
+    """
+    Create a http session, connections are kept alive and reused for all requests to the same host
+    The pool size is the max count of connections kept per host, default to leaf.download.parallel.remote setting
+    """
+    if pool_size is None:
+        pool_size = LeafSettings.DOWNLOAD_PARALLEL_REMOTE.as_int()
+    out = requests.Session()
+    adapter = HTTPAdapter(pool_maxsize=max(1, pool_size))
+    out.mount("http://", adapter)
+    out.mount("https://", adapter)
+    return out
+
+
+def _download_file_generic(url: str, output: Path, logger: TextLogger, progress: callable = None, hasher=None):
+    if progress is None:
+        _display_progress(logger, "Getting {0.name}".format(output))
     with urlopen(url, timeout=LeafSettings.DOWNLOAD_TIMEOUT.as_int()) as stream:
+        data = stream.read()
         with output.open("wb") as fp:
-            fp.write(stream.read())
-    # End the progress display
-    _display_progress(logger, "Getting {0.name}".format(output), 1, 1, end="\n")
+            size = fp.write(data)
+        if hasher is not None:
+            hasher.update(data)
+    if progress is None:
+        # End the progress display
+        _display_progress(logger, "Getting {0.name}".format(output), 1, 1, end="\n")
+    else:
+        progress(size)
 
 
-def _download_file_local(url: str, output: Path, logger: TextLogger):
-    _display_progress(logger, "Copying {0.name}".format(output))
-    shutil.copy(str(url), str(output))
-    # End the progress display
-    _display_progress(logger, "Copying {0.name}".format(output), 1, 1, end="\n")
+def _download_file_local(url: str, output: Path, logger: TextLogger, buffer_size: int = 262144, progress: callable = None, hasher=None):
+    if progress is None:
+        _display_progress(logger, "Copying {0.name}".format(output))
+    if hasher is None:
+        shutil.copy(str(url), str(output))
+    else:
+        # Copy by chunks to compute the hash in the same pass
+        with open(str(url), "rb") as fin, output.open("wb") as fout:
+            data = fin.read(buffer_size)
+            while len(data) > 0:
+                fout.write(data)
+                hasher.update(data)
+                data = fin.read(buffer_size)
+    if progress is None:
+        # End the progress display
+        _display_progress(logger, "Copying {0.name}".format(output), 1, 1, end="\n")
+    else:
+        progress(output.stat().st_size)
 
 
-def _download_file_http(url: str, output: Path, logger: TextLogger, resume: bool = None, retry: int = None, buffer_size: int = 262144):
+def _download_file_http(
+    url: str,
+    output: Path,
+    logger: TextLogger,
+    resume: bool = None,
+    retry: int = None,
+    buffer_size: int = 262144,
+    progress: callable = None,
+    hasher_factory: callable = None,
+    session: requests.Session = None,
+    request_headers: dict = None,
+    on_response: callable = None,
+):
+    """
+    Download the file using http(s), with retry and resume support.
+    If a hasher factory is given, the content is hashed as it is written and the hash object is returned
+    If a session is given, its pooled connections are used
+    If the on_response callback returns False for a response, the download is stopped before writing the output
+    """
     # Handle default values
     if retry is None:
         retry = LeafSettings.DOWNLOAD_RETRY.as_int()
     if resume is None:
         resume = not LeafSettings.DOWNLOAD_NORESUME.as_boolean()
 
-    _display_progress(logger, "Downloading {0.name}".format(output))
+    if progress is None:
+        _display_progress(logger, "Downloading {0.name}".format(output))
 
+    hasher = None
+    size_hashed = 0
     iteration = 0
     while True:
         try:
-            headers = {}
+            headers = dict(request_headers or {})
             size_current = 0
             if output.exists():
                 if resume:
                     size_current = output.stat().st_size
-                    headers = {"Range": "bytes={0}-".format(size_current)}
+                    headers["Range"] = "bytes={0}-".format(size_current)
                 else:
                     output.unlink()
+            if hasher_factory is not None and (hasher is None or size_hashed != size_current):
+                # Only hash the existing data if it has not been hashed while written
+                hasher = hasher_factory()
+                if size_current > 0:
+                    hash_update(hasher, output, size=size_current)
+                size_hashed = size_current
+
+            req = (session or requests).get(url, stream=True, headers=headers, timeout=LeafSettings.DOWNLOAD_TIMEOUT.as_int())
+            if on_response is not None and not on_response(req):
+                req.close()
+                if progress is None:
+                    # End the progress display
+                    _display_progress(logger, "Downloading {0.name}".format(output), 1, 1, end="\n")
+                return None
 
             with output.open("ab" if resume else "wb") as fp:
-                req = requests.get(url, stream=True, headers=headers, timeout=LeafSettings.DOWNLOAD_TIMEOUT.as_int())
+                if size_current > 0 and req.status_code == 200:
+                    # Server does not support range requests, restart from the beginning
+                    fp.seek(0)
+                    fp.truncate()
+                    size_current = 0
+                    if hasher_factory is not None:
+                        hasher = hasher_factory()
+                        size_hashed = 0
                 # Get total size on first request
                 size_total = int(req.headers.get("content-length", -1)) + size_current
 
                 # Read remote data and write to output file
                 for data in req.iter_content(buffer_size):
-                    size_current += fp.write(data)
-                    _display_progress(logger, "Downloading {0.name}".format(output), size_current, size_total)
+                    size_written = fp.write(data)
+                    size_current += size_written
+                    if hasher is not None:
+                        hasher.update(data)
+                        size_hashed += size_written
+                    if progress is None:
+                        _display_progress(logger, "Downloading {0.name}".format(output), size_current, size_total)
+                    else:
+                        progress(size_written)
 
                 # Rare case when no exception raised and download is not finished
                 if 0 < size_current < size_total:
                     raise ValueError("Incomplete download")
 
-                # End the progress display
-                _display_progress(logger, "Downloading {0.name}".format(output), 1, 1, end="\n")
-                return size_current
+                if progress is None:
+                    # End the progress display
+                    _display_progress(logger, "Downloading {0.name}".format(output), 1, 1, end="\n")
+                return hasher
         except (ValueError, requests.RequestException, requests.ConnectionError, requests.HTTPError, requests.Timeout) as e:
             iteration += 1
             # Check retry
@@ -105,26 +196,81 @@ def _download_file_http(url: str, output: Path, logger: TextLogger, resume: bool
             time.sleep(1)
 
 
-def download_file(url: str, output: Path, logger: TextLogger = None):
+def download_file(
+    url: str, output: Path, logger: TextLogger = None, progress: callable = None, compute_hash: bool = False, session: requests.Session = None
+):
+    """
+    Download a file.
+    If a progress callback is given, it is called with the count of bytes received
+    instead of displaying the progress of this single file
+    If a http session is given, it is used for http(s) urls
+    @return: the hash of the downloaded content if compute_hash is set, None otherwise
+    """
     # Create parent folder if needed
     if not output.parent.exists():
-        output.parent.mkdir(parents=True)
+        output.parent.mkdir(parents=True, exist_ok=True)
+    hasher = hash_create() if compute_hash else None
     # Parse url to get the protocole
     parsedurl = urlparse(url)
     if parsedurl.scheme == "":
         # file mode, simple file copy
-        _download_file_local(parsedurl.path, output, logger=logger)
+        _download_file_local(parsedurl.path, output, logger=logger, progress=progress, hasher=hasher)
     elif parsedurl.scheme.startswith("http"):
         # http/https mode, get file length before
-        _download_file_http(url, output, logger=logger)
+        hasher = _download_file_http(url, output, logger=logger, progress=progress, hasher_factory=hash_create if compute_hash else None, session=session)
     else:
         # other scheme, use urllib
-        _download_file_generic(url, output, logger=logger)
+        _download_file_generic(url, output, logger=logger, progress=progress, hasher=hasher)
+    return hash_tostring(hasher) if hasher is not None else None
+
+
+def download_file_if_modified(url: str, output: Path, validators: dict = None, logger: TextLogger = None, session: requests.Session = None):
+    """
+    Download a file unless it has not been modified since the download described by the validators (ETag, Last-Modified).
+    Conditional requests are only supported for http(s) urls, other files are always downloaded.
+    The output file is only replaced if the content has been modified.
+    @return: the validators of the new content (can be empty), or None if the content has not been modified
+    """
+    if not urlparse(url).scheme.startswith("http"):
+        download_file(url, output, logger=logger, session=session)
+        return {}
+
+    request_headers = {}
+    if validators is not None and output.exists():
+        if HTTP_ETAG in validators:
+            request_headers["If-None-Match"] = validators[HTTP_ETAG]
+        if HTTP_LAST_MODIFIED in validators:
+            request_headers["If-Modified-Since"] = validators[HTTP_LAST_MODIFIED]
+    out = {}
+
+    def on_response(response):
+        if response.status_code == 304:
+            return False
+        for key in (HTTP_ETAG, HTTP_LAST_MODIFIED):
+            if key in response.headers:
+                out[key] = response.headers[key]
+        return True
+
+    # Download in a temporary file to keep the current content on error
+    tmpfile = output.parent / (output.name + PARTIAL_SUFFIX)
+    if tmpfile.exists():
+        tmpfile.unlink()
+    output.parent.mkdir(parents=True, exist_ok=True)
+    _download_file_http(url, tmpfile, logger, resume=False, session=session, request_headers=request_headers, on_response=on_response)
+    if not tmpfile.exists():
+        # Not modified
+        return None
+    tmpfile.replace(output)
+    return out
 
 
-def download_and_verify_file(url: str, output: Path, logger: TextLogger = None, hashstr: str = None):
+def download_and_verify_file(
+    url: str, output: Path, logger: TextLogger = None, hashstr: str = None, progress: callable = None, session: requests.Session = None
+):
     """
-    Download an artifact and check its hash if given
+    Download an artifact and check its hash if given.
+    The hash is computed while the file is downloaded, so the file is not read twice
+    The file is downloaded with a temporary name and only renamed once complete and verified
     """
     if output.exists():
         if hashstr is None:
@@ -137,9 +283,17 @@ def download_and_verify_file(url: str, output: Path, logger: TextLogger = None,
             logger.print_verbose("File {file.name} is already downloaded".format(file=output))
 
     if not output.exists():
-        download_file(url, output, logger=logger)
+        # An interrupted download is kept to be resumed
+        tmpfile = output.parent / (output.name + PARTIAL_SUFFIX)
+        actual = download_file(url, tmpfile, logger=logger, progress=progress, compute_hash=hashstr is not None, session=session)
         if hashstr:
-            hash_check(output, hashstr, raise_exception=True)
+            try:
+                hash_check(tmpfile, hashstr, raise_exception=True, actual=actual)
+            except InvalidHashException:
+                # Corrupted content cannot be resumed
+                os.remove(str(tmpfile))
+                raise
+        tmpfile.replace(output)
     return output
 
 
@@ -154,3 +308,118 @@ def _display_progress(logger: TextLogger, message: str, worked: int = None, tota
             else:
                 kwargs["progress"] = "{0}/{1}".format(worked, total)
             logger.print_default("\r[{progress}] {message} ".format(**kwargs), end=end, flush=True)
+
+
+class DownloadPool:
+
+    """
+    Download and verify files concurrently with a bounded pool of workers.
+    Downloads sharing the same key (for example, the remote alias) are limited
+    to a given count of parallel connections.
+    The progress of all downloads is displayed on a single line.
+    """
+
+    def __init__(self, logger: TextLogger = None, max_workers: int = None, max_per_key: int = None, session: requests.Session = None):
+        if max_workers is None:
+            max_workers = LeafSettings.DOWNLOAD_PARALLEL.as_int()
+        if max_per_key is None:
+            max_per_key = LeafSettings.DOWNLOAD_PARALLEL_REMOTE.as_int()
+        self.__logger = logger
+        self.__session = session
+        self.__executor = ThreadPoolExecutor(max_workers=max(1, max_workers))
+        self.__max_per_key = max(1, max_per_key)
+        self.__semaphores = {}
+        self.__futures = []
+        self.__lock = Lock()
+        # Progress
+        self.__count = 0
+        self.__done = 0
+        self.__worked = 0
+        self.__total = 0
+        self.__unknown_size = False
+        self.__pending_line = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.shutdown(cancel=exc[0] is not None)
+
+    def submit(self, url: str, output: Path, hashstr: str = None, size: int = None, key=None, label: str = None):
+        """
+        Schedule the download of the given url, the label is used in logs instead of the output file name
+        @return: a Future which result is the output file
+        """
+        with self.__lock:
+            self.__count += 1
+            if size is None:
+                self.__unknown_size = True
+            else:
+                self.__total += size
+            semaphore = self.__semaphores.get(key)
+            if semaphore is None:
+                semaphore = BoundedSemaphore(self.__max_per_key)
+                self.__semaphores[key] = semaphore
+        future = self.__executor.submit(self.__download, url, output, hashstr, size, semaphore, label or output.name)
+        self.__futures.append(future)
+        return future
+
+    def shutdown(self, cancel: bool = False):
+        """
+        Wait for running downloads, pending downloads are canceled if *cancel* is set
+        """
+        if cancel:
+            for future in self.__futures:
+                future.cancel()
+        self.__executor.shutdown(wait=True)
+        if self.__pending_line:
+            # End the progress display
+            self.__display_progress(end="\n")
+
+    def print_message(self, message: str, verbose: bool = False):
+        """
+        Print a message without breaking the progress line, which is displayed again on next update
+        """
+        if self.__logger and (self.__logger.isverbose() or not verbose):
+            with self.__lock:
+                if self.__pending_line:
+                    self.__logger.print_default("")
+                    self.__pending_line = False
+                if verbose:
+                    self.__logger.print_verbose(message)
+                else:
+                    self.__logger.print_default(message)
+
+    def __download(self, url: str, output: Path, hashstr: str, size: int, semaphore, label: str):
+        received = []
+
+        def progress(count):
+            received.append(count)
+            with self.__lock:
+                self.__worked += count
+            self.__display_progress()
+
+        with semaphore:
+            try:
+                return download_and_verify_file(url, output, logger=self.__logger, hashstr=hashstr, progress=progress, session=self.__session)
+            finally:
+                with self.__lock:
+                    self.__done += 1
+                    # File may be already in cache or its size may be wrong in index
+                    if size is not None:
+                        self.__worked += size - sum(received)
+                self.__display_progress(done_label=label)
+
+    def __display_progress(self, end: str = "", done_label: str = None):
+        with self.__lock:
+            if self.__logger is not None and self.__logger.isverbose():
+                # Verbose logs would break the progress line, only log completed files
+                if done_label is not None:
+                    self.__logger.print_verbose("[{done}/{count}] Downloaded {label}".format(done=self.__done, count=self.__count, label=done_label))
+                return
+            message = "Downloading {done}/{count} file(s)".format(done=self.__done, count=self.__count)
+            if self.__unknown_size or self.__total <= 0:
+                _display_progress(self.__logger, message, self.__done, self.__count, end=end)
+            else:
+                _display_progress(self.__logger, message, min(self.__worked, self.__total), self.__total, end=end)
+            self.__pending_line = end == ""
@@ -0,0 +1,149 @@
+"""
+Leaf Package Manager
+
+@author:    Legato Tooling Team <letools@sierrawireless.com>
+@copyright: Sierra Wireless. All rights reserved.
+@contact:   Legato Tooling Team <letools@sierrawireless.com>
+@license:   https://www.mozilla.org/en-US/MPL/2.0/
+"""
+
+import bz2
+import gzip
+import lzma
+import multiprocessing
+import os
+import shutil
+import sys
+from concurrent.futures import Future, ProcessPoolExecutor
+from pathlib import Path
+from tarfile import StreamError, TarFile
+from threading import Thread
+
+from leaf.core.constants import LeafSettings
+from leaf.core.utils import rmtree_force
+
+# Compressed archives bigger than this size are decompressed in a separate thread
+PIPELINE_THRESHOLD = 32 * 1024 * 1024
+_PIPELINE_BLOCKSIZE = 1024 * 1024
+_DECOMPRESSORS = ((b"\xfd7zXZ\x00", lzma.open), (b"\x1f\x8b", gzip.open), (b"BZh", bz2.open))
+
+
+def _find_decompressor(archive: Path) -> callable:
+    with archive.open("rb") as fp:
+        magic = fp.read(6)
+    for prefix, opener in _DECOMPRESSORS:
+        if magic.startswith(prefix):
+            return opener
+    return None
+
+
+def _extract_pipelined(archive: Path, folder: Path, opener: callable):
+    """
+    Decompress the archive in a thread while the tar members are written by the current one
+    """
+    rfd, wfd = os.pipe()
+    errors = []
+
+    def decompress():
+        try:
+            with os.fdopen(wfd, "wb") as dst, opener(str(archive), "rb") as src:
+                shutil.copyfileobj(src, dst, _PIPELINE_BLOCKSIZE)
+        except BaseException as e:
+            errors.append(e)
+
+    thread = Thread(target=decompress, daemon=True)
+    thread.start()
+    try:
+        with os.fdopen(rfd, "rb") as src:
+            with TarFile.open(fileobj=src, mode="r|") as tf:
+                tf.extractall(str(folder))
+            # Consume the end of the stream, so the decompressor checks the whole archive
+            while len(src.read(_PIPELINE_BLOCKSIZE)) > 0:
+                pass
+    finally:
+        thread.join()
+    if len(errors) > 0:
+        raise errors[0]
+
+
+def extract_tarfile(archive: Path, folder: Path) -> Path:
+    """
+    Extract the given tar file in the folder
+    Big compressed archives are decompressed while files are written
+    @return: the folder
+    """
+    opener = _find_decompressor(archive) if archive.stat().st_size >= PIPELINE_THRESHOLD else None
+    if opener is not None:
+        try:
+            _extract_pipelined(archive, folder, opener)
+            return folder
+        except StreamError:
+            # Some members cannot be extracted sequentially, clean the folder and extract with random access
+            for item in folder.iterdir():
+                if item.is_dir() and not item.is_symlink():
+                    rmtree_force(item)
+                else:
+                    item.unlink()
+    with TarFile.open(str(archive)) as tf:
+        tf.extractall(str(folder))
+    return folder
+
+
+class ExtractionPool:
+
+    """
+    Extract artifacts concurrently in a pool of processes, since decompression is CPU bound.
+    The pool is not bigger than the number of *jobs* if known. With a single worker or a single job, artifacts are extracted when submitted.
+    """
+
+    def __init__(self, max_workers: int = None, jobs: int = None):
+        if max_workers is None:
+            max_workers = LeafSettings.EXTRACT_PARALLEL.as_int()
+        if max_workers <= 0:
+            max_workers = os.cpu_count() or 1
+        if jobs is not None:
+            max_workers = min(max_workers, jobs)
+        self.__executor = ExtractionPool.__create_executor(max_workers) if max_workers > 1 else None
+        self.__futures = []
+
+    @staticmethod
+    def __create_executor(max_workers: int) -> ProcessPoolExecutor:
+        if sys.version_info < (3, 7):
+            # The start method cannot be chosen, forking while download threads hold locks could deadlock the workers
+            return None
+        # Workers are not forked from the current process, which runs the download threads
+        methods = multiprocessing.get_all_start_methods()
+        context = multiprocessing.get_context("forkserver" if "forkserver" in methods else "spawn")
+        return ProcessPoolExecutor(max_workers=max_workers, mp_context=context)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.shutdown(cancel=exc[0] is not None)
+
+    def submit(self, archive: Path, folder: Path) -> Future:
+        """
+        Schedule the extraction of the archive in the given folder, which must exist
+        @return: a Future which result is the folder
+        """
+        if self.__executor is not None:
+            future = self.__executor.submit(extract_tarfile, archive, folder)
+        else:
+            future = Future()
+            try:
+                future.set_result(extract_tarfile(archive, folder))
+            except Exception as e:
+                future.set_exception(e)
+        self.__futures.append(future)
+        return future
+
+    def shutdown(self, cancel: bool = False):
+        """
+        Wait for running extractions, pending extractions are canceled if *cancel* is set
+        """
+        if cancel:
+            for future in self.__futures:
+                future.cancel()
+        if self.__executor is not None:
+            self.__executor.shutdown(wait=True)
@@ -8,11 +8,20 @@ Leaf Package Manager
 """
 
 import json
+import struct
+import sys
 from collections import OrderedDict
 from pathlib import Path
 
 __JSON_LOAD_ARGS = {"object_pairs_hook": OrderedDict}
 __JSON_DUMP_PP = {"indent": 4, "separators": (",", ": ")}
+# Cache file: header (magic, format version, source size and mtime) followed by the compact utf-8 json of the data
+__CACHE_MAGIC = b"LFJS"
+__CACHE_VERSION = 1
+__CACHE_HEADER = struct.Struct("<4sBQQ")
+__JSON_DUMP_COMPACT = {"separators": (",", ":"), "ensure_ascii": False}
+# Plain dict keeps insertion order since python 3.7
+__CACHE_SUPPORTED = sys.version_info >= (3, 7)
 
 
 def jtostring(data: dict, pp: bool = False):
@@ -38,6 +47,39 @@ def jloads(s):
     return json.loads(s, **__JSON_LOAD_ARGS)
 
 
+def __cache_header(source: Path):
+    st = source.stat()
+    return __CACHE_HEADER.pack(__CACHE_MAGIC, __CACHE_VERSION, st.st_size, st.st_mtime_ns)
+
+
+def jwritecache(file: Path, data: dict, source: Path):
+    """
+    Write a compact copy of the data loaded from the given json file, see jloadcache
+    """
+    if __CACHE_SUPPORTED:
+        tmpfile = file.parent / (file.name + ".tmp")
+        with tmpfile.open("wb") as fp:
+            fp.write(__cache_header(source))
+            fp.write(json.dumps(data, **__JSON_DUMP_COMPACT).encode())
+        tmpfile.replace(file)
+
+
+def jloadcache(file: Path, source: Path):
+    """
+    Load the compact copy of the given json file, faster than parsing the json file.
+    Objects are loaded as plain dict instead of OrderedDict, which keeps the decoding in the C json parser.
+    @return: None if the copy does not exist, is outdated or is invalid
+    """
+    if __CACHE_SUPPORTED and file.exists() and source.exists():
+        with file.open("rb") as fp:
+            if fp.read(__CACHE_HEADER.size) == __cache_header(source):
+                try:
+                    return json.loads(fp.read().decode())
+                except ValueError:
+                    pass
+    return None
+
+
 def jlayer_update(left: dict, right: dict, list_append: bool = False):
     """
     Update the *left* model with values from *right*
@@ -111,23 +153,31 @@ class JsonObject:
     Represent a json object
     """
 
-    def __init__(self, json: dict):
+    def __init__(self, json: dict, loader: callable = None):
+        """
+        If json is None, the loader is called to get the content on first access
+        """
         self.__json = json
+        self.__loader = loader
 
     @property
     def json(self):
+        if self.__json is None and self.__loader is not None:
+            self.__json = self.__loader()
+            self.__loader = None
         return self.__json
 
     def jsonget(self, key: str, default=None, mandatory: bool = False):
         """
         Utility to browse json and reduce None testing
         """
-        if key not in self.__json:
+        json = self.json
+        if key not in json:
             if mandatory:
                 raise ValueError("Missing mandatory json field '{key}'".format(key=key))
             if default is not None:
-                self.__json[key] = default
-        return self.__json.get(key)
+                json[key] = default
+        return json.get(key)
 
     def jsonpath(self, path: list, default=None, mandatory: bool = False):
         """
@@ -147,7 +197,7 @@ class JsonObject:
     def has(self, *keys: str) -> bool:
         out = 0
         for key in keys:
-            if key in self.__json:
+            if key in self.json:
                 out += 1
         return out
 
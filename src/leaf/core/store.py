@@ -0,0 +1,164 @@
+"""
+Leaf Package Manager
+
+@author:    Legato Tooling Team <letools@sierrawireless.com>
+@copyright: Sierra Wireless. All rights reserved.
+@contact:   Legato Tooling Team <letools@sierrawireless.com>
+@license:   https://www.mozilla.org/en-US/MPL/2.0/
+"""
+
+import filecmp
+import os
+import shutil
+import stat
+from pathlib import Path
+
+from leaf.core.jsonutils import jloadfile, jwritefile
+from leaf.core.logger import print_trace
+from leaf.core.utils import hash_create, hash_update
+
+
+class ContentStore:
+
+    """
+    Pool of objects shared by the installed packages with hard links.
+    Identical files (same content and same mode) of the packages are links to the same object,
+    so an object without any other link is not used by any package anymore.
+    The objects used by each package folder are listed, to only check them when the folder is removed.
+    Shared files must not be modified in place since the modification would be seen by all packages.
+    """
+
+    __OBJECTS_FOLDERNAME = "objects"
+    __REFS_FOLDERNAME = "refs"
+
+    def __init__(self, folder: Path):
+        self.__folder = folder
+
+    @property
+    def folder(self) -> Path:
+        return self.__folder
+
+    @property
+    def objects_folder(self) -> Path:
+        return self.__folder / ContentStore.__OBJECTS_FOLDERNAME
+
+    def __get_refs_file(self, folder: Path) -> Path:
+        return self.__folder / ContentStore.__REFS_FOLDERNAME / (folder.name + ".json")
+
+    def __get_object_name(self, file: Path, st: os.stat_result) -> str:
+        digest = hash_update(hash_create(), file).hexdigest()
+        return "{prefix}/{digest}_{mode:o}".format(prefix=digest[:2], digest=digest[2:], mode=stat.S_IMODE(st.st_mode))
+
+    def __is_same_object(self, file: Path, st: os.stat_result, obj: Path) -> bool:
+        """
+        Check the actual mode and content of the object, it may have been modified through another link
+        """
+        objst = obj.lstat()
+        return stat.S_ISREG(objst.st_mode) and objst.st_mode == st.st_mode and objst.st_size == st.st_size and filecmp.cmp(str(file), str(obj), shallow=False)
+
+    def deduplicate(self, folder: Path) -> int:
+        """
+        Replace the regular files of the folder by links to the objects of the store, unknown files are added to the store.
+        Files which cannot be linked (other filesystem, too many links, read only folder...) are kept as is.
+        @return: the size saved
+        """
+        out = 0
+        refs = []
+        for root, _, files in os.walk(str(folder)):
+            for name in files:
+                file = Path(root, name)
+                st = file.lstat()
+                # Empty files and files already linked (in the package or in the store) are ignored
+                if not stat.S_ISREG(st.st_mode) or st.st_size == 0 or st.st_nlink > 1:
+                    continue
+                tmpfile = file.parent / ("." + name + ".leaf-link")
+                try:
+                    objname = self.__get_object_name(file, st)
+                    obj = self.objects_folder / objname
+                    obj.parent.mkdir(parents=True, exist_ok=True)
+                    try:
+                        os.link(str(file), str(obj))
+                        # New object
+                        refs.append(objname)
+                        continue
+                    except FileExistsError:
+                        pass
+                    if self.__is_same_object(file, st, obj):
+                        os.link(str(obj), str(tmpfile))
+                        os.replace(str(tmpfile), str(file))
+                        out += st.st_size
+                    else:
+                        # The object was modified, the file replaces it for next packages
+                        tmpfile = obj.parent / ("." + obj.name + ".leaf-link")
+                        os.link(str(file), str(tmpfile))
+                        os.replace(str(tmpfile), str(obj))
+                    refs.append(objname)
+                except OSError:
+                    print_trace("Cannot share {file}".format(file=file))
+                    if tmpfile.exists():
+                        tmpfile.unlink()
+        if len(refs) > 0:
+            refsfile = self.__get_refs_file(folder)
+            refsfile.parent.mkdir(parents=True, exist_ok=True)
+            jwritefile(refsfile, sorted(set(refs)))
+        return out
+
+    def unshare(self, folder: Path) -> int:
+        """
+        Replace the files of the folder linked to other files by copies, so they can be modified
+        @return: the count of copied files
+        """
+        out = 0
+        if self.__get_refs_file(folder).exists():
+            for root, _, files in os.walk(str(folder)):
+                for name in files:
+                    file = Path(root, name)
+                    st = file.lstat()
+                    if stat.S_ISREG(st.st_mode) and st.st_nlink > 1:
+                        tmpfile = file.parent / ("." + name + ".leaf-copy")
+                        shutil.copy2(str(file), str(tmpfile))
+                        os.replace(str(tmpfile), str(file))
+                        out += 1
+            self.release(folder)
+        return out
+
+    def release(self, folder: Path) -> int:
+        """
+        Forget the objects used by the folder, the ones which are not linked by any other package are removed.
+        The folder must be removed or unshared before.
+        @return: the count of removed objects
+        """
+        out = 0
+        refsfile = self.__get_refs_file(folder)
+        if refsfile.exists():
+            try:
+                refs = jloadfile(refsfile)
+            except ValueError:
+                print_trace("Invalid store references {file}".format(file=refsfile))
+                refs = []
+            for objname in refs:
+                obj = self.objects_folder / objname
+                try:
+                    if obj.lstat().st_nlink <= 1:
+                        obj.unlink()
+                        out += 1
+                except FileNotFoundError:
+                    pass
+            refsfile.unlink()
+        return out
+
+    def garbage_collect(self) -> int:
+        """
+        Scan the whole store and remove the objects which are not linked by any package anymore
+        @return: the count of removed objects
+        """
+        out = 0
+        if self.objects_folder.is_dir():
+            for subfolder in self.objects_folder.iterdir():
+                for entry in os.scandir(str(subfolder)):
+                    if entry.stat(follow_symlinks=False).st_nlink <= 1:
+                        os.unlink(entry.path)
+                        out += 1
+                if next(subfolder.iterdir(), None) is None:
+                    subfolder.rmdir()
+        return out
@@ -17,7 +17,6 @@ import sys
 import time
 from collections import OrderedDict
 from functools import total_ordering
-from itertools import zip_longest
 from pathlib import Path
 
 from leaf import __version__
@@ -30,30 +29,48 @@ _VERSION_SEPARATOR = re.compile("[-_.~]")
 
 @total_ordering
 class Version:
+
+    """
+    Comparable version, like 1.2.3-rc1
+    Versions are compared with a normalized key, so 1.0 and 1.00 are equal and have the same hash
+    """
+
+    __slots__ = ("__version", "__key")
+
     def __init__(self, version: str):
         self.__version = version
+        self.__key = None
 
     @property
     def value(self):
         return self.__version.strip()
 
+    @property
+    def key(self) -> tuple:
+        """
+        Sort key, computed once
+        """
+        if self.__key is None:
+            self.__key = version_string_to_key(self.__version)
+        return self.__key
+
     def __str__(self):
         return self.value
 
     def __hash__(self):
-        return hash(self.value)
+        return hash(self.key)
 
     def __eq__(self, other):
         if isinstance(other, str):
             return self.__eq__(Version(other))
         if not isinstance(other, Version):
             return NotImplemented
-        return version_comparator(self.value, other.value) == 0
+        return self.key == other.key
 
     def __lt__(self, other):
         if isinstance(other, str):
             return self.__lt__(Version(other))
-        return version_comparator(self.value, other.value) < 0
+        return self.key < other.key
 
 
 CURRENT_LEAF_VERSION = Version(__version__)
@@ -69,43 +86,40 @@ def version_string_to_tuple(version):
     return tuple(tryint(x) for x in _VERSION_SEPARATOR.split(version.strip()))
 
 
+_VERSION_RUN = re.compile("[0-9]+|[^0-9]+")
+# Key of a "0" part
+_VERSION_KEY_ZERO = ((0, 0, ""),)
+
+
+def version_string_to_key(version: str) -> tuple:
+    """
+    Build a key which can be compared with native tuple comparison
+    Each part is split in digit and letter runs, so 0rc1 is compared like (0, rc, 1).
+    A run is (0, int, "") if numeric and (1, 0, str) otherwise, so numeric runs are lower than text runs at the same position.
+    A shorter version is lower.
+    """
+    return tuple(
+        tuple((0, int(run), "") if run.isdigit() else (1, 0, run) for run in _VERSION_RUN.findall(part))
+        for part in _VERSION_SEPARATOR.split(version.strip())
+    )
+
+
 def version_comparator(a: str, b: str, implicit_zero: bool = False):
     # Check string given
     if not isinstance(a, str) or not isinstance(b, str):
         raise ValueError()
 
-    # extract tuples
-    a, b = version_string_to_tuple(a), version_string_to_tuple(b)
+    # extract keys
+    a, b = version_string_to_key(a), version_string_to_key(b)
 
     if implicit_zero:
         # Fill with 0 the shortest
         if len(a) < len(b):
-            a += (0,) * (len(b) - len(a))
+            a += (_VERSION_KEY_ZERO,) * (len(b) - len(a))
         elif len(b) < len(a):
-            b += (0,) * (len(a) - len(b))
-        assert len(a) == len(b)
-
-    # Check equality
-    if a == b:
-        return 0
-
-    # Iterate over values
-    for va, vb in zip_longest(a, b):
-        # Detect shorter version
-        if va is None:
-            return -1
-        if vb is None:
-            return 1
-        # If different type, use str comparison
-        if type(va) != type(vb):
-            va, vb = str(va), str(vb)
-        if va < vb:
-            return -1
-        if va > vb:
-            return 1
-
-    # Tuple are equal
-    return 0
+            b += (_VERSION_KEY_ZERO,) * (len(a) - len(b))
+
+    return (a > b) - (a < b)
 
 
 def version_comparator_lt(a: str, b: str):
@@ -136,9 +150,9 @@ def get_cached_artifact_name(filename: str, hashstr: str):
 
 def is_folder_ignored(folder: Path):
     """
-    Checks if a package folder should be ignored
+    Checks if a package folder should be ignored, hidden folders are not packages
     """
-    return _IGNORED_PATTERN.match(folder.name) is not None
+    return folder.name.startswith(".") or _IGNORED_PATTERN.match(folder.name) is not None
 
 
 def mark_folder_as_ignored(folder: Path):
@@ -193,7 +207,10 @@ def fs_check_free_space(folder: Path, neededspace: int):
 
 def chmod_write(item: Path):
     if item.exists() and not item.is_symlink():
-        item.chmod(item.stat().st_mode | 0o222)
+        st = item.stat()
+        # Files with other hard links are shared, their mode must not change
+        if item.is_dir() or st.st_nlink <= 1:
+            item.chmod(st.st_mode | 0o222)
         if item.is_dir():
             for i in item.iterdir():
                 chmod_write(i)
@@ -210,7 +227,7 @@ def rmtree_force(item: Path):
 __HASH_NAME = "sha384"
 __HASH_FACTORY = hashlib.sha384
 __HASH_LEN = 96
-__HASH_BLOCKSIZE = 4096
+__HASH_BLOCKSIZE = 1024 * 1024
 
 
 def hash_parse(hashstr: str):
@@ -224,22 +241,48 @@ def hash_parse(hashstr: str):
     return parts
 
 
-def hash_compute(file: Path):
+def hash_create():
     """
-    Return the hash of the given file
+    Return a new hash object, use hash_tostring to get its value
+    """
+    return __HASH_FACTORY()
+
+
+def hash_update(hasher, file: Path, size: int = None):
+    """
+    Update the given hash object with the content of the file, or only its first bytes if size is given
     """
-    hasher = __HASH_FACTORY()
     with file.open("rb") as fp:
-        buf = fp.read(__HASH_BLOCKSIZE)
-        while len(buf) > 0:
+        remaining = size
+        while remaining is None or remaining > 0:
+            buf = fp.read(__HASH_BLOCKSIZE if remaining is None else min(remaining, __HASH_BLOCKSIZE))
+            if len(buf) == 0:
+                break
             hasher.update(buf)
-            buf = fp.read(__HASH_BLOCKSIZE)
+            if remaining is not None:
+                remaining -= len(buf)
+    return hasher
+
+
+def hash_tostring(hasher):
     return __HASH_NAME + ":" + hasher.hexdigest()
 
 
-def hash_check(file: Path, expected: str, raise_exception: bool = False):
+def hash_compute(file: Path):
+    """
+    Return the hash of the given file
+    """
+    return hash_tostring(hash_update(hash_create(), file))
+
+
+def hash_check(file: Path, expected: str, raise_exception: bool = False, actual: str = None):
+    """
+    Check the hash of the given file.
+    If the actual hash is given (computed while the file was written), the file is not read again
+    """
     hash_parse(expected)
-    actual = hash_compute(file)
+    if actual is None:
+        actual = hash_compute(file)
     if actual != expected:
         if raise_exception is True:
             raise InvalidHashException(file, actual, expected)
@@ -12,8 +12,62 @@ from functools import reduce
 
 from leaf.core.logger import TextLogger
 from leaf.model.environment import Environment
-from leaf.model.modelutils import find_latest_version, find_manifest
-from leaf.model.package import IDENTIFIER_GETTER, PackageIdentifier
+from leaf.model.modelutils import PackageMap, find_latest_version, find_manifest
+from leaf.model.package import IDENTIFIER_GETTER, ConditionalPackageIdentifier, PackageIdentifier
+
+
+class ReverseDependencies:
+
+    """
+    Reverse dependency edges of a manifest map: identifier -> packages depending on it, with the conditions of the dependency.
+    Built once, it can answer several queries without parsing all manifests again.
+    """
+
+    def __init__(self, mfmap: dict):
+        # PackageIdentifier -> list of (rank in mfmap, dependent identifier, dependent manifest, conditional identifier)
+        self.__edges = {}
+        # Dependent identifier -> all its conditional dependencies
+        self.__depends = {}
+        for rank, (pi, mf) in enumerate(mfmap.items()):
+            try:
+                cpilist = [ConditionalPackageIdentifier.parse(pisc) for pisc in mf.depends_packages]
+            except Exception:
+                # Ignore invalid manifests
+                continue
+            self.__depends[pi] = cpilist
+            for cpi in cpilist:
+                self.__edges.setdefault(cpi, []).append((rank, pi, mf, cpi))
+
+    def get_dependents(self, pilist: list, env: Environment = None) -> OrderedDict:
+        """
+        Return the packages depending on any of the given identifiers, in the order of the map
+        If env is given, only dependencies whose conditions are satisfied are used,
+        manifests with an invalid condition on any of their dependencies are ignored
+        """
+        values = env.snapshot() if env is not None else None
+        found = {}
+        # Dependent identifier -> conditions of all its dependencies can be evaluated
+        valid = {}
+        for pi in pilist:
+            for rank, dpi, mf, cpi in self.__edges.get(pi, ()):
+                if dpi in found:
+                    continue
+                if values is not None:
+                    if dpi not in valid:
+                        valid[dpi] = self.__are_conditions_valid(dpi, values)
+                    if not valid[dpi] or not cpi.are_conditions_satified(values):
+                        continue
+                found[dpi] = (rank, mf)
+        return OrderedDict((dpi, mf) for dpi, (_, mf) in sorted(found.items(), key=lambda item: item[1][0]))
+
+
+    def __are_conditions_valid(self, dpi: PackageIdentifier, values: dict) -> bool:
+        try:
+            for cpi in self.__depends[dpi]:
+                cpi.are_conditions_satified(values)
+            return True
+        except ValueError:
+            return False
 
 
 class DependencyUtils:
@@ -22,52 +76,89 @@ class DependencyUtils:
     Used to build the dependency tree using dynamic conditions
     """
 
+    @staticmethod
+    def __traverse(pilist: list, mf_getter: callable, depends_getter: callable, out: list):
+        """
+        Iterative depth first traversal, dependencies are added before the package which needs them
+        """
+        visited = set()
+        out_ids = set(map(id, out))
+        # Stack of (manifest, iterator on its dependencies)
+        stack = [(None, iter(pilist))]
+        while len(stack) > 0:
+            parent, children = stack[-1]
+            for pi in children:
+                if pi not in visited:
+                    visited.add(pi)
+                    mf = mf_getter(pi)
+                    if mf is not None and id(mf) not in out_ids:
+                        # Begin by adding dependencies
+                        stack.append((mf, iter(depends_getter(mf))))
+                        break
+            else:
+                stack.pop()
+                if parent is not None:
+                    out.append(parent)
+                    out_ids.add(id(parent))
+
     @staticmethod
     def __build_tree(
-        pilist: list, mfmap: dict, out: list, env: Environment = None, only_keep_latest: bool = False, ignored_pilist: list = None, ignore_unknown: bool = False
+        pilist: list,
+        mfmap: dict,
+        out: list,
+        env: Environment = None,
+        only_keep_latest: bool = False,
+        ignore_unknown: bool = False,
+        used_variables: set = None,
     ):
         """
         Build a manifest list of given PackageIdentifiers and its dependecies
+        If used_variables is given, it is filled with the variables used by the evaluated conditions
         @return: Manifest list
         """
-        if ignored_pilist is None:
-            ignored_pilist = []
-        for pi in pilist:
-            if pi not in ignored_pilist:
-                ignored_pilist.append(pi)
-                mf = find_manifest(pi, mfmap, ignore_unknown=ignore_unknown)
-                if mf is not None and mf not in out:
-                    # Begin by adding dependencies
-                    DependencyUtils.__build_tree(
-                        mf.get_depends_from_env(env), mfmap, out, env=env, ignored_pilist=ignored_pilist, ignore_unknown=ignore_unknown
-                    )
-                    out.append(mf)
+        # The env does not change during the resolution, it is flattened once and conditions are evaluated once per manifest
+        values = env.snapshot() if env is not None else None
+        depends_cache = {}
+
+        def get_depends(mf):
+            deps = depends_cache.get(id(mf))
+            if deps is None:
+                deps = mf.get_depends_from_env(values)
+                depends_cache[id(mf)] = deps
+                if used_variables is not None and env is not None:
+                    for pisc in mf.depends_packages:
+                        used_variables.update(ConditionalPackageIdentifier.parse(pisc).condition_variables)
+            return deps
+
+        DependencyUtils.__traverse(pilist, lambda pi: find_manifest(pi, mfmap, ignore_unknown=ignore_unknown), get_depends, out)
 
         if only_keep_latest:
-            # Create a MF dict overriding package to latest version previously
-            # computed
-            alt_mfmap = {}
-            for pi in mfmap:
-                latest_mf = None
-                for mf in out:
-                    if pi.name == mf.name:
-                        if latest_mf is None or mf.identifier > latest_mf.identifier:
-                            latest_mf = mf
-                alt_mfmap[pi] = latest_mf or mfmap[pi]
-            # Reset out
+            # Replace all versions of a package by the latest one previously computed
+            latest_mfmap = {}
+            for mf in out:
+                if mf.name not in latest_mfmap or mf.identifier > latest_mfmap[mf.name].identifier:
+                    latest_mfmap[mf.name] = mf
+
+            def get_latest_manifest(pi):
+                mf = find_manifest(pi, mfmap, ignore_unknown=ignore_unknown)
+                return latest_mfmap.get(mf.name, mf) if mf is not None else None
+
+            # Reset out and restart with latest versions
             del out[:]
-            # Reinvoke and give latest versions,
-            # NB reset ignored_pilist to restart algo
-            DependencyUtils.__build_tree(pilist, alt_mfmap, out, env=env, ignore_unknown=ignore_unknown)
+            DependencyUtils.__traverse(pilist, get_latest_manifest, get_depends, out)
 
     @staticmethod
-    def installed(pilist: list, ipmap: dict, env: Environment = None, only_keep_latest: bool = False, ignore_unknown: bool = False):
+    def installed(
+        pilist: list, ipmap: dict, env: Environment = None, only_keep_latest: bool = False, ignore_unknown: bool = False, used_variables: set = None
+    ):
         """
         Build a dependency list of installed packages and dependencies.
         Returns a list of InstalledPackage
         """
         out = []
-        DependencyUtils.__build_tree(pilist, ipmap, out, env=env, only_keep_latest=only_keep_latest, ignore_unknown=ignore_unknown)
+        DependencyUtils.__build_tree(
+            pilist, ipmap, out, env=env, only_keep_latest=only_keep_latest, ignore_unknown=ignore_unknown, used_variables=used_variables
+        )
         return out
 
     @staticmethod
@@ -80,7 +171,7 @@ class DependencyUtils:
         """
         out = []
         # Build a map containing all knwon packages
-        all_packages = reduce(lambda a, b: a.update(b) or a, [apmap, ipmap], {})
+        all_packages = reduce(lambda a, b: a.update(b) or a, [apmap, ipmap], PackageMap())
         # Build the list from available packages
         DependencyUtils.__build_tree(pilist, all_packages, out, env=env)
         # Remove already installed packages
@@ -105,23 +196,28 @@ class DependencyUtils:
         DependencyUtils.__build_tree(pilist, ipmap, out, env=env, ignore_unknown=True)
         # for uninstall, reverse order
         out = list(reversed(out))
+        out_ids = set(map(id, out))
 
         # Remove read only packages
         ro_packages = list(filter(lambda ip: ip.read_only, out))
         if len(ro_packages) > 0 and logger is not None and logger.isverbose():
             logger.print_verbose("System package(s) cannot be uninstalled: " + ", ".join(map(str, ro_packages)))
+        kept_ids = set(map(id, ro_packages))
 
         # Maintain dependencies
-        other_pi_list = [ip.identifier for ip in ipmap.values() if ip not in out]
+        other_pi_list = [ip.identifier for ip in ipmap.values() if id(ip) not in out_ids]
+        rdeps = None
         # Keep all configurations (ie env=None) for all other installed packages
         for needed_ip in DependencyUtils.installed(other_pi_list, ipmap, env=None, ignore_unknown=True):
-            if needed_ip in out:
+            if id(needed_ip) in out_ids:
                 if logger is not None and logger.isverbose():
                     # Print packages which needs this package
-                    rdepends = DependencyUtils.rdepends([needed_ip.identifier], ipmap, env=env)
+                    if rdeps is None:
+                        rdeps = ReverseDependencies(ipmap)
+                    rdepends = rdeps.get_dependents([needed_ip.identifier], env=env)
                     _log("Cannot uninstall {ip.identifier} (dependency of {text})".format(ip=needed_ip, text=", ".join(map(str, rdepends))))
-                out.remove(needed_ip)
-        out = [ip for ip in out if ip not in ro_packages]
+                kept_ids.add(id(needed_ip))
+        out = [ip for ip in out if id(ip) not in kept_ids]
         return out
 
     @staticmethod
@@ -132,7 +228,7 @@ class DependencyUtils:
         Returns a list of AvailablePackages
         """
         # All available packages
-        mfmap = reduce(lambda a, b: a.update(b) or a, [apmap or {}, ipmap or {}], {})
+        mfmap = reduce(lambda a, b: a.update(b) or a, [apmap or {}, ipmap or {}], PackageMap())
 
         # Get the list of prereq
         prereq_pilist = []
@@ -181,13 +277,11 @@ class DependencyUtils:
         return (install_list, uninstall_list)
 
     @staticmethod
-    def rdepends(pilist: list, mfmap: dict, env: Environment = None):
-        out = OrderedDict()
-        for pi, mf in mfmap.items():
-            try:
-                for cpi in mf.get_depends_from_env(env):
-                    if cpi in pilist and pi not in out:
-                        out[pi] = mf
-            except Exception:
-                pass
-        return out
+    def rdepends(pilist: list, mfmap: dict, env: Environment = None, rdeps: ReverseDependencies = None):
+        """
+        Return the packages of the map depending on any of the given identifiers
+        A ReverseDependencies built on the same map can be given to answer several queries
+        """
+        if rdeps is None:
+            rdeps = ReverseDependencies(mfmap)
+        return rdeps.get_dependents(pilist, env=env)
@@ -52,6 +52,11 @@ class Environment:
         self.__in_files = in_files
         self.__out_files = out_files
         self.__sub_env_list = []
+        # Environments containing this one, to invalidate their cache
+        self.__parents = []
+        # Flattened tree and variables index, computed on demand and reset when the tree is modified
+        self.__flat_envs = None
+        self.__index = None
         # Init content
         if isinstance(content, dict):
             for k, v in content.items():
@@ -62,53 +67,80 @@ class Environment:
         elif content is not None:
             raise ValueError()
 
+    def __invalidate(self):
+        if self.__flat_envs is not None or self.__index is not None:
+            self.__flat_envs = None
+            self.__index = None
+            for parent in self.__parents:
+                parent.__invalidate()
+
+    def __get_flat_envs(self) -> list:
+        """
+        All environments of the tree in activation order, sub environments first
+        """
+        if self.__flat_envs is None:
+            out = []
+            for e in self.__sub_env_list:
+                out.extend(e.__get_flat_envs())
+            out.append(self)
+            self.__flat_envs = out
+        return self.__flat_envs
+
+    def __get_index(self) -> OrderedDict:
+        """
+        Variables of the tree, ordered by first definition, the last value wins
+        """
+        if self.__index is None:
+            out = OrderedDict()
+            for e in self.__get_flat_envs():
+                for k, v in e.__values:
+                    out[k] = v
+            self.__index = out
+        return self.__index
+
     def append(self, subenv):
         if isinstance(subenv, Environment):
             self.__sub_env_list.append(subenv)
+            subenv.__parents.append(self)
+            self.__invalidate()
         elif subenv is not None:
             raise ValueError()
 
     def activate(self, comment_consumer: callable = None, kv_consumer: callable = None, file_consumer: callable = None):
-        # Start with sub env
-        for e in self.__sub_env_list:
-            e.activate(comment_consumer=comment_consumer, kv_consumer=kv_consumer, file_consumer=file_consumer)
-        # Activate self
-        if len(self.__values) > 0 or len(self.__values) > 0 or len(self.__values) > 0:
-            if self.__label and comment_consumer:
-                comment_consumer(self.__label)
-            if kv_consumer:
-                for k, v in self.__values:
-                    kv_consumer(k, v)
-            if file_consumer and self.__in_files:
-                for f in self.__in_files:
-                    file_consumer(f)
+        # Sub envs come first in the flattened tree
+        for e in self.__get_flat_envs():
+            if len(e.__values) > 0:
+                if e.__label and comment_consumer:
+                    comment_consumer(e.__label)
+                if kv_consumer:
+                    for k, v in e.__values:
+                        kv_consumer(k, v)
+                if file_consumer and e.__in_files:
+                    for f in e.__in_files:
+                        file_consumer(f)
 
     def deactivate(self, comment_consumer: callable = None, kv_consumer: callable = None, file_consumer: callable = None):
-        # Start with sub env
-        for e in self.__sub_env_list:
-            e.deactivate(comment_consumer=comment_consumer, kv_consumer=kv_consumer, file_consumer=file_consumer)
-        # Deactivate self
-        if len(self.__values) > 0 or len(self.__values) > 0 or len(self.__values) > 0:
-            if self.__label and comment_consumer:
-                comment_consumer(self.__label)
-            if file_consumer and self.__out_files:
-                for f in self.__out_files:
-                    file_consumer(f)
-            if kv_consumer:
-                for k, _ in self.__values:
-                    kv_consumer(k, REFERENCE_ENVIRON.get(k))
+        # Sub envs come first in the flattened tree
+        for e in self.__get_flat_envs():
+            if len(e.__values) > 0:
+                if e.__label and comment_consumer:
+                    comment_consumer(e.__label)
+                if file_consumer and e.__out_files:
+                    for f in e.__out_files:
+                        file_consumer(f)
+                if kv_consumer:
+                    for k, _ in e.__values:
+                        kv_consumer(k, REFERENCE_ENVIRON.get(k))
 
     def print_env(self, kv_consumer: callable = None, comment_consumer: callable = None):
-        # Start with sub env
-        for e in self.__sub_env_list:
-            e.print_env(kv_consumer, comment_consumer)
-        # Print self
-        if len(self.__values) > 0 or len(self.__values) > 0 or len(self.__values) > 0:
-            if self.__label is not None and comment_consumer is not None:
-                comment_consumer(self.__label)
-            if kv_consumer is not None:
-                for k, v in self.__values:
-                    kv_consumer(k, v)
+        # Sub envs come first in the flattened tree
+        for e in self.__get_flat_envs():
+            if len(e.__values) > 0:
+                if e.__label is not None and comment_consumer is not None:
+                    comment_consumer(e.__label)
+                if kv_consumer is not None:
+                    for k, v in e.__values:
+                        kv_consumer(k, v)
 
     def find_setting(self, setting: LeafSetting) -> str:
         out = self.find_value(setting.key)
@@ -118,30 +150,23 @@ class Environment:
         return out if out is not None else setting.value
 
     def find_value(self, key: str):
-        def visitor(k, v):
-            if k == key:
-                values.append(v)
+        return self.__get_index().get(key)
 
-        values = []
-        self.activate(kv_consumer=visitor)
-        return values[-1] if len(values) > 0 else None
+    def snapshot(self) -> dict:
+        """
+        Return all variables as a flat dict, the last value wins like with find_value
+        The dict is not updated if the environment changes
+        """
+        return dict(self.__get_index())
 
     def is_set(self, key):
-        # First search value in sub envs
-        for e in self.__sub_env_list:
-            if e.is_set(key):
-                return True
-        # Search value in self values
-        for k, _ in self.__values:
-            if k == key:
-                return True
-        return False
+        return key in self.__get_index()
 
     def unset_variable(self, key, reccursive=True):
-        self.__values = list(filter(lambda kv: kv[0] != key, self.__values))
-        if reccursive:
-            for c in self.__sub_env_list:
-                c.unset_variable(key, reccursive=reccursive)
+        for e in self.__get_flat_envs() if reccursive else (self,):
+            if any(k == key for k, _ in e.__values):
+                e.__values = [kv for kv in e.__values if kv[0] != key]
+                e.__invalidate()
 
     def set_variable(self, key, value, replace=False, prepend=False):
         if value is None:
@@ -152,25 +177,30 @@ class Environment:
             self.__values.insert(0, (key, value))
         else:
             self.__values.append((key, value))
+        self.__invalidate()
 
     def generate_scripts(self, activate_file: Path = None, deactivate_file: Path = None):
         """
         Generates environment script to activate and desactivate a profile
         """
         if activate_file is not None:
+            lines = []
+            self.activate(
+                comment_consumer=lambda c: lines.append(Environment.tostring_comment(c)),
+                kv_consumer=lambda k, v: lines.append(Environment.tostring_export(k, v)),
+                file_consumer=lambda f: lines.append(Environment.tostring_file(f)),
+            )
             with activate_file.open("w") as fp:
-                self.activate(
-                    comment_consumer=lambda c: fp.write(Environment.tostring_comment(c) + "\n"),
-                    kv_consumer=lambda k, v: fp.write(Environment.tostring_export(k, v) + "\n"),
-                    file_consumer=lambda f: fp.write(Environment.tostring_file(f) + "\n"),
-                )
+                fp.write("".join(line + "\n" for line in lines))
         if deactivate_file is not None:
+            lines = []
+            self.deactivate(
+                comment_consumer=lambda c: lines.append(Environment.tostring_comment(c)),
+                kv_consumer=lambda k, v: lines.append(Environment.tostring_export(k, v)),
+                file_consumer=lambda f: lines.append(Environment.tostring_file(f)),
+            )
             with deactivate_file.open("w") as fp:
-                self.deactivate(
-                    comment_consumer=lambda c: fp.write(Environment.tostring_comment(c) + "\n"),
-                    kv_consumer=lambda k, v: fp.write(Environment.tostring_export(k, v) + "\n"),
-                    file_consumer=lambda f: fp.write(Environment.tostring_file(f) + "\n"),
-                )
+                fp.write("".join(line + "\n" for line in lines))
 
 
 class IEnvProvider(ABC):
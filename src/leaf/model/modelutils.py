@@ -1,12 +1,96 @@
 import operator
 import subprocess
+from bisect import bisect_left
 from builtins import sorted
+from collections import OrderedDict
 
 from leaf.core.constants import LeafConstants, LeafSettings
 from leaf.core.error import InvalidPackageNameException
 from leaf.core.utils import CURRENT_LEAF_VERSION
 from leaf.model.environment import Environment
-from leaf.model.package import PackageIdentifier
+from leaf.model.package import PI_KEY_GETTER, PackageIdentifier
+
+
+class PackageMap(OrderedDict):
+
+    """
+    PackageIdentifier/Manifest map, which also indexes the identifiers by package name.
+    Versions of each package are kept sorted, so the latest version is found without scanning the whole map.
+    """
+
+    def __init__(self, *args, **kwargs):
+        # name -> ([version keys], [identifiers]), both sorted
+        self.__names = {}
+        OrderedDict.__init__(self, *args, **kwargs)
+
+    def __index_add(self, pi: PackageIdentifier):
+        keys, pilist = self.__names.setdefault(pi.name, ([], []))
+        vkey = pi.get_version().key
+        i = bisect_left(keys, vkey)
+        if i < len(keys) and keys[i] == vkey:
+            pilist[i] = pi
+        else:
+            keys.insert(i, vkey)
+            pilist.insert(i, pi)
+
+    def __index_remove(self, pi: PackageIdentifier):
+        keys, pilist = self.__names.get(pi.name, ([], []))
+        vkey = pi.get_version().key
+        i = bisect_left(keys, vkey)
+        if i < len(keys) and keys[i] == vkey:
+            del keys[i]
+            del pilist[i]
+            if len(keys) == 0:
+                del self.__names[pi.name]
+
+    def __setitem__(self, pi, mf):
+        if not isinstance(pi, PackageIdentifier):
+            raise ValueError("Invalid package identifier: {pi}".format(pi=pi))
+        OrderedDict.__setitem__(self, pi, mf)
+        self.__index_add(pi)
+
+    def __delitem__(self, pi):
+        OrderedDict.__delitem__(self, pi)
+        self.__index_remove(pi)
+
+    def pop(self, pi, *args):
+        if pi in self:
+            self.__index_remove(pi)
+        return OrderedDict.pop(self, pi, *args)
+
+    def popitem(self, last=True):
+        out = OrderedDict.popitem(self, last=last)
+        self.__index_remove(out[0])
+        return out
+
+    def setdefault(self, pi, default=None):
+        if pi not in self:
+            self[pi] = default
+        return self[pi]
+
+    def clear(self):
+        OrderedDict.clear(self)
+        self.__names.clear()
+
+    @property
+    def names(self) -> list:
+        """
+        Names of the packages in the map, sorted
+        """
+        return sorted(self.__names.keys())
+
+    def get_versions(self, name: str) -> list:
+        """
+        Identifiers of the given package, sorted by version
+        """
+        return list(self.__names.get(name, ([], []))[1])
+
+    def get_latest(self, name: str) -> PackageIdentifier:
+        """
+        Identifier with the highest version of the given package, or None
+        """
+        pilist = self.__names.get(name, ([], []))[1]
+        return pilist[-1] if len(pilist) > 0 else None
 
 
 def check_leaf_min_version(mflist: list):
@@ -64,11 +148,11 @@ def find_latest_version(pi_or_name, pilist, ignore_unknown=False):
     """
     Use given package name to return the PackageIdentifier with the highest version
     """
-    out = None
     piname = pi_or_name.name if isinstance(pi_or_name, PackageIdentifier) else str(pi_or_name)
-    for pi in [pi for pi in pilist if pi.name == piname]:
-        if out is None or pi > out:
-            out = pi
+    if isinstance(pilist, PackageMap):
+        out = pilist.get_latest(piname)
+    else:
+        out = max((pi for pi in pilist if pi.name == piname), key=PI_KEY_GETTER, default=None)
     if out is None and not ignore_unknown:
         raise InvalidPackageNameException(pi_or_name)
     return out
@@ -82,7 +166,7 @@ def find_manifest(pi, mfmap, ignore_unknown=False):
     if not isinstance(mfmap, dict):
         raise ValueError()
     if is_latest_package(pi):
-        pi = find_latest_version(pi, mfmap.keys(), ignore_unknown=True)
+        pi = find_latest_version(pi, mfmap if isinstance(mfmap, PackageMap) else mfmap.keys(), ignore_unknown=True)
     if pi in mfmap:
         return mfmap[pi]
     if not ignore_unknown:
@@ -119,11 +203,13 @@ def group_package_identifiers_by_name(pilist, pkgmap=None) -> dict:
 
 
 def keep_latest(pilist: list) -> list:
+    if isinstance(pilist, PackageMap):
+        return [pilist.get_latest(name) for name in pilist.names]
     pkgmap = {}
     for pi in pilist:
-        if pi.name not in pkgmap or pi > pkgmap[pi.name]:
+        if pi.name not in pkgmap or pi.key > pkgmap[pi.name].key:
             pkgmap[pi.name] = pi
-    return sorted(pkgmap.values())
+    return sorted(pkgmap.values(), key=PI_KEY_GETTER)
 
 
 def keep_latest_mf(mflist: list) -> list:
@@ -7,11 +7,10 @@ Leaf Package Manager
 @license:   https://www.mozilla.org/en-US/MPL/2.0/
 """
 
-import io
 import operator
 import re
 from collections import OrderedDict
-from functools import total_ordering
+from functools import lru_cache, partial, total_ordering
 from pathlib import Path
 from tarfile import TarFile
 
@@ -21,13 +20,15 @@ from pkg_resources import resource_string
 from leaf.core.constants import JsonConstants, LeafFiles
 from leaf.core.download import url_resolve
 from leaf.core.error import InvalidPackageNameException, LeafException
-from leaf.core.jsonutils import JsonObject, jload, jloadfile, jloads
+from leaf.core.jsonutils import JsonObject, jloadfile, jloads, jwritefile
+from leaf.core.logger import print_trace
 from leaf.core.utils import Version
 from leaf.model.environment import Environment, IEnvProvider
 from leaf.model.help import HelpTopic
 from leaf.model.settings import ScopeSetting
 
 IDENTIFIER_GETTER = operator.attrgetter("identifier")
+PI_KEY_GETTER = operator.attrgetter("key")
 
 
 @total_ordering
@@ -37,13 +38,15 @@ class PackageIdentifier:
     VERSION_PATTERN = "[a-zA-Z0-9][-._a-zA-Z0-9]*"
     SEPARATOR = "_"
 
+    __slots__ = ("__name", "__version", "__version_object")
+
     @staticmethod
     def is_valid_identifier(pis: str) -> bool:
         if isinstance(pis, str):
             split = pis.partition(PackageIdentifier.SEPARATOR)
             if len(split) == 3:
-                if re.compile(PackageIdentifier.NAME_PATTERN).fullmatch(split[0]) is not None:
-                    if re.compile(PackageIdentifier.VERSION_PATTERN).fullmatch(split[2]) is not None:
+                if _NAME_REGEX.fullmatch(split[0]) is not None:
+                    if _VERSION_REGEX.fullmatch(split[2]) is not None:
                         return True
         return False
 
@@ -51,20 +54,20 @@ class PackageIdentifier:
     def parse(pis: str):
         if not PackageIdentifier.is_valid_identifier(pis):
             raise InvalidPackageNameException(pis)
-        split = pis.partition(PackageIdentifier.SEPARATOR)
-        return PackageIdentifier(split[0], split[2])
+        return _parse_identifier(pis)
 
     @staticmethod
     def parse_list(pislist: list):
         return [PackageIdentifier.parse(pis) for pis in pislist]
 
     def __init__(self, name: str, version: str):
-        if re.compile(PackageIdentifier.NAME_PATTERN).fullmatch(name) is None:
+        if _NAME_REGEX.fullmatch(name) is None:
             raise ValueError("Invalid package name: " + name)
-        if re.compile(PackageIdentifier.VERSION_PATTERN).fullmatch(version) is None:
+        if _VERSION_REGEX.fullmatch(version) is None:
             raise ValueError("Invalid package version: " + version)
         self.__name = name
         self.__version = version
+        self.__version_object = None
 
     @property
     def name(self):
@@ -75,25 +78,32 @@ class PackageIdentifier:
         return self.__version
 
     def get_version(self):
-        return Version(self.__version)
+        if self.__version_object is None:
+            self.__version_object = Version(self.__version)
+        return self.__version_object
+
+    @property
+    def key(self) -> tuple:
+        """
+        Sort key, consistent with equality and hash
+        """
+        return (self.__name, self.get_version().key)
 
     def __str__(self):
         return self.name + PackageIdentifier.SEPARATOR + self.version
 
     def __hash__(self):
-        return hash((self.name, self.version))
+        return hash(self.key)
 
     def __eq__(self, other):
         if not isinstance(other, PackageIdentifier):
             return NotImplemented
-        return self.name == other.name and self.get_version() == other.get_version()
+        return self.key == other.key
 
     def __lt__(self, other):
         if not isinstance(other, PackageIdentifier):
             return NotImplemented
-        if not self.name == other.name:
-            return self.name < other.name
-        return self.get_version() < other.get_version()
+        return self.key < other.key
 
 
 class ConditionalPackageIdentifier(PackageIdentifier):
@@ -102,56 +112,108 @@ class ConditionalPackageIdentifier(PackageIdentifier):
     COND_SET = "(!)?([A-Za-z0-9_]+)"
     COND_EQ = "([A-Za-z0-9_]+)(=|!=|~|!~)(.+)"
 
+    __slots__ = ("__conditions", "__compiled_conditions")
+
     @staticmethod
     def parse(pisc: str):
-        p = re.compile(
-            "({name}){separator}({version})({conditions})*".format(
-                name=PackageIdentifier.NAME_PATTERN,
-                separator=PackageIdentifier.SEPARATOR,
-                version=PackageIdentifier.VERSION_PATTERN,
-                conditions=ConditionalPackageIdentifier.CONDITION_PATTERN,
-            )
-        )
-        m = p.fullmatch(pisc)
-        if m is None:
+        if not isinstance(pisc, str):
             raise ValueError("Invalid conditional package identifier: {pi}".format(pi=pisc))
-        conditions = re.compile(ConditionalPackageIdentifier.CONDITION_PATTERN).findall(pisc)
-        return ConditionalPackageIdentifier(m.group(1), m.group(2), conditions)
+        return _parse_conditional_identifier(pisc)
 
     def __init__(self, name: str, version: str, conditions: list):
         PackageIdentifier.__init__(self, name, version)
         self.__conditions = conditions
+        self.__compiled_conditions = tuple(_compile_condition(cond) for cond in conditions) if conditions is not None else ()
 
     @property
     def conditions(self):
-        return self.__conditions
+        return list(self.__conditions) if self.__conditions is not None else None
 
-    def are_conditions_satified(self, env: Environment) -> bool:
-        if self.__conditions is None:
+    @property
+    def condition_variables(self) -> list:
+        """
+        Names of the variables used by the conditions
+        """
+        out = []
+        for op, key, _ in self.__compiled_conditions:
+            if op is not None and key not in out:
+                out.append(key)
+        return out
+
+    def are_conditions_satified(self, env: Environment or dict) -> bool:
+        """
+        Evaluate the conditions with the given environment or with a dict built by Environment.snapshot
+        """
+        if len(self.__compiled_conditions) == 0:
             return True
-        for cond in self.__conditions:
-            if not self.__is_condition_satified(cond, env):
+        values = env.snapshot() if isinstance(env, Environment) else env
+        for cond in self.__compiled_conditions:
+            if not _evaluate_condition(cond, values):
                 return False
         return True
 
-    def __is_condition_satified(self, cond: str, env: Environment) -> bool:
-        m = re.compile(ConditionalPackageIdentifier.COND_SET).fullmatch(cond)
-        if m is not None:
-            return (m.group(1) is None) ^ (env.find_value(m.group(2)) is None)
 
-        m = re.compile(ConditionalPackageIdentifier.COND_EQ).fullmatch(cond)
-        if m is not None:
-            value = env.find_value(m.group(1))
-            if m.group(2) == "!=":
-                return value != m.group(3)
-            elif m.group(2) == "=":
-                return value == m.group(3)
-            elif m.group(2) == "~":
-                return value is not None and m.group(3).lower() in value.lower()
-            elif m.group(2) == "!~":
-                return value is None or m.group(3).lower() not in value.lower()
+_NAME_REGEX = re.compile(PackageIdentifier.NAME_PATTERN)
+_VERSION_REGEX = re.compile(PackageIdentifier.VERSION_PATTERN)
+_CONDITIONAL_IDENTIFIER_REGEX = re.compile(
+    "({name}){separator}({version})({conditions})*".format(
+        name=PackageIdentifier.NAME_PATTERN,
+        separator=PackageIdentifier.SEPARATOR,
+        version=PackageIdentifier.VERSION_PATTERN,
+        conditions=ConditionalPackageIdentifier.CONDITION_PATTERN,
+    )
+)
+_CONDITION_REGEX = re.compile(ConditionalPackageIdentifier.CONDITION_PATTERN)
+_COND_SET_REGEX = re.compile(ConditionalPackageIdentifier.COND_SET)
+_COND_EQ_REGEX = re.compile(ConditionalPackageIdentifier.COND_EQ)
+
 
-        raise ValueError("Unknown condition: {cond}".format(cond=cond))
+# Identifiers are immutable, parsed instances are shared
+@lru_cache(maxsize=16384)
+def _parse_identifier(pis: str) -> PackageIdentifier:
+    split = pis.partition(PackageIdentifier.SEPARATOR)
+    return PackageIdentifier(split[0], split[2])
+
+
+@lru_cache(maxsize=4096)
+def _parse_conditional_identifier(pisc: str) -> ConditionalPackageIdentifier:
+    m = _CONDITIONAL_IDENTIFIER_REGEX.fullmatch(pisc)
+    if m is None:
+        raise ValueError("Invalid conditional package identifier: {pi}".format(pi=pisc))
+    return ConditionalPackageIdentifier(m.group(1), m.group(2), tuple(_CONDITION_REGEX.findall(pisc)))
+
+
+@lru_cache(maxsize=1024)
+def _compile_condition(cond: str) -> tuple:
+    """
+    Parse a condition as an (operator, variable, value) tuple, the operator is None for unknown conditions
+    """
+    m = _COND_SET_REGEX.fullmatch(cond)
+    if m is not None:
+        return ("unset" if m.group(1) else "set", m.group(2), None)
+    m = _COND_EQ_REGEX.fullmatch(cond)
+    if m is not None:
+        op, value = m.group(2), m.group(3)
+        return (op, m.group(1), value.lower() if op in ("~", "!~") else value)
+    return (None, None, cond)
+
+
+def _evaluate_condition(cond: tuple, values: dict) -> bool:
+    op, key, expected = cond
+    value = values.get(key)
+    if op == "set":
+        return value is not None
+    if op == "unset":
+        return value is None
+    if op == "=":
+        return value == expected
+    if op == "!=":
+        return value != expected
+    if op == "~":
+        return value is not None and expected in value.lower()
+    if op == "!~":
+        return value is None or expected not in value.lower()
+    raise ValueError("Unknown condition: {cond}".format(cond=expected))
 
 
 class Manifest(JsonObject):
@@ -163,8 +225,8 @@ class Manifest(JsonObject):
     def parse(mffile: Path):
         return Manifest(jloadfile(mffile))
 
-    def __init__(self, json: dict):
-        JsonObject.__init__(self, json)
+    def __init__(self, json: dict, loader: callable = None):
+        JsonObject.__init__(self, json, loader=loader)
         self.__custom_tags = []
 
     def validate_model(self):
@@ -236,7 +298,13 @@ class Manifest(JsonObject):
     def auto_upgrade(self):
         return self.jsonpath([JsonConstants.INFO, JsonConstants.INFO_AUTOUPGRADE])
 
-    def get_depends_from_env(self, env: Environment):
+    def get_depends_from_env(self, env: Environment or dict):
+        """
+        Return the dependencies matching the given environment (or Environment.snapshot dict), all dependencies if env is None
+        """
+        if isinstance(env, Environment):
+            # Flatten the environment once for all conditions
+            env = env.snapshot()
         out = []
         for pisc in self.depends_packages:
             cpi = ConditionalPackageIdentifier.parse(pisc)
@@ -252,32 +320,129 @@ class LeafArtifact(Manifest):
 
     """
     Represent a tar/xz or a single manifest.json file
+    When the manifest is the first member of the archive, only this member is read.
+    Otherwise, or when the members are needed, the archive is read once as a stream to get its manifest, its members and its total size.
+    If a scan file is given, this result is stored in it and reused as long as the archive is not modified.
     """
 
+    KEY_PATH = "path"
+    KEY_SIZE = "size"
+    KEY_MTIME = "mtime"
+    KEY_MANIFEST = "manifest"
+    KEY_MEMBERS = "members"
+    KEY_TOTALSIZE = "totalSize"
+    # By order of preference
+    MANIFEST_NAMES = (LeafFiles.MANIFEST, "./" + LeafFiles.MANIFEST)
+
     @staticmethod
-    def __find_manifest(tarfile):
-        for prefix in ("", "./"):
-            out = prefix + LeafFiles.MANIFEST
-            if out in tarfile.getnames():
-                return out
+    def __read_first_manifest(path: Path) -> dict:
+        with TarFile.open(str(path), "r|*") as tarfile:
+            ti = tarfile.next()
+            if ti is not None and ti.isfile() and ti.name in LeafArtifact.MANIFEST_NAMES:
+                return jloads(tarfile.extractfile(ti).read().decode())
+        return None
+
+    @staticmethod
+    def __scan(path: Path, stat) -> OrderedDict:
+        manifests = {}
+        members = []
+        total_size = 0
+        with TarFile.open(str(path), "r|*") as tarfile:
+            for ti in tarfile:
+                members.append(ti.name)
+                total_size += ti.size
+                if ti.name in LeafArtifact.MANIFEST_NAMES:
+                    manifests[ti.name] = jloads(tarfile.extractfile(ti).read().decode())
+        for name in LeafArtifact.MANIFEST_NAMES:
+            if name in manifests:
+                return OrderedDict(
+                    (
+                        (LeafArtifact.KEY_PATH, str(Path(str(path)).absolute())),
+                        (LeafArtifact.KEY_SIZE, stat.st_size),
+                        (LeafArtifact.KEY_MTIME, stat.st_mtime_ns),
+                        (LeafArtifact.KEY_MANIFEST, manifests[name]),
+                        (LeafArtifact.KEY_MEMBERS, members),
+                        (LeafArtifact.KEY_TOTALSIZE, total_size),
+                    )
+                )
         raise ValueError("Cannot find {file} in package".format(file=LeafFiles.MANIFEST))
 
-    def __init__(self, path):
+    @staticmethod
+    def __read_scan(scan_file: Path, stat) -> dict:
+        if scan_file.is_file():
+            try:
+                out = jloadfile(scan_file)
+                if out.get(LeafArtifact.KEY_SIZE) == stat.st_size and out.get(LeafArtifact.KEY_MTIME) == stat.st_mtime_ns:
+                    return out
+            except ValueError:
+                print_trace("Invalid artifact scan file {file}".format(file=scan_file))
+        return None
+
+    @staticmethod
+    def is_scan_outdated(scan_file: Path) -> bool:
+        """
+        Check if the artifact of the given scan file has been removed or modified since it was scanned
+        """
+        try:
+            scan = jloadfile(scan_file)
+            stat = Path(scan[LeafArtifact.KEY_PATH]).stat()
+            return scan.get(LeafArtifact.KEY_SIZE) != stat.st_size or scan.get(LeafArtifact.KEY_MTIME) != stat.st_mtime_ns
+        except (ValueError, KeyError, TypeError, OSError):
+            return True
+
+    @staticmethod
+    def __write_scan(scan_file: Path, scan: dict):
+        try:
+            scan_file.parent.mkdir(parents=True, exist_ok=True)
+            tmpfile = scan_file.parent / (scan_file.name + ".tmp")
+            jwritefile(tmpfile, scan)
+            tmpfile.replace(scan_file)
+        except OSError:
+            print_trace("Cannot write artifact scan file {file}".format(file=scan_file))
+
+    def __init__(self, path, scan_file: Path = None):
         self.__path = path
-        with TarFile.open(str(self.__path), "r") as tarfile:
-            mf = LeafArtifact.__find_manifest(tarfile)
-            Manifest.__init__(self, jload(io.TextIOWrapper(tarfile.extractfile(mf))))
+        self.__scan_file = scan_file
+        self.__members = None
+        self.__total_size = None
+        stat = Path(str(path)).stat()
+        scan = LeafArtifact.__read_scan(scan_file, stat) if scan_file is not None else None
+        if scan is not None:
+            self.__members = scan[LeafArtifact.KEY_MEMBERS]
+            self.__total_size = scan[LeafArtifact.KEY_TOTALSIZE]
+            manifest = scan[LeafArtifact.KEY_MANIFEST]
+        else:
+            manifest = LeafArtifact.__read_first_manifest(path)
+            if manifest is None:
+                # The manifest can be anywhere, read the whole archive
+                manifest = self.__scan_archive(stat)
+        Manifest.__init__(self, manifest)
+
+    def __scan_archive(self, stat=None) -> dict:
+        scan = LeafArtifact.__scan(self.__path, stat or Path(str(self.__path)).stat())
+        if self.__scan_file is not None:
+            LeafArtifact.__write_scan(self.__scan_file, scan)
+        self.__members = scan[LeafArtifact.KEY_MEMBERS]
+        self.__total_size = scan[LeafArtifact.KEY_TOTALSIZE]
+        return scan[LeafArtifact.KEY_MANIFEST]
 
     @property
     def path(self):
         return self.__path
 
+    @property
+    def members(self) -> list:
+        """
+        Names of the archive members, in archive order
+        """
+        if self.__members is None:
+            self.__scan_archive()
+        return list(self.__members)
+
     def get_total_size(self):
-        out = 0
-        with TarFile.open(str(self.__path), "r") as tarfile:
-            for ti in tarfile.getmembers():
-                out += ti.size
-        return out
+        if self.__total_size is None:
+            self.__scan_archive()
+        return self.__total_size
 
 
 class AvailablePackage(Manifest):
@@ -318,6 +483,14 @@ class AvailablePackage(Manifest):
             out += [t for t in c.tags if t not in out]
         return out
 
+    def copy(self):
+        """
+        Return a new instance sharing the same json content and duplicates, custom tags are not copied
+        """
+        out = AvailablePackage(self.json, remote=self.remote)
+        out.__duplicates = list(self.__duplicates)
+        return out
+
     def add_duplicate(self, dupp_ap):
         if not isinstance(dupp_ap, AvailablePackage):
             raise ValueError()
@@ -344,14 +517,26 @@ class InstalledPackage(Manifest, IEnvProvider):
     Represent an installed package
     """
 
-    def __init__(self, mffile: Path, read_only=False):
-        Manifest.__init__(self, jloadfile(mffile))
-        IEnvProvider.__init__(self, "package {pi}".format(pi=self.identifier))
+    def __init__(self, mffile: Path, read_only=False, identifier: PackageIdentifier = None):
+        """
+        If the identifier is known, the manifest is only parsed when its content is needed
+        """
+        if identifier is None:
+            Manifest.__init__(self, jloadfile(mffile))
+            identifier = Manifest.identifier.fget(self)
+        else:
+            Manifest.__init__(self, None, loader=partial(jloadfile, mffile))
+        self.__identifier = identifier
+        IEnvProvider.__init__(self, "package {pi}".format(pi=identifier))
         self.__folder = mffile.parent
         self.__read_only = read_only
         if read_only:
             self.custom_tags.append("system")
 
+    @property
+    def identifier(self):
+        return self.__identifier
+
     @property
     def folder(self):
         return self.__folder
@@ -21,6 +21,8 @@ class Remote(JsonObject):
         JsonObject.__init__(self, json)
         self.__alias = alias
         self.__content = content
+        self.__content_loader = None
+        self.__available_packages = None
 
     @property
     def alias(self):
@@ -28,11 +30,24 @@ class Remote(JsonObject):
 
     @property
     def content(self):
+        if self.__content_loader is not None:
+            loader, self.__content_loader = self.__content_loader, None
+            self.__content = loader()
         return self.__content
 
     @content.setter
     def content(self, content):
+        self.__content_loader = None
         self.__content = content
+        self.__available_packages = None
+
+    def set_content_loader(self, loader: callable):
+        """
+        The content will be loaded with the given function on first access
+        """
+        self.__content = None
+        self.__content_loader = loader
+        self.__available_packages = None
 
     @property
     def enabled(self):
@@ -84,11 +99,9 @@ class Remote(JsonObject):
     def available_packages(self) -> list:
         if not self.is_fetched:
             raise LeafException("Remote is not fetched")
-        out = []
-        for json in JsonObject(self.content).jsonget(JsonConstants.REMOTE_PACKAGES, []):
-            ap = AvailablePackage(json, remote=self)
-            out.append(ap)
-        return out
+        if self.__available_packages is None:
+            self.__available_packages = [AvailablePackage(json, remote=self) for json in JsonObject(self.content).jsonget(JsonConstants.REMOTE_PACKAGES, [])]
+        return list(self.__available_packages)
 
     def __lt__(self, other):
         if not isinstance(other, Remote):
@@ -14,15 +14,18 @@ class VariableResolver:
         name=PackageIdentifier.NAME_PATTERN, separator=PackageIdentifier.SEPARATOR, version=PackageIdentifier.VERSION_PATTERN
     )
 
-    def __init__(self, current_package: InstalledPackage = None, other_packages: list = None):
+    def __init__(self, current_package: InstalledPackage = None, other_packages: list or dict = None):
         self.__current_package = current_package
         self.__all_packages = {}
 
-        if other_packages is not None:
-            for pkg in other_packages:
+        if isinstance(other_packages, dict) and (current_package is None or other_packages.get(current_package.identifier) is current_package):
+            # The identifier/package map already contains the current package, share it
+            self.__all_packages = other_packages
+        else:
+            for pkg in (other_packages.values() if isinstance(other_packages, dict) else other_packages) or []:
                 self.__all_packages[pkg.identifier] = pkg
-        if current_package is not None:
-            self.__all_packages[current_package.identifier] = current_package
+            if current_package is not None:
+                self.__all_packages[current_package.identifier] = current_package
 
     def get_value(self, var: str, pis: str):
         pkg = None
@@ -6,8 +6,9 @@ import operator
 from collections import OrderedDict
 
 from leaf.core.constants import LeafFiles
-from leaf.model.dependencies import DependencyUtils
+from leaf.model.dependencies import DependencyUtils, ReverseDependencies
 from leaf.model.environment import Environment
+from leaf.model.modelutils import PackageMap
 from leaf.model.package import IDENTIFIER_GETTER, AvailablePackage, InstalledPackage, Manifest, PackageIdentifier
 from leaf.model.remote import Remote
 from tests.testutils import TEST_REMOTE_PACKAGE_SOURCE, LeafTestCase
@@ -222,3 +223,44 @@ class TestApiDepends(LeafTestCase):
 
             pilist = DependencyUtils.rdepends(PackageIdentifier.parse_list(["condition-B_1.0"]), {})
             self.assertEqual([], list(map(str, pilist)))
+
+    def test_reverse_dependencies(self):
+        rdeps = ReverseDependencies(APMAP)
+        for pis, env, expected in (
+            ("condition-A_1.0", None, ["condition_1.0"]),
+            ("condition-A_1.0", Environment(None, {}), []),
+            ("condition-B_1.0", Environment(None, {}), ["condition_1.0"]),
+            ("container-E_1.0", None, ["container-B_1.0"]),
+            ("unknown_1.0", None, []),
+        ):
+            pilist = PackageIdentifier.parse_list([pis])
+            self.assertEqual(expected, list(map(str, DependencyUtils.rdepends(pilist, APMAP, env=env, rdeps=rdeps))))
+            self.assertEqual(expected, list(map(str, DependencyUtils.rdepends(pilist, APMAP, env=env))))
+        # Result follows the map order
+        pilist = PackageIdentifier.parse_list(["container-E_1.0", "condition-A_1.0"])
+        self.assertEqual(["condition_1.0", "container-B_1.0"], list(map(str, rdeps.get_dependents(pilist))))
+
+        # Manifests with invalid conditions are ignored
+        apmap = PackageMap()
+        for ap in (
+            AvailablePackage({"info": {"name": "a", "version": "1.0", "depends": ["b_1.0(FOO BAR)"]}}),
+            AvailablePackage({"info": {"name": "c", "version": "1.0", "depends": ["b_1.0"]}}),
+            AvailablePackage({"info": {"name": "d", "version": "1.0", "depends": ["b_1.0(FOO=1)", "e_1.0(=1)"]}}),
+        ):
+            apmap[ap.identifier] = ap
+        pilist = PackageIdentifier.parse_list(["b_1.0"])
+        self.assertEqual(["a_1.0", "c_1.0", "d_1.0"], list(map(str, DependencyUtils.rdepends(pilist, apmap))))
+        self.assertEqual(["c_1.0"], list(map(str, DependencyUtils.rdepends(pilist, apmap, env=Environment(None, {})))))
+        # Even if the invalid condition is on another dependency
+        self.assertEqual(["c_1.0"], list(map(str, DependencyUtils.rdepends(pilist, apmap, env=Environment(None, {"FOO": "1"})))))
+
+    def test_deep_dependencies(self):
+        # Longer than the python recursion limit
+        count = 5000
+        apmap = PackageMap()
+        for i in range(count):
+            depends = ["chain-{0}_latest".format(i + 1)] if i + 1 < count else ["chain-0_1.0"]
+            ap = AvailablePackage({"info": {"name": "chain-{0}".format(i), "version": "1.0", "depends": depends}})
+            apmap[ap.identifier] = ap
+        deps = DependencyUtils.installed(PackageIdentifier.parse_list(["chain-0_1.0"]), apmap, only_keep_latest=True)
+        self.assertEqual(["chain-{0}_1.0".format(i) for i in reversed(range(count))], deps2strlist(deps))
@@ -84,3 +84,32 @@ class TestApiEnvironment(LeafTestCase):
         env.generate_scripts(activate_file=self.volatile_folder / "activate.sh", deactivate_file=self.volatile_folder / "deactivate.sh")
         self.assertFileContentEquals(self.volatile_folder / "activate.sh", "activate.out")
         self.assertFileContentEquals(self.volatile_folder / "deactivate.sh", "deactivate.out")
+
+    def test_cache(self):
+        env = Environment("root", content=[("A", "root")])
+        subenv = Environment("sub", content=[("A", "sub"), ("B", "sub")])
+        env.append(subenv)
+        self.assertEqual("root", env.find_value("A"))
+        self.assertEqual("sub", env.find_value("B"))
+        self.assertTrue(env.is_set("B"))
+        self.assertFalse(env.is_set("C"))
+
+        # Modifying a sub environment updates its parents
+        subsubenv = Environment("subsub")
+        subenv.append(subsubenv)
+        subsubenv.set_variable("C", "subsub")
+        self.assertEqual("subsub", env.find_value("C"))
+        subenv.set_variable("B", "sub2", replace=True)
+        self.assertEqual("sub2", env.find_value("B"))
+        self.assertEqual({"A": "root", "B": "sub2", "C": "subsub"}, env.snapshot())
+
+        env.unset_variable("A", reccursive=False)
+        self.assertEqual("sub", env.find_value("A"))
+        env.unset_variable("A")
+        self.assertIsNone(env.find_value("A"))
+        self.assertFalse(env.is_set("A"))
+        self.assertIsNone(subenv.find_value("A"))
+
+        lines = []
+        env.print_env(kv_consumer=lambda k, v: lines.append("{0}={1}".format(k, v)), comment_consumer=lines.append)
+        self.assertEqual(["subsub", "C=subsub", "sub", "B=sub2"], lines)
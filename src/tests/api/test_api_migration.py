@@ -25,6 +25,7 @@ class TestApiMigration(LeafTestCase):
     def force_version(self, version):
         self.assertEqual(CURRENT_LEAF_VERSION._Version__version, CURRENT_LEAF_VERSION.value)
         CURRENT_LEAF_VERSION._Version__version = version
+        CURRENT_LEAF_VERSION._Version__key = None
         self.assertEqual(CURRENT_LEAF_VERSION.value, version)
 
     def test_updaters(self):
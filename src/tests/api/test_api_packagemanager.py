@@ -4,6 +4,7 @@
 
 import os
 import random
+import shutil
 import socketserver
 import sys
 import time
@@ -11,15 +12,21 @@ import unittest
 from datetime import datetime, timedelta
 from http.server import SimpleHTTPRequestHandler
 from multiprocessing import Process
+from tarfile import TarFile
 from time import sleep
 
 from leaf.api import PackageManager
+from leaf.core import extract
+from leaf.core.cache import DownloadCache
+from leaf.core.constants import LeafFiles, LeafSettings
+from leaf.core.download import create_http_session
 from leaf.core.error import (InvalidHashException, InvalidPackageNameException,
                              LeafException, LeafOutOfDateException,
                              NoEnabledRemoteException, NoRemoteException,
                              PrereqException)
+from leaf.core.jsonutils import jloadcache, jloadfile, jwritefile
 from leaf.core.settings import EnvVar
-from leaf.core.utils import NotEnoughSpaceException, is_folder_ignored
+from leaf.core.utils import NotEnoughSpaceException, is_folder_ignored, rmtree_force
 from leaf.model.dependencies import DependencyUtils
 from leaf.model.environment import Environment
 from leaf.model.package import (AvailablePackage, InstalledPackage,
@@ -60,6 +67,55 @@ class TestApiPackageManager(LeafTestCaseWithRepo):
         self.pm.install_packages(PackageIdentifier.parse_list(pislist))
         self.check_content(self.pm.list_installed_packages(), pislist)
 
+    def test_installed_packages_index(self):
+        self.pm.install_packages(PackageIdentifier.parse_list(["container-A_1.0"]))
+        pislist = ["container-A_1.0", "container-B_1.0", "container-C_1.0", "container-E_1.0"]
+        self.check_content(self.pm.list_installed_packages(), pislist)
+
+        index = self.pm.get_installed_packages_index(self.pm.install_folder)
+        self.assertTrue(index.index_file.exists())
+        self.assertEqual(sorted(pislist), sorted(index.packages.values()))
+        # Valid index is not rebuilt
+        data = jloadfile(index.index_file)
+        data["root"] = str(index.root_folder)
+        data["mtime"] = self.pm.install_folder.stat().st_mtime_ns
+        data["packages"] = {"foo": "container-A_1.0"}
+        jwritefile(index.index_file, data)
+        self.assertEqual({"foo": "container-A_1.0"}, index.packages)
+
+        # Packages removed outside leaf
+        rmtree_force(self.pm.install_folder / "container-E_1.0")
+        self.check_content(self.pm.list_installed_packages(), ["container-A_1.0", "container-B_1.0", "container-C_1.0"])
+
+        # Folder being extracted
+        folder = self.pm.install_folder / "container-E_1.0"
+        folder.mkdir()
+        self.check_content(self.pm.list_installed_packages(), ["container-A_1.0", "container-B_1.0", "container-C_1.0"])
+        self.assertEqual(["container-E_1.0"], jloadfile(index.index_file)["pending"])
+        data = jloadfile(index.index_file)
+        data["mtime"] = self.pm.install_folder.stat().st_mtime_ns
+        jwritefile(index.index_file, data)
+        shutil.copy(str(self.pm.install_folder / "container-A_1.0" / LeafFiles.MANIFEST), str(folder / LeafFiles.MANIFEST))
+        self.assertIn("container-A_1.0", index.packages.values())
+        self.assertIn("container-E_1.0", index.packages.keys())
+
+        # Uninstall updates the index
+        rmtree_force(folder)
+        self.pm.uninstall_packages(PackageIdentifier.parse_list(["container-A_1.0"]))
+        self.check_content(self.pm.list_installed_packages(), [])
+        self.assertEqual({}, jloadfile(index.index_file)["packages"])
+
+        # Packages removed outside leaf are not hidden by the next install
+        self.pm.install_packages(PackageIdentifier.parse_list(["container-A_1.0"]))
+        data = jloadfile(index.index_file)
+        data["mtime"] = self.pm.install_folder.stat().st_mtime_ns
+        jwritefile(index.index_file, data)
+        rmtree_force(self.pm.install_folder / "container-B_1.0")
+        index.add(self.pm.install_folder / "container-E_1.0", "container-E_1.0")
+        self.assertEqual(
+            ["container-A_1.0", "container-C_1.0", "container-E_1.0"], sorted(self.pm.get_installed_packages_index(self.pm.install_folder).packages.values())
+        )
+
     def test_enable_disable_remote(self):
         self.assertEqual(2, len(self.pm.list_remotes(True)))
         self.assertTrue(len(self.pm.list_available_packages()) > 0)
@@ -235,6 +291,290 @@ class TestApiPackageManager(LeafTestCaseWithRepo):
         with self.assertRaises(InvalidHashException):
             self.pm.install_packages(PackageIdentifier.parse_list(["failure-badhash_1.0"]))
 
+    def test_parallel_download(self):
+        pislist = ["container-A_1.0", "container-B_1.0", "container-C_1.0", "container-E_1.0"]
+        try:
+            for parallel in ("1", "4"):
+                LeafSettings.DOWNLOAD_PARALLEL.value = parallel
+                LeafSettings.DOWNLOAD_PARALLEL_REMOTE.value = "2"
+                self.pm.install_packages(PackageIdentifier.parse_list(["container-A_1.0"]))
+                self.check_content(self.pm.list_installed_packages(), pislist)
+                self.pm.uninstall_packages(PackageIdentifier.parse_list(["container-A_1.0"]))
+                self.check_content(self.pm.list_installed_packages(), [])
+            # Packages are extracted as soon as downloaded, the ones before the failure are installed
+            with self.assertRaises(InvalidHashException):
+                self.pm.install_packages(PackageIdentifier.parse_list(["container-A_1.0", "failure-badhash_1.0"]))
+            self.check_content(self.pm.list_installed_packages(), pislist)
+        finally:
+            LeafSettings.DOWNLOAD_PARALLEL.value = None
+            LeafSettings.DOWNLOAD_PARALLEL_REMOTE.value = None
+
+    def test_parallel_extraction(self):
+        pislist = ["container-A_1.0", "container-B_1.0", "container-C_1.0", "container-E_1.0"]
+        threshold = extract.PIPELINE_THRESHOLD
+        try:
+            for parallel, pipeline_threshold in (("1", threshold), ("4", threshold), ("4", 0)):
+                LeafSettings.EXTRACT_PARALLEL.value = parallel
+                extract.PIPELINE_THRESHOLD = pipeline_threshold
+                self.pm.install_packages(PackageIdentifier.parse_list(["container-A_1.0"]))
+                self.check_content(self.pm.list_installed_packages(), pislist)
+                self.check_installed_packages(pislist)
+                self.pm.uninstall_packages(PackageIdentifier.parse_list(["container-A_1.0"]))
+                self.check_content(self.pm.list_installed_packages(), [])
+
+            # Decompression and extraction are pipelined for big archives
+            for pis in ("compress-xz_1.0", "compress-bz2_1.0", "compress-gz_1.0"):
+                folder = self.volatile_folder / "extract" / pis
+                folder.mkdir(parents=True)
+                self.assertEqual(folder, extract.extract_tarfile(self.repository_folder / (pis + ".leaf"), folder))
+                self.assertEqual(pis, str(InstalledPackage(folder / LeafFiles.MANIFEST).identifier))
+
+            # A single job is extracted in process
+            folder = self.volatile_folder / "extract" / "single"
+            folder.mkdir(parents=True)
+            with extract.ExtractionPool(max_workers=4, jobs=1) as xpool:
+                self.assertTrue(xpool.submit(self.repository_folder / "compress-tar_1.0.leaf", folder).done())
+            self.assertTrue((folder / LeafFiles.MANIFEST).is_file())
+
+            # Packages extracted after a failure are removed
+            with self.assertRaises(Exception):
+                self.pm.install_packages(PackageIdentifier.parse_list(["failure-postinstall-exec_1.0", "container-A_1.0"]))
+            self.check_content(self.pm.list_installed_packages(), [])
+            self.check_installed_packages([])
+        finally:
+            LeafSettings.EXTRACT_PARALLEL.value = None
+            extract.PIPELINE_THRESHOLD = threshold
+
+    def test_content_store(self):
+        store = self.pm.content_store
+        xz_data = self.install_folder / "compress-xz_1.0" / "data"
+        gz_data = self.install_folder / "compress-gz_1.0" / "data"
+        try:
+            LeafSettings.INSTALL_DEDUP.value = "1"
+            self.pm.install_packages(PackageIdentifier.parse_list(["compress-xz_1.0", "compress-gz_1.0"]))
+            self.check_content(self.pm.list_installed_packages(), ["compress-xz_1.0", "compress-gz_1.0"])
+
+            # Same file content is shared, the manifests differ
+            self.assertTrue(os.path.samefile(str(xz_data), str(gz_data)))
+            self.assertEqual(3, xz_data.stat().st_nlink)
+            self.assertFalse(os.path.samefile(str(xz_data.parent / LeafFiles.MANIFEST), str(gz_data.parent / LeafFiles.MANIFEST)))
+            self.assertEqual(3, len(list(store.objects_folder.glob("*/*"))))
+
+            # Objects are removed when no package use them
+            self.pm.uninstall_packages(PackageIdentifier.parse_list(["compress-xz_1.0"]))
+            self.assertEqual(2, gz_data.stat().st_nlink)
+            self.assertEqual(2, len(list(store.objects_folder.glob("*/*"))))
+            self.pm.uninstall_packages(PackageIdentifier.parse_list(["compress-gz_1.0"]))
+            self.assertEqual([], list(store.objects_folder.glob("*/*")))
+
+            # Objects modified through another link are not shared anymore
+            folders = []
+            for name in ("a", "b", "c"):
+                folder = self.volatile_folder / "store" / name
+                folder.mkdir(parents=True)
+                (folder / "file").write_text("hello")
+                (folder / "file").chmod(0o644)
+                store.deduplicate(folder)
+                folders.append(folder)
+                if name == "a":
+                    (folder / "file").chmod(0o444)
+            self.assertFalse(os.path.samefile(str(folders[0] / "file"), str(folders[1] / "file")))
+            self.assertTrue(os.path.samefile(str(folders[1] / "file"), str(folders[2] / "file")))
+            self.assertEqual(0o644, (folders[1] / "file").stat().st_mode & 0o777)
+
+            # Files can be copied to be modified
+            self.assertEqual(1, store.unshare(folders[1]))
+            self.assertFalse(os.path.samefile(str(folders[1] / "file"), str(folders[2] / "file")))
+
+            # Removing a folder keeps the objects, without changing their mode
+            rmtree_force(folders[2])
+            self.assertEqual(0o644, next(store.objects_folder.glob("*/*")).stat().st_mode & 0o777)
+            self.assertEqual(1, store.release(folders[2]))
+            self.assertEqual([], list(store.objects_folder.glob("*/*")))
+            rmtree_force(folders[0])
+            self.assertEqual(0, store.garbage_collect())
+        finally:
+            LeafSettings.INSTALL_DEDUP.value = None
+
+    def test_download_cache(self):
+        cache = self.pm.download_cache
+        self.pm.install_packages(PackageIdentifier.parse_list(["container-A_1.0"]))
+        apmap = self.pm.list_available_packages()
+        ap = apmap[PackageIdentifier.parse("container-A_1.0")]
+
+        # Artifacts are stored by hash
+        self.assertEqual(4, len(cache.entries))
+        cachedfile = cache.get_path(ap.hashsum)
+        self.assertTrue(cachedfile.exists())
+        self.assertEqual(ap.hashsum.split(":")[1], cachedfile.name)
+        entry = [e for e in cache.entries if e.key == cachedfile.name][0]
+        self.assertEqual(cachedfile.stat().st_size, entry.size)
+        self.assertEqual(ap.filename, entry.filename)
+        self.assertIsNotNone(entry.remote)
+        self.assertEqual(sum(e.size for e in cache.entries), cache.total_size)
+
+        # Index is reloaded from disk
+        cache2 = PackageManager().download_cache
+        self.assertEqual([e.key for e in cache.entries], [e.key for e in cache2.entries])
+
+        # Size is kept in the ledger
+        self.assertGreater(cache.last_check, 0)
+        ledger = jloadfile(cache.ledger_file)
+        self.assertEqual(cache.total_size, ledger["size"])
+        self.assertEqual(4, ledger["count"])
+        self.assertEqual(cache.total_size, DownloadCache(cache.folder).total_size)
+
+        # Corrupted files are removed
+        with cachedfile.open("ab") as fp:
+            fp.write(b"foo")
+        removed = self.pm.verify_download_cache()
+        self.assertEqual([cachedfile.name], [e.key for e in removed])
+        self.assertFalse(cachedfile.exists())
+        self.assertEqual(3, len(cache.entries))
+
+        # Least recently used files are evicted first
+        self.pm.install_packages(PackageIdentifier.parse_list(["container-A_2.0"]))
+        lru = cache.entries[0]
+        self.pm.prune_download_cache(max_size=cache.total_size - 1)
+        self.assertFalse(lru.path.exists())
+        self.assertNotIn(lru.key, [e.key for e in cache.entries])
+        self.pm.prune_download_cache(max_size=0)
+        self.assertEqual(0, len(cache.entries))
+        self.assertEqual(0, cache.total_size)
+
+        # Auto clean when the cache is too big
+        try:
+            LeafSettings.CACHE_SIZE_MAX.value = "0"
+            self.pm.uninstall_packages(PackageIdentifier.parse_list(["container-A_1.0"]))
+            self.pm.install_packages(PackageIdentifier.parse_list(["container-A_1.0"]))
+            self.assertEqual(0, len(cache.entries))
+        finally:
+            LeafSettings.CACHE_SIZE_MAX.value = None
+
+    def test_http_session(self):
+        session = self.pm.http_session
+        self.assertIs(session, self.pm.http_session)
+
+        # Record the requests done with the shared session
+        requested_urls = []
+        session.hooks["response"].append(lambda response, *args, **kwargs: requested_urls.append(response.url))
+        self.pm.fetch_remotes(force_refresh=True)
+        self.pm.install_packages(PackageIdentifier.parse_list(["container-A_1.0"]))
+        if self.remote_url1.startswith("http"):
+            # 2 remotes + 4 artifacts
+            self.assertEqual(6, len(requested_urls))
+            self.assertIn(self.remote_url1, requested_urls)
+        else:
+            self.assertEqual(0, len(requested_urls))
+
+        # Session can be replaced
+        session2 = create_http_session(pool_size=1)
+        self.pm.http_session = session2
+        self.assertIs(session2, self.pm.http_session)
+
+    def test_conditional_fetch(self):
+        index = self.pm.remote_cache_folder / "default.json"
+        validators = self.pm.remote_cache_folder / "default.validators.json"
+
+        def update_index(marker):
+            data = jloadfile(index)
+            data["marker"] = marker
+            jwritefile(index, data)
+
+        def get_marker():
+            return jloadfile(index).get("marker")
+
+        update_index("foo")
+        self.pm.fetch_remotes(force_refresh=True)
+        if self.remote_url1.startswith("http"):
+            # Index has not been modified on server side, cache is kept
+            self.assertTrue(validators.exists())
+            self.assertEqual("foo", get_marker())
+            self.assertTrue(self.pm.list_remotes()["default"].is_fetched)
+            # Without validators, index is downloaded
+            validators.unlink()
+            self.pm.fetch_remotes(force_refresh=True)
+            self.assertIsNone(get_marker())
+            self.assertTrue(validators.exists())
+        else:
+            # No conditional request for local files
+            self.assertFalse(validators.exists())
+            self.assertIsNone(get_marker())
+
+        # Validators are removed with the cache
+        self.pm.update_remote(self.pm.list_remotes()["default"])
+        self.assertFalse(index.exists())
+        self.assertFalse(validators.exists())
+
+    def test_fetch_remotes_parallel(self):
+        try:
+            LeafSettings.DOWNLOAD_PARALLEL.value = "4"
+            self.pm.create_remote("broken", self.remote_url1 + ".missing", insecure=True, priority=1)
+            self.pm.create_remote("default2", self.remote_url1, insecure=True)
+            self.pm.fetch_remotes(force_refresh=True)
+            remotes = self.pm.list_remotes()
+            self.assertFalse(remotes["broken"].is_fetched)
+            for alias in ("default", "other", "default2"):
+                self.assertTrue(remotes[alias].is_fetched)
+            self.assertEqual(len(remotes["default"].content), len(remotes["default2"].content))
+        finally:
+            LeafSettings.DOWNLOAD_PARALLEL.value = None
+
+    @unittest.skipIf(sys.version_info < (3, 7), "Binary cache needs python 3.7")
+    def test_remote_binary_cache(self):
+        index = self.pm.remote_cache_folder / "default.json"
+        bincache = self.pm.remote_cache_folder / "default.json.bin"
+        self.assertTrue(bincache.exists())
+        self.assertEqual(jloadfile(index), self.pm.list_remotes()["default"].content)
+
+        # Outdated cache is rebuilt
+        jwritefile(index, jloadfile(index), pp=True)
+        self.assertEqual(jloadfile(index), self.pm.list_remotes()["default"].content)
+        self.assertEqual(jloadfile(index), jloadcache(bincache, index))
+
+        # Invalid cache is ignored
+        bincache.write_bytes(b"foo")
+        self.assertEqual(jloadfile(index), self.pm.list_remotes()["default"].content)
+
+        # Removed with the remote cache
+        self.pm.update_remote(self.pm.list_remotes()["default"])
+        self.assertFalse(bincache.exists())
+
+    def test_available_packages_memo(self):
+        remote = self.pm.list_remotes()["default"]
+        self.assertEqual(remote.available_packages, remote.available_packages)
+        self.assertIsNot(remote.available_packages, remote.available_packages)
+
+        aps1 = self.pm.list_available_packages()
+        aps2 = self.pm.list_available_packages()
+        self.assertEqual(list(aps1.keys()), list(aps2.keys()))
+        for pi, ap in aps1.items():
+            # Copies are returned, so callers can modify them
+            self.assertIsNot(ap, aps2[pi])
+            self.assertEqual(ap.json, aps2[pi].json)
+        ap = next(iter(aps1.values()))
+        ap.custom_tags.append("foo")
+        self.assertNotIn("foo", self.pm.list_available_packages()[ap.identifier].custom_tags)
+
+        # Disabling or enabling a remote invalidates the cache
+        other = self.pm.list_remotes()["other"]
+        other.enabled = False
+        self.pm.update_remote(other)
+        self.assertGreater(len(aps1), len(self.pm.list_available_packages()))
+        other.enabled = True
+        self.pm.update_remote(other)
+        self.pm.fetch_remotes()
+        self.assertEqual(list(aps1.keys()), list(self.pm.list_available_packages().keys()))
+
+        # Removing a remote invalidates the cache
+        self.pm.delete_remote("other")
+        self.assertGreater(len(aps1), len(self.pm.list_available_packages()))
+
+        # Refreshing the remotes invalidates the cache
+        generation = self.pm.remotes_generation
+        self.pm.fetch_remotes(force_refresh=True)
+        self.assertLess(generation, self.pm.remotes_generation)
+
     def test_outdated_leaf_version(self):
         with self.assertRaises(LeafOutOfDateException):
             self.pm.install_packages(PackageIdentifier.parse_list(["failure-minver_1.0"]))
@@ -530,6 +870,32 @@ class TestApiPackageManager(LeafTestCaseWithRepo):
             la = LeafArtifact(file)
             testfunc(file.stat().st_size, la.get_total_size())
 
+    def test_artifact_scan(self):
+        file = self.volatile_folder / "compress-xz_1.0.leaf"
+        shutil.copy(str(self.repository_folder / file.name), str(file))
+        la = self.pm.open_artifact(file)
+        with TarFile.open(str(file)) as tf:
+            self.assertEqual(tf.getnames(), la.members)
+            self.assertEqual(sum(ti.size for ti in tf.getmembers()), la.get_total_size())
+        self.assertEqual(LeafArtifact(file).json, la.json)
+
+        # The scan is reused while the file is not modified
+        scan_files = list((self.cache_folder / LeafFiles.CACHE_ARTIFACTS_FOLDERNAME).iterdir())
+        self.assertEqual(1, len(scan_files))
+        scan = jloadfile(scan_files[0])
+        scan[LeafArtifact.KEY_TOTALSIZE] = 42
+        jwritefile(scan_files[0], scan)
+        self.assertEqual(42, self.pm.open_artifact(file).get_total_size())
+        os.utime(str(file), ns=(file.stat().st_atime_ns, file.stat().st_mtime_ns + 10 ** 9))
+        self.assertEqual(la.get_total_size(), self.pm.open_artifact(file).get_total_size())
+
+        # Scans of removed artifacts are pruned with the cache
+        self.pm.prune_download_cache(max_size=2 ** 40)
+        self.assertEqual(scan_files, list((self.cache_folder / LeafFiles.CACHE_ARTIFACTS_FOLDERNAME).iterdir()))
+        file.unlink()
+        self.pm.prune_download_cache(max_size=2 ** 40)
+        self.assertEqual([], list((self.cache_folder / LeafFiles.CACHE_ARTIFACTS_FOLDERNAME).iterdir()))
+
 
 def start_http_server(folder):
     print("Start http server for {folder} on port {port}".format(folder=folder, port=HTTP_PORT), file=sys.stderr)
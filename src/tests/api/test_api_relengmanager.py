@@ -4,15 +4,17 @@
 
 import json
 import os
+import time
+from tarfile import TarFile
 
 from jsonschema.exceptions import ValidationError
 
 from leaf.api import RelengManager
-from leaf.core.constants import JsonConstants, LeafFiles
+from leaf.core.constants import JsonConstants, LeafFiles, LeafSettings
 from leaf.core.error import LeafException
 from leaf.core.jsonutils import jloadfile, jwritefile
 from leaf.core.utils import hash_compute
-from leaf.model.package import AvailablePackage
+from leaf.model.package import AvailablePackage, LeafArtifact
 from tests.testutils import TEST_REMOTE_PACKAGE_SOURCE, LeafTestCaseWithRepo, check_mime
 
 
@@ -37,6 +39,80 @@ class TestApiRelengManager(LeafTestCaseWithRepo):
         check_all_compressions(".tar.bz2", "x-bzip2")
         check_all_compressions(".tar.xz", "x-xz")
 
+    def test_manifest_first(self):
+        folder = TEST_REMOTE_PACKAGE_SOURCE / "install_1.0"
+        artifact = self.workspace_folder / "myPackage.leaf"
+        self.rm.create_package(folder, artifact)
+        with TarFile.open(str(artifact)) as tf:
+            names = tf.getnames()
+        self.assertEqual(LeafFiles.MANIFEST, names[0])
+        self.assertEqual(1, names.count(LeafFiles.MANIFEST))
+
+        # Only the manifest is read, even if the rest of the archive is missing
+        truncated = self.workspace_folder / "truncated.leaf"
+        with artifact.open("rb") as fp:
+            truncated.write_bytes(fp.read(4000))
+        self.assertEqual("install_1.0", str(LeafArtifact(truncated).identifier))
+        self.assertEqual(names, LeafArtifact(artifact).members)
+
+    def test_custom_tar_member_names(self):
+        folder = self.workspace_folder / "mypackage_1.0"
+        folder.mkdir()
+        jwritefile(folder / LeafFiles.MANIFEST, {"info": {"name": "mypackage", "version": "1.0"}})
+        # File names looking like tar options
+        (folder / "--exclude=manifest.json").write_text("hello")
+        (folder / "-v").write_text("hello")
+        artifact = self.workspace_folder / "mypackage.leaf"
+        try:
+            LeafSettings.CUSTOM_TAR.value = "tar"
+            self.rm.create_package(folder, artifact)
+        finally:
+            LeafSettings.CUSTOM_TAR.value = None
+        with TarFile.open(str(artifact)) as tf:
+            self.assertEqual(["./" + LeafFiles.MANIFEST, "./--exclude=manifest.json", "./-v"], tf.getnames())
+        self.assertEqual("mypackage_1.0", str(LeafArtifact(artifact).identifier))
+
+    def test_reproducible_package(self):
+        folder = self.workspace_folder / "mypackage_1.0"
+        folder.mkdir()
+        jwritefile(folder / LeafFiles.MANIFEST, {"info": {"name": "mypackage", "version": "1.0"}})
+        (folder / "b").mkdir()
+        (folder / "b" / "file").write_text("hello")
+        (folder / "a").write_text("hello world")
+        (folder / "link").symlink_to("a")
+
+        for compression, mime in ((None, "x-tar"), ("gz", "gzip"), ("bz2", "x-bzip2"), ("xz", "x-xz")):
+            artifacts = []
+            for name in ("first.leaf", "second.leaf"):
+                artifact = self.workspace_folder / name
+                self.rm.create_package(folder, artifact, compression=compression)
+                check_mime(artifact, mime)
+                artifacts.append(artifact)
+                # Files are modified but not their content
+                os.utime(str(folder / "a"), (0, time.time() + 10))
+
+            # Same archives, hashed when written
+            info_node = jloadfile(self.rm.find_external_info_file(artifacts[0]))
+            self.assertEqual(hash_compute(artifacts[0]), info_node[JsonConstants.REMOTE_PACKAGE_HASH])
+            self.assertEqual(hash_compute(artifacts[0]), hash_compute(artifacts[1]))
+            self.assertEqual(artifacts[0].stat().st_size, info_node[JsonConstants.REMOTE_PACKAGE_SIZE])
+            self.assertEqual(len("hello world") + len("hello") + (folder / LeafFiles.MANIFEST).stat().st_size, AvailablePackage(info_node).final_size)
+
+            with TarFile.open(str(artifacts[0])) as tf:
+                self.assertEqual([LeafFiles.MANIFEST, "a", "b", "b/file", "link"], tf.getnames())
+                for ti in tf.getmembers():
+                    self.assertEqual((0, 0, "", "", 0), (ti.uid, ti.gid, ti.uname, ti.gname, ti.mtime))
+
+        # The archive is not included in itself
+        artifact = folder / "mypackage.leaf"
+        self.rm.create_package(folder, artifact)
+        self.assertNotIn("mypackage.leaf", LeafArtifact(artifact).members)
+
+        with self.assertRaises(LeafException):
+            self.rm.create_package(folder, self.workspace_folder / "foo.leaf", compression="zip")
+        with self.assertRaises(LeafException):
+            self.rm.create_package(folder, self.workspace_folder / "foo.leaf", tar_extra_args=["-z", "."], compression="gz")
+
     def test_external_info_file(self):
         folder = TEST_REMOTE_PACKAGE_SOURCE / "install_1.0"
         artifact = self.workspace_folder / "myPackage.leaf"
@@ -194,6 +270,52 @@ class TestApiRelengManager(LeafTestCaseWithRepo):
         index_content = jloadfile(index)
         self.assertEqual(11, len(index_content[JsonConstants.REMOTE_PACKAGES]))
 
+    def test_index_parallel_incremental(self):
+        index = self.workspace_folder / "index.json"
+        artifacts = []
+        for pis in ("install_1.0", "condition_1.0", "condition-A_1.0", "condition-B_1.0"):
+            artifact = self.workspace_folder / (pis + ".leaf")
+            self.rm.create_package(TEST_REMOTE_PACKAGE_SOURCE / pis, artifact, store_extenal_info=False)
+            artifacts.append(artifact)
+
+        self.rm.generate_index(index, artifacts, max_workers=1)
+        expected = jloadfile(index)[JsonConstants.REMOTE_PACKAGES]
+        self.rm.generate_index(index, artifacts, max_workers=4)
+        self.assertEqual(expected, jloadfile(index)[JsonConstants.REMOTE_PACKAGES])
+        self.assertEqual(hash_compute(artifacts[0]), expected[0][JsonConstants.REMOTE_PACKAGE_HASH])
+
+        # Unmodified artifacts are not read again
+        content = jloadfile(index)
+        for node in content[JsonConstants.REMOTE_PACKAGES]:
+            node[JsonConstants.REMOTE_PACKAGE_HASH] = "sha384:" + "0" * 96
+        jwritefile(index, content)
+        os.utime(str(index), (time.time() + 10, time.time() + 10))
+        os.utime(str(artifacts[1]), (time.time() + 20, time.time() + 20))
+        self.rm.generate_index(index, artifacts, incremental=True)
+        hashes = [node[JsonConstants.REMOTE_PACKAGE_HASH] for node in jloadfile(index)[JsonConstants.REMOTE_PACKAGES]]
+        self.assertEqual(["sha384:" + "0" * 96, expected[1][JsonConstants.REMOTE_PACKAGE_HASH], "sha384:" + "0" * 96, "sha384:" + "0" * 96], hashes)
+
+        # Without incremental mode, all artifacts are read
+        self.rm.generate_index(index, artifacts)
+        self.assertEqual(expected, jloadfile(index)[JsonConstants.REMOTE_PACKAGES])
+
+        # Extra tags of reused artifacts are updated
+        artifact = self.workspace_folder / "container-A_1.0.leaf"
+        self.rm.create_package(TEST_REMOTE_PACKAGE_SOURCE / "container-A_1.0", artifact, store_extenal_info=False)
+        tags_file = self.workspace_folder / (artifact.name + ".tags")
+
+        def check_tags(expected_tags, **kwargs):
+            self.rm.generate_index(index, [artifact], incremental=True, **kwargs)
+            self.assertEqual(expected_tags, jloadfile(index)[JsonConstants.REMOTE_PACKAGES][0][JsonConstants.INFO][JsonConstants.INFO_TAGS])
+
+        check_tags(["foo"])
+        tags_file.write_text("bar\n")
+        check_tags(["foo", "bar"])
+        check_tags(["foo"], use_extra_tags=False)
+        check_tags(["foo", "bar"])
+        tags_file.unlink()
+        check_tags(["foo"])
+
     def test_index_same_artifact_different_hash(self):
         (self.workspace_folder / "a").mkdir(parents=True, exist_ok=True)
         (self.workspace_folder / "b").mkdir(parents=True, exist_ok=True)
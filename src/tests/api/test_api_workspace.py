@@ -2,13 +2,15 @@
 @author: Legato Tooling Team <letools@sierrawireless.com>
 """
 
+import os
 import platform
 from collections import OrderedDict
 
 import leaf
 from leaf.api import WorkspaceManager
-from leaf.core.constants import LeafSettings
+from leaf.core.constants import LeafFiles, LeafSettings
 from leaf.core.error import InvalidProfileNameException, LeafException, NoProfileSelected, ProfileNameAlreadyExistException
+from leaf.core.jsonutils import jloadfile, jwritefile
 from leaf.model.base import Scope
 from leaf.model.package import IDENTIFIER_GETTER, PackageIdentifier
 from tests.testutils import LeafTestCaseWithRepo, env_tolist
@@ -373,6 +375,63 @@ class TestApiWorkspaceManager(LeafTestCaseWithRepo):
         self.check_installed_packages(["testlatest_1.0", "version_1.1", "version_2.0"])
         self.check_profile_content("myprofile", ["testlatest", "version"])
 
+    def test_profile_dependencies_cache(self):
+        self.wm.init_ws()
+        self.wm.install_packages(PackageIdentifier.parse_list(["condition_1.0"] + ["condition-{0}_1.0".format(c) for c in "ABCDEFGH"]))
+        profile = self.wm.create_profile("myprofile")
+        profile.add_packages(PackageIdentifier.parse_list(["condition_1.0"]))
+        profile.update_environment({"FOO": "BAR"})
+        self.wm.update_profile(profile)
+
+        def get_deps():
+            return [str(ip.identifier) for ip in self.wm.get_profile_dependencies(profile)]
+
+        def tamper_cache(*pislist):
+            entries = jloadfile(cache_file)
+            for entry in entries.values():
+                entry["dependencies"] = list(pislist)
+            jwritefile(cache_file, entries)
+
+        self.assertEqual(["condition-A_1.0", "condition-C_1.0", "condition-F_1.0", "condition_1.0"], get_deps())
+        cache_files = list((self.wm.cache_folder / LeafFiles.CACHE_PROFILES_FOLDERNAME).iterdir())
+        self.assertEqual(1, len(cache_files))
+        cache_file = cache_files[0]
+        entry = next(iter(jloadfile(cache_file).values()))
+        self.assertEqual({"FOO": "BAR", "FOO2": None, "HELLO": None}, entry["variables"])
+
+        # Resolution is reused
+        tamper_cache("condition-B_1.0")
+        self.assertEqual(["condition-B_1.0"], get_deps())
+
+        # Unused variables do not invalidate the cache
+        profile.update_environment({"UNUSED": "foo"})
+        self.wm.update_profile(profile)
+        self.assertEqual(["condition-B_1.0"], get_deps())
+
+        # Used variables do
+        profile.update_environment({"HELLO": "world"})
+        self.wm.update_profile(profile)
+        self.assertEqual(["condition-A_1.0", "condition-C_1.0", "condition-E_1.0", "condition_1.0"], get_deps())
+
+        # Installed packages too
+        tamper_cache("condition-B_1.0")
+        self.assertEqual(["condition-B_1.0"], get_deps())
+        self.wm.install_packages(PackageIdentifier.parse_list(["version_1.0"]))
+        self.assertEqual(["condition-A_1.0", "condition-C_1.0", "condition-E_1.0", "condition_1.0"], get_deps())
+
+        # And manifests modified in place
+        tamper_cache("condition-B_1.0")
+        self.assertEqual(["condition-B_1.0"], get_deps())
+        mffile = self.wm.list_installed_packages()[PackageIdentifier.parse("condition_1.0")].folder / LeafFiles.MANIFEST
+        os.utime(str(mffile), ns=(mffile.stat().st_atime_ns, mffile.stat().st_mtime_ns + 10 ** 9))
+        self.assertEqual(["condition-A_1.0", "condition-C_1.0", "condition-E_1.0", "condition_1.0"], get_deps())
+
+        # Invalid cache is ignored
+        tamper_cache("unknown_1.0")
+        self.assertEqual(["condition-A_1.0", "condition-C_1.0", "condition-E_1.0", "condition_1.0"], get_deps())
+        cache_file.write_text("foo")
+        self.assertEqual(["condition-A_1.0", "condition-C_1.0", "condition-E_1.0", "condition_1.0"], get_deps())
+
     def test_sync_with_package_not_available(self):
         self.wm.init_ws()
 
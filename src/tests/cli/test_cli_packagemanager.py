@@ -144,6 +144,14 @@ class TestCliPackageManager(LeafTestCaseWithCli):
         self.leaf_exec(["package", "uninstall"], "container-A_1.0")
         self.check_installed_packages(["container-A_2.0", "container-C_1.0", "container-D_1.0"])
 
+    def test_cache(self):
+        self.leaf_exec(["package", "install"], "container-A_1.0")
+        self.leaf_exec("cache")
+        self.leaf_exec(["cache", "show"])
+        self.leaf_exec(["cache", "verify"])
+        self.leaf_exec(["cache", "prune"])
+        self.leaf_exec(["cache", "prune"], "--size", "0", "--untracked")
+
     def test_conditional_install(self):
         self.leaf_exec(["package", "install"], "condition_1.0")
         self.check_installed_packages(["condition_1.0", "condition-B_1.0", "condition-D_1.0", "condition-F_1.0", "condition-H_1.0"])
@@ -15,6 +15,12 @@ class TestConditions(LeafTestCase):
         self.assertEqual(pi, cpi)
         self.assertEqual([], cpi.conditions)
 
+        cpi = ConditionalPackageIdentifier("foo", "1.2-beta", None)
+        self.assertEqual(pi, cpi)
+        self.assertIsNone(cpi.conditions)
+        self.assertEqual([], cpi.condition_variables)
+        self.assertTrue(cpi.are_conditions_satified({}))
+
         cpi = ConditionalPackageIdentifier.parse("foo_1.2-beta(FOO=BAR)")
         self.assertEqual(pi, cpi)
         self.assertEqual(["FOO=BAR"], cpi.conditions)
@@ -122,3 +128,38 @@ class TestConditions(LeafTestCase):
 
         env = Environment("ut", {"FOO": "BAR", "BAR": "1"})
         self.assertFalse(cpi.are_conditions_satified(env))
+
+    def test_parse_cache(self):
+        # Parsed identifiers are immutable and shared
+        self.assertIs(PackageIdentifier.parse("foo_1.0"), PackageIdentifier.parse("foo_1.0"))
+        self.assertIs(ConditionalPackageIdentifier.parse("foo_1.0(FOO)"), ConditionalPackageIdentifier.parse("foo_1.0(FOO)"))
+        self.assertIsNot(PackageIdentifier.parse("foo_1.0"), ConditionalPackageIdentifier.parse("foo_1.0"))
+        with self.assertRaises(AttributeError):
+            PackageIdentifier.parse("foo_1.0").foo = "bar"
+
+        cpi = ConditionalPackageIdentifier.parse("foo_1.0(FOO)")
+        cpi.conditions.append("BAR")
+        self.assertEqual(["FOO"], ConditionalPackageIdentifier.parse("foo_1.0(FOO)").conditions)
+
+        with self.assertRaises(ValueError):
+            ConditionalPackageIdentifier.parse("foo")
+        with self.assertRaises(ValueError):
+            ConditionalPackageIdentifier.parse(None)
+
+    def test_snapshot(self):
+        env = Environment("ut", {"FOO": "1", "BAR": "HELLO"})
+        subenv = Environment("sub", {"FOO": "2"})
+        env.append(subenv)
+        env.append(Environment("sub2", {"FOO": "3"}))
+        # Last value wins, like find_value
+        self.assertEqual({"FOO": "1", "BAR": "HELLO"}, env.snapshot())
+        self.assertEqual(env.find_value("FOO"), env.snapshot()["FOO"])
+
+        cpi = ConditionalPackageIdentifier.parse("foo_1.0(FOO=1)(BAR~ell)(!BAZ)")
+        self.assertEqual(["FOO", "BAR", "BAZ"], cpi.condition_variables)
+        self.assertTrue(cpi.are_conditions_satified(env))
+        self.assertTrue(cpi.are_conditions_satified(env.snapshot()))
+        self.assertFalse(cpi.are_conditions_satified({"FOO": "1", "BAR": "HELLO", "BAZ": ""}))
+
+        with self.assertRaises(ValueError):
+            ConditionalPackageIdentifier.parse("foo_1.0(FOO BAR)").are_conditions_satified({})
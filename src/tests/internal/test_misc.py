@@ -2,15 +2,19 @@
 @author: Legato Tooling Team <letools@sierrawireless.com>
 """
 
+import sys
+import unittest
 from pathlib import Path
 from random import shuffle
 from tempfile import mktemp
 
 from leaf.core.constants import LeafFiles
-from leaf.core.error import LeafException
-from leaf.core.jsonutils import JsonObject, jloadfile, jwritefile
+from leaf.core.download import download_and_verify_file, download_file
+from leaf.core.error import InvalidHashException, LeafException
+from leaf.core.jsonutils import JsonObject, jloadcache, jloadfile, jwritecache, jwritefile
 from leaf.core.lock import LockFile
-from leaf.model.modelutils import keep_latest
+from leaf.core.utils import hash_compute, hash_create, hash_tostring, hash_update
+from leaf.model.modelutils import PackageMap, find_latest_version, find_manifest, keep_latest
 from leaf.model.package import AvailablePackage, InstalledPackage, PackageIdentifier
 from leaf.model.remote import Remote
 from leaf.model.steps import VariableResolver
@@ -48,6 +52,30 @@ class TestMisc(LeafTestCase):
         with self.assertRaises(ValueError):
             jo.jsonpath(["a", "d", "e"])
 
+    @unittest.skipIf(sys.version_info < (3, 7), "Binary cache needs python 3.7")
+    def test_json_cache(self):
+        source = self.volatile_folder / "data.json"
+        cache = self.volatile_folder / "data.json.bin"
+        jwritefile(source, {"b": [1, 2, {"c": None}], "a": "foo", "d": {"z": True, "y": 1.5}})
+        data = jloadfile(source)
+
+        self.assertIsNone(jloadcache(cache, source))
+        jwritecache(cache, data, source)
+        cached = jloadcache(cache, source)
+        self.assertEqual(data, cached)
+        self.assertEqual(list(data.keys()), list(cached.keys()))
+        self.assertEqual(list(data["d"].keys()), list(cached["d"].keys()))
+
+        # Cache is invalidated when source changes
+        jwritefile(source, {"a": "bar"})
+        self.assertIsNone(jloadcache(cache, source))
+
+        # Invalid cache
+        jwritecache(cache, jloadfile(source), source)
+        with cache.open("ab") as fp:
+            fp.truncate(cache.stat().st_size - 2)
+        self.assertIsNone(jloadcache(cache, source))
+
     def test_sort_pi(self):
         a10 = PackageIdentifier.parse("a_1.0")
         a11 = PackageIdentifier.parse("a_1.1")
@@ -64,6 +92,33 @@ class TestMisc(LeafTestCase):
             latest_pilist = keep_latest([b10, a20, a10, b11, b21, b20, a21, a11])
             self.assertEqual(latest_pilist, [a21, b21])
 
+    def test_package_map(self):
+        pkgmap = PackageMap()
+        for pis in ("b_1.0", "a_2.0", "a_1.10", "a_1.2", "b_1.0-rc1"):
+            pkgmap[PackageIdentifier.parse(pis)] = pis
+        self.assertEqual(["a", "b"], pkgmap.names)
+        self.assertEqual(PackageIdentifier.parse_list(["a_1.2", "a_1.10", "a_2.0"]), pkgmap.get_versions("a"))
+        self.assertEqual(PackageIdentifier.parse("a_2.0"), pkgmap.get_latest("a"))
+        self.assertEqual(PackageIdentifier.parse("b_1.0-rc1"), find_latest_version("b", pkgmap))
+        self.assertEqual("a_2.0", find_manifest(PackageIdentifier.parse("a_latest"), pkgmap))
+        self.assertEqual(PackageIdentifier.parse_list(["a_2.0", "b_1.0-rc1"]), keep_latest(pkgmap))
+        self.assertIsNone(pkgmap.get_latest("c"))
+
+        # Index is updated with the map
+        del pkgmap[PackageIdentifier.parse("a_2.0")]
+        self.assertEqual(PackageIdentifier.parse("a_1.10"), pkgmap.get_latest("a"))
+        pkgmap.pop(PackageIdentifier.parse("b_1.0-rc1"))
+        pkgmap.pop(PackageIdentifier.parse("b_1.0-rc1"), None)
+        self.assertEqual(PackageIdentifier.parse("b_1.0"), pkgmap.get_latest("b"))
+        pkgmap.popitem(last=False)
+        self.assertEqual(["a"], pkgmap.names)
+        pkgmap.update({PackageIdentifier.parse("c_1.0"): "c_1.0"})
+        self.assertEqual(PackageIdentifier.parse("c_1.0"), pkgmap.copy().get_latest("c"))
+        pkgmap.setdefault(PackageIdentifier.parse("a_3.0"), "a_3.0")
+        self.assertEqual("a_3.0", find_manifest(PackageIdentifier.parse("a_latest"), pkgmap))
+        pkgmap.clear()
+        self.assertEqual([], pkgmap.names)
+
     def test_variable_resolver(self):
 
         ip1 = InstalledPackage(TEST_REMOTE_PACKAGE_SOURCE / "version_1.0" / LeafFiles.MANIFEST)
@@ -93,6 +148,18 @@ class TestMisc(LeafTestCase):
         with self.assertRaises(LeafException):
             vr.resolve("@{NAME} @{VERSION:version_1.2} @{DIR:version_latest}")
 
+    def test_lazy_manifest(self):
+        mffile = TEST_REMOTE_PACKAGE_SOURCE / "version_1.0" / LeafFiles.MANIFEST
+        ip = InstalledPackage(mffile, identifier=PackageIdentifier.parse("version_1.0"))
+        self.assertEqual(PackageIdentifier.parse("version_1.0"), ip.identifier)
+        self.assertEqual(InstalledPackage(mffile).json, ip.json)
+
+        # Manifest is only read when needed
+        ip = InstalledPackage(TEST_REMOTE_PACKAGE_SOURCE / "unknown" / LeafFiles.MANIFEST, identifier=PackageIdentifier.parse("unknown_1.0"))
+        self.assertEqual("unknown_1.0", str(ip))
+        with self.assertRaises(FileNotFoundError):
+            ip.description
+
     def test_lock_advisory(self):
         advisory = True
         lf = LockFile("/tmp/advisory.lock")
@@ -183,3 +250,34 @@ class TestMisc(LeafTestCase):
 
         remote_custom.json["priority"] = 100
         self.assertEqual("https://foo.tld/custom/pack.leaf", ap.best_candidate.url)
+
+    def test_download_hash(self):
+        source = TEST_REMOTE_PACKAGE_SOURCE / "version_1.0" / LeafFiles.MANIFEST
+        expected = hash_compute(source)
+
+        # Hash of a prefix
+        size = source.stat().st_size
+        with source.open("rb") as fp:
+            prefix = fp.read(size // 2)
+        prefix_hasher = hash_create()
+        prefix_hasher.update(prefix)
+        self.assertEqual(hash_tostring(prefix_hasher), hash_tostring(hash_update(hash_create(), source, size=size // 2)))
+        self.assertEqual(expected, hash_tostring(hash_update(hash_create(), source, size=size * 2)))
+
+        # Hash computed while downloading
+        for url in (str(source), source.as_uri()):
+            output = self.volatile_folder / "download" / "manifest.json"
+            if output.exists():
+                output.unlink()
+            self.assertIsNone(download_file(url, output))
+            self.assertEqual(expected, hash_compute(output))
+            output.unlink()
+            self.assertEqual(expected, download_file(url, output, compute_hash=True))
+            output.unlink()
+            self.assertEqual(output, download_and_verify_file(url, output, hashstr=expected))
+            output.unlink()
+            with self.assertRaises(InvalidHashException):
+                download_and_verify_file(url, output, hashstr="sha384:" + "0" * 96)
+            # Nothing is left in place of an invalid download
+            self.assertFalse(output.exists())
+            self.assertEqual([], list(output.parent.iterdir()))
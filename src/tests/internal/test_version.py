@@ -5,6 +5,8 @@
 
 from leaf import __version__
 from leaf.core.utils import CURRENT_LEAF_VERSION, Version, version_comparator
+from leaf.model.modelutils import find_latest_version, keep_latest
+from leaf.model.package import PackageIdentifier
 from leaf.tools import OPERATOR_LABELS
 from tests.testutils import LeafTestCase
 
@@ -66,3 +68,33 @@ class TestVersion(LeafTestCase):
         # Default behaviour
         self.assertEqual(-1, version_comparator("1.0", "1.0.0"))
         self.assertEqual(1, version_comparator("1.0.0.0", "1.0.0"))
+
+    def test_hash(self):
+        self.assertEqual(Version("1.0"), Version("1.00"))
+        self.assertEqual(hash(Version("1.0")), hash(Version("1.00")))
+        self.assertEqual(1, len({Version("1.0"), Version("1.00"), Version("1-0 ")}))
+        self.assertNotEqual(Version("1.0"), Version("1.0.0"))
+
+        pimap = {PackageIdentifier.parse("foo_1.0"): "foo"}
+        self.assertEqual("foo", pimap.get(PackageIdentifier.parse("foo_1.00")))
+        self.assertIsNone(pimap.get(PackageIdentifier.parse("foo_1.0.0")))
+
+    def test_sort(self):
+        versions = ["1.10", "1.2", "1.2.a", "1.2.0", "1.a", "1", "1.2-rc1", "2.0", "1.02"]
+        self.assertEqual(["1", "1.2", "1.02", "1.2.0", "1.2.a", "1.2-rc1", "1.10", "1.a", "2.0"], [str(v) for v in sorted(map(Version, versions))])
+        for a in versions:
+            for b in versions:
+                self.assertEqual(version_comparator(a, b), (Version(a) > Version(b)) - (Version(a) < Version(b)))
+
+        # Parts mixing digits and letters are compared run by run
+        versions = ["1.1", "1.9", "1.10", "1.0rc1", "1.2b3", "2.0a1", "19.10", "19.04b1"]
+        self.assertEqual(["1.0rc1", "1.1", "1.2b3", "1.9", "1.10", "2.0a1", "19.04b1", "19.10"], [str(v) for v in sorted(map(Version, versions))])
+        self.assertLess(Version("1.0rc1"), Version("1.1"))
+        self.assertLess(Version("19.04b1"), Version("19.10"))
+        self.assertLess(Version("1.0rc1"), Version("1.0rc2"))
+        self.assertLess(Version("1.0rc2"), Version("1.0rc10"))
+
+        pilist = PackageIdentifier.parse_list(["foo_1.2", "bar_2.0", "foo_1.10", "bar_1.0", "foo_1.02"])
+        self.assertEqual(["bar_1.0", "bar_2.0", "foo_1.2", "foo_1.02", "foo_1.10"], [str(pi) for pi in sorted(pilist)])
+        self.assertEqual(PackageIdentifier.parse("foo_1.10"), find_latest_version("foo", pilist))
+        self.assertEqual(["bar_2.0", "foo_1.10"], [str(pi) for pi in keep_latest(pilist)])